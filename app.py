@@ -5,18 +5,34 @@ Robot de Ventas Hotmart - Backend Flask
 API para webhook Hotmart, Web Push y FAQ
 """
 
+import time
+# Inicio del import del módulo (desglose de tiempos de arranque)
+IMPORT_STARTED = time.perf_counter()
+
 import sys
 import os
+import re
 import json
-import psycopg2
-import psycopg2.extras
+import math
 import hmac
 import hashlib
-from difflib import get_close_matches
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, redirect
+import secrets
+import ipaddress
+import threading
+import gzip
+import atexit
+import asyncio
+import importlib.util
+import mimetypes
+import unicodedata
+from collections import OrderedDict, deque
+from difflib import SequenceMatcher
+from datetime import datetime, timedelta
+from flask import Flask, request, jsonify, send_from_directory, send_file, redirect, g
 from dotenv import load_dotenv
-from urllib.parse import urlparse
+from werkzeug.security import safe_join
+from html import escape as html_escape
+from urllib.parse import urlparse, urlencode, parse_qsl
 
 # Cargar variables de entorno
 load_dotenv()
@@ -49,6 +65,8 @@ def get_db_connection():
     
     if db_url and db_url.startswith('postgresql'):
         try:
+            # Import diferido: con SQLite el driver no se carga nunca
+            import psycopg2
             print(f"🔗 Conectando a PostgreSQL: {db_url.split('@')[0]}...")
             conn = psycopg2.connect(db_url)
             return conn
@@ -61,6 +79,29 @@ def get_db_connection():
         print(f"🔗 Conectando a SQLite: {db_url or 'robot.db'}...")
         return sqlite3.connect('robot.db')
 
+def is_postgresql_db():
+    """Detectar si DATABASE_URL apunta a PostgreSQL"""
+    db_url = os.getenv('DATABASE_URL')
+    return bool(db_url and db_url.startswith('postgresql'))
+
+def sql_placeholder():
+    """Placeholder de parámetros según el driver (%s o ?)"""
+    return '%s' if is_postgresql_db() else '?'
+
+def ensure_column(cursor, table, column, definition):
+    """Agregar una columna a una tabla existente si todavía no existe"""
+    if is_postgresql_db():
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+        return
+
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Versión del esquema que crea init_db(): subirla cada vez que init_db cambia
+# (el preflight del arranque solo migra si la base tiene otra versión)
+SCHEMA_VERSION = 9
+
 def init_db():
     """Inicializar base de datos (PostgreSQL o SQLite)"""
     db_url = os.getenv('DATABASE_URL')
@@ -182,26 +223,187 @@ def init_db():
             )
         ''')
         
-        # Tabla de analytics - tracking de clics y visitas
+        # Tabla de analytics - tracking de clics y visitas. Los strings repetidos
+        # (URL, user agent, UTM...) van una sola vez a analytics_dimensions y
+        # analytics_facts guarda su id; `analytics` es una vista con las columnas de siempre
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS analytics_dimensions (
+                id {id_type},
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                UNIQUE (kind, value)
+            )
+        ''')
+        dimension_keys = ''.join(f'{column}_key INTEGER,\n' for column in ANALYTICS_DIMENSIONS)
         cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS analytics (
+            CREATE TABLE IF NOT EXISTS analytics_facts (
                 id {id_type},
                 event_type TEXT NOT NULL,
-                page_url TEXT,
-                element_id TEXT,
-                element_text TEXT,
-                user_agent TEXT,
+                {dimension_keys}
                 ip_address TEXT,
                 country TEXT,
+                session_id TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                metadata {json_type}
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analytics_facts_page ON analytics_facts (event_type, page_url_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analytics_facts_element ON analytics_facts (event_type, element_id_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_analytics_facts_timestamp ON analytics_facts (timestamp)')
+        # Bases anteriores: la tabla analytics pasa a analytics_facts + diccionario
+        if analytics_is_table(cursor):
+            ensure_column(cursor, 'analytics', 'country', 'TEXT')
+            migrate_analytics_to_facts(cursor)
+        if is_postgresql:
+            cursor.execute(f'CREATE OR REPLACE VIEW analytics AS {analytics_view_sql()}')
+        else:
+            cursor.execute('DROP VIEW IF EXISTS analytics')
+            cursor.execute(f'CREATE VIEW analytics AS {analytics_view_sql()}')
+        
+        # Chats que iniciaron el bot de Telegram (destinatarios de difusiones)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS telegram_chats (
+                chat_id BIGINT PRIMARY KEY,
+                first_name TEXT,
+                username TEXT,
+                status TEXT DEFAULT 'active',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Difusiones de Telegram (last_chat_id permite retomar una interrumpida)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS telegram_broadcasts (
+                id {id_type},
+                message TEXT NOT NULL,
+                status TEXT DEFAULT 'running',
+                last_chat_id BIGINT DEFAULT 0,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                blocked_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+
+        # Tráfico de bots: solo contadores por día, motivo y tipo de evento (no van a analytics)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_traffic (
+                day TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                events INTEGER DEFAULT 0,
+                PRIMARY KEY (day, reason, event_type)
+            )
+        ''')
+
+        # Sesiones armadas a partir de los eventos (una fila por session_id)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                started_at TIMESTAMP,
+                ended_at TIMESTAMP,
+                duration_seconds INTEGER DEFAULT 0,
+                time_on_page INTEGER DEFAULT 0,
+                events INTEGER DEFAULT 0,
+                page_views INTEGER DEFAULT 0,
+                clicks INTEGER DEFAULT 0,
+                max_scroll INTEGER DEFAULT 0,
+                landing_page TEXT,
                 referrer TEXT,
                 utm_source TEXT,
                 utm_medium TEXT,
                 utm_campaign TEXT,
-                session_id TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                metadata {json_type}
+                country TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_started ON sessions (started_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_utm_source ON sessions (utm_source, started_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_landing ON sessions (landing_page, started_at)')
+
+        # Embudo por día y atribución: visitas -> clics al checkout -> compras.
+        # Las dimensiones vacías se guardan como '' (son parte de la clave)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funnel_daily (
+                day TEXT NOT NULL,
+                utm_source TEXT NOT NULL DEFAULT '',
+                utm_medium TEXT NOT NULL DEFAULT '',
+                utm_campaign TEXT NOT NULL DEFAULT '',
+                src TEXT NOT NULL DEFAULT '',
+                page_views INTEGER DEFAULT 0,
+                cta_clicks INTEGER DEFAULT 0,
+                purchases INTEGER DEFAULT 0,
+                revenue DECIMAL(12,2) DEFAULT 0,
+                PRIMARY KEY (day, utm_source, utm_medium, utm_campaign, src)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_funnel_daily_campaign ON funnel_daily (utm_campaign, day)')
+        # Eventos de Hotmart sin pasar por el embudo (los reenvíos vuelven a processed = FALSE)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_hotmart_events_pending ON hotmart_events (id) WHERE processed = FALSE')
+        # Clic de /go/<slug> -> dimensiones del embudo de la visita. Hotmart devuelve
+        # solo src/sck en la venta y /go genera un sck por clic: un src repetido
+        # en varias campañas no se pisa (reemplaza a attribution_sources, clave src)
+        cursor.execute('DROP TABLE IF EXISTS attribution_sources')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attribution_clicks (
+                hotmart_src TEXT NOT NULL DEFAULT '',
+                sck TEXT NOT NULL DEFAULT '',
+                utm_source TEXT NOT NULL DEFAULT '',
+                utm_medium TEXT NOT NULL DEFAULT '',
+                utm_campaign TEXT NOT NULL DEFAULT '',
+                src TEXT NOT NULL DEFAULT '',
+                last_seen TIMESTAMP,
+                PRIMARY KEY (hotmart_src, sck)
+            )
+        ''')
+        # Ventas ya sumadas al embudo (una vez por transacción aunque Hotmart reenvíe)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attributed_sales (
+                transaction_id TEXT PRIMARY KEY,
+                day TEXT NOT NULL,
+                utm_source TEXT NOT NULL DEFAULT '',
+                utm_medium TEXT NOT NULL DEFAULT '',
+                utm_campaign TEXT NOT NULL DEFAULT '',
+                src TEXT NOT NULL DEFAULT '',
+                revenue DECIMAL(10,2) DEFAULT 0
+            )
+        ''')
+
+        # Catálogo del archivo en frío: días [day_from, day_to) exportados a Parquet
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS analytics_archive (
+                id {id_type},
+                day_from TEXT NOT NULL,
+                day_to TEXT NOT NULL,
+                path TEXT NOT NULL,
+                rows INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+
+        # Historial de entregas de push (para podar suscripciones muertas)
+        ensure_column(cursor, 'push_subs', 'status', "TEXT DEFAULT 'active'")
+        ensure_column(cursor, 'push_subs', 'failure_count', 'INTEGER DEFAULT 0')
+        ensure_column(cursor, 'push_subs', 'last_success', 'TIMESTAMP')
+        ensure_column(cursor, 'push_subs', 'country', 'TEXT')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_push_subs_status_last_used ON push_subs(status, last_used)')
+        
+        # Catálogo: slug estable por producto (lo usan la API, el bot y las páginas).
+        # El producto inicial se insertaba en cada init_db: el slug queda en el
+        # primero y las copias se desactivan
+        ensure_column(cursor, 'products', 'slug', 'TEXT')
+        placeholder = '%s' if is_postgresql else '?'
+        cursor.execute(f'''
+            UPDATE products SET slug = {placeholder}
+            WHERE slug IS NULL AND id = (SELECT MIN(id) FROM products WHERE name = {placeholder})
+        ''', ('enciclopedia-plantas-medicinales', 'Enciclopedia de Plantas Medicinales'))
+        cursor.execute(f'''
+            UPDATE products SET status = 'duplicate'
+            WHERE slug IS NULL AND name = {placeholder}
+        ''', ('Enciclopedia de Plantas Medicinales',))
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_products_slug ON products(slug)')
         
         # Insertar FAQs iniciales
         if is_postgresql:
@@ -241,35 +443,46 @@ def init_db():
                 INSERT OR IGNORE INTO faqs (question, answer, category, keywords) VALUES (?, ?, ?, ?)
             ''', faqs_data)
         
-        # Insertar producto inicial
-        if is_postgresql:
-            cursor.execute('''
-                INSERT INTO products (name, description, price, currency, hotmart_link, category) VALUES
-                ('Enciclopedia de Plantas Medicinales', 
-                 'Guía completa con más de 550 hierbas medicinales, preparados caseros, cultivo y propiedades terapéuticas', 
-                 29.99, 
-                 'USD', 
-                 'https://go.hotmart.com/H102540942W', 
-                 'libros-digitales')
-                ON CONFLICT DO NOTHING
-            ''')
-        else:
-            cursor.execute('''
-                INSERT OR IGNORE INTO products (name, description, price, currency, hotmart_link, category) VALUES
-                ('Enciclopedia de Plantas Medicinales', 
-                 'Guía completa con más de 550 hierbas medicinales, preparados caseros, cultivo y propiedades terapéuticas', 
-                 29.99, 
-                 'USD', 
-                 'https://go.hotmart.com/H102540942W', 
-                 'libros-digitales')
-            ''')
+        # Insertar producto inicial (una sola vez: se identifica por slug)
+        placeholder = '%s' if is_postgresql else '?'
+        cursor.execute(f'SELECT COUNT(*) FROM products WHERE slug = {placeholder}', ('enciclopedia-plantas-medicinales',))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f'''
+                INSERT INTO products (slug, name, description, price, currency, hotmart_link, category) VALUES
+                ({', '.join([placeholder] * 7)})
+            ''', (
+                'enciclopedia-plantas-medicinales',
+                'Enciclopedia de Plantas Medicinales',
+                'Guía completa con más de 550 hierbas medicinales, preparados caseros, cultivo y propiedades terapéuticas',
+                29.99,
+                'USD',
+                'https://go.hotmart.com/H102540942W',
+                'libros-digitales'
+            ))
+        
+        # Versión del esquema (la lee el preflight del arranque)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        cursor.execute(f'''
+            INSERT INTO app_meta (key, value) VALUES ('schema_version', {placeholder})
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        ''', (str(SCHEMA_VERSION),))
+        # Último id procesado por los trabajos incrementales (sesiones y embudo)
+        cursor.executemany(f'''
+            INSERT INTO app_meta (key, value) VALUES ({placeholder}, '0')
+            ON CONFLICT (key) DO NOTHING
+        ''', [(key,) for key in (SESSIONS_CHECKPOINT_KEY, FUNNEL_EVENTS_CHECKPOINT_KEY)])
         
         conn.commit()
         if is_postgresql:
             print("✅ Base de datos PostgreSQL inicializada correctamente")
         else:
             print("✅ Base de datos SQLite inicializada correctamente")
-        print("✅ Tablas creadas: push_subs, hotmart_events, faqs, products, visitors, notifications, analytics")
+        print("✅ Tablas creadas: push_subs, hotmart_events, faqs, products, visitors, notifications, analytics (vista), analytics_facts, analytics_dimensions, telegram_chats, telegram_broadcasts, bot_traffic, sessions, funnel_daily, attribution_clicks, attributed_sales, analytics_archive")
         print("✅ FAQs y producto inicial insertados")
         
     except Exception as e:
@@ -279,6 +492,2954 @@ def init_db():
     finally:
         conn.close()
 
+def analytics_is_table(cursor):
+    """True si `analytics` todavía es la tabla original (no la vista)"""
+    if is_postgresql_db():
+        cursor.execute("""
+            SELECT table_type FROM information_schema.tables
+            WHERE table_name = 'analytics' AND table_schema = current_schema()
+        """)
+        row = cursor.fetchone()
+        return bool(row) and row[0] == 'BASE TABLE'
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'analytics'")
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'table'
+
+def dimension_value_sql(expression):
+    """
+    SQL que recorta un valor para el diccionario. En PostgreSQL el límite del
+    índice es en bytes: lo que pasa de ANALYTICS_DIMENSION_MAX_BYTES se corta
+    a un cuarto en caracteres (UTF-8 usa hasta 4 bytes por carácter)
+    """
+    if is_postgresql_db():
+        return (f"CASE WHEN OCTET_LENGTH({expression}) <= {ANALYTICS_DIMENSION_MAX_BYTES} THEN {expression} "
+                f"ELSE LEFT({expression}, {ANALYTICS_DIMENSION_MAX_BYTES // 4}) END")
+    # SQLite no tiene límite de largo en los índices
+    return f"SUBSTR({expression}, 1, {ANALYTICS_DIMENSION_MAX_BYTES})"
+
+def migrate_analytics_to_facts(cursor):
+    """Pasar las filas de la tabla analytics a analytics_facts + diccionario y borrarla"""
+    for column in ANALYTICS_DIMENSIONS:
+        cursor.execute(f'''
+            INSERT INTO analytics_dimensions (kind, value)
+            SELECT DISTINCT '{column}', {dimension_value_sql(column)}
+            FROM analytics WHERE {column} IS NOT NULL
+            ON CONFLICT (kind, value) DO NOTHING
+        ''')
+
+    keys = ', '.join(f'{column}_key' for column in ANALYTICS_DIMENSIONS)
+    ids = ', '.join(f'd_{column}.id' for column in ANALYTICS_DIMENSIONS)
+    joins = ' '.join(
+        f"LEFT JOIN analytics_dimensions d_{column} ON d_{column}.kind = '{column}' "
+        f"AND d_{column}.value = {dimension_value_sql(f'a.{column}')}"
+        for column in ANALYTICS_DIMENSIONS
+    )
+    cursor.execute(f'''
+        INSERT INTO analytics_facts (id, event_type, {keys}, ip_address, country, session_id, timestamp, metadata)
+        SELECT a.id, a.event_type, {ids}, a.ip_address, a.country, a.session_id, a.timestamp, a.metadata
+        FROM analytics a {joins}
+    ''')
+    migrated = cursor.rowcount
+
+    if is_postgresql_db():
+        # Los ids se copiaron explícitos: adelantar la secuencia
+        cursor.execute("SELECT setval(pg_get_serial_sequence('analytics_facts', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM analytics_facts")
+    cursor.execute('DROP TABLE analytics')
+    print(f"✅ Analytics migrado a tabla de hechos + diccionario ({migrated} eventos)")
+
+def analytics_view_sql():
+    """SELECT de la vista `analytics`: mismas columnas que la tabla original"""
+    select = []
+    joins = []
+    for column in ANALYTICS_VIEW_COLUMNS:
+        if column in ANALYTICS_DIMENSIONS:
+            select.append(f'd_{column}.value AS {column}')
+            joins.append(f'LEFT JOIN analytics_dimensions d_{column} ON d_{column}.id = f.{column}_key')
+        else:
+            select.append(f'f.{column}')
+    return f"SELECT {', '.join(select)} FROM analytics_facts f {' '.join(joins)}"
+
+# ============================================
+# TRACKING DE NOTIFICACIONES PUSH
+# ============================================
+
+# Segundos entre volcados de contadores a la base de datos
+PUSH_FLUSH_INTERVAL = int(os.getenv('PUSH_FLUSH_INTERVAL', '10'))
+# Cantidad de notificaciones distintas pendientes que fuerza un volcado inmediato
+PUSH_FLUSH_MAX_PENDING = int(os.getenv('PUSH_FLUSH_MAX_PENDING', '500'))
+
+class PushCounterBuffer:
+    """
+    Acumula aperturas y clics de notificaciones en memoria y los vuelca
+    en lote con un UPDATE por notificación (no uno por evento).
+
+    Cada worker de gunicorn tiene su propio buffer; como los volcados son
+    incrementos (opened_count = opened_count + n) los totales se suman bien.
+    """
+
+    FIELDS = {'open': 0, 'click': 1}
+
+    def __init__(self, flush_interval=PUSH_FLUSH_INTERVAL, max_pending=PUSH_FLUSH_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = {}  # notification_id -> [aperturas, clics]
+        self.thread = None
+
+    def record(self, notification_id, event):
+        """Registrar un evento 'open' o 'click' de una notificación"""
+        index = self.FIELDS[event]
+        with self.lock:
+            counts = self.pending.setdefault(notification_id, [0, 0])
+            counts[index] += 1
+            pending_size = len(self.pending)
+
+        self._ensure_thread()
+        if pending_size >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        """Volcar contadores pendientes a la tabla notifications"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return 0
+
+        ph = sql_placeholder()
+        rows = [(opened, clicked, notification_id) for notification_id, (opened, clicked) in pending.items()]
+
+        try:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(f'''
+                    UPDATE notifications
+                    SET opened_count = opened_count + {ph},
+                        clicked_count = clicked_count + {ph}
+                    WHERE id = {ph}
+                ''', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"❌ Error volcando contadores push: {e}")
+            # Reincorporar lo pendiente para no perder eventos
+            with self.lock:
+                for notification_id, (opened, clicked) in pending.items():
+                    counts = self.pending.setdefault(notification_id, [0, 0])
+                    counts[0] += opened
+                    counts[1] += clicked
+            return 0
+
+        return len(rows)
+
+    def _ensure_thread(self):
+        """Arrancar el hilo de volcado periódico (lazy, después del fork de gunicorn)"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='push-counter-flush', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+push_counters = PushCounterBuffer()
+atexit.register(push_counters.flush)
+
+def record_push_event(data):
+    """Validar y acumular un beacon de sw.js. Devuelve un mensaje de error o None"""
+    event = data.get('event')
+
+    try:
+        notification_id = int(data.get('notification_id'))
+    except (TypeError, ValueError):
+        return 'notification_id inválido'
+
+    if event not in PushCounterBuffer.FIELDS:
+        return 'Evento inválido'
+
+    push_counters.record(notification_id, event)
+    return None
+
+# ============================================
+# GEOLOCALIZACIÓN (GEOIP)
+# ============================================
+
+try:
+    import maxminddb
+except ImportError:  # GeoIP es opcional: sin él country queda vacío
+    maxminddb = None
+
+# Base en formato MaxMind (GeoLite2-Country.mmdb o GeoIP2-Country.mmdb)
+GEOIP_DB_PATH = os.getenv('GEOIP_DB_PATH', os.path.join(os.path.dirname(__file__), 'GeoLite2-Country.mmdb'))
+# IPs resueltas en memoria (muchos eventos repiten la misma IP)
+GEOIP_CACHE_SIZE = 50000
+# Segundos entre chequeos de cambios del archivo (se actualiza semanalmente)
+GEOIP_CHECK_INTERVAL = 300
+# Proxies públicos que agregan su salto a X-Forwarded-For: 1 con solo el de la
+# plataforma, 2 con una CDN adelante (Cloudflare, CloudFront...)
+TRUSTED_PROXY_COUNT = max(1, int(os.getenv('TRUSTED_PROXY_COUNT', '1')))
+
+def real_client_ip(forwarded_for, remote_addr=None, trusted_proxies=TRUSTED_PROXY_COUNT):
+    """
+    IP real del cliente a partir de X-Forwarded-For ("cliente, proxy1, proxy2").
+    Cada proxy de confianza agrega al final la IP que vio, así que el cliente
+    es la IP pública número trusted_proxies contando desde el final (las
+    primeras las puede inventar el cliente). Las IPs privadas son saltos
+    internos y no cuentan.
+    """
+    candidates = []
+    for part in (forwarded_for or '').split(','):
+        try:
+            candidates.append(ipaddress.ip_address(part.strip()))
+        except ValueError:
+            continue
+
+    public = [ip for ip in candidates if ip.is_global]
+    if public:
+        # Menos saltos que proxies configurados: la más vieja que hay
+        return str(public[max(0, len(public) - trusted_proxies)])
+    if candidates:
+        return str(candidates[0])
+    return remote_addr or ''
+
+class GeoIpResolver:
+    """
+    País (código ISO) de una IP usando la base de MaxMind mapeada en memoria
+    (MODE_MMAP: el sistema operativo comparte las páginas entre workers) y un
+    LRU de resultados. Si el archivo cambia se vuelve a abrir.
+    """
+
+    def __init__(self, db_path=GEOIP_DB_PATH, cache_size=GEOIP_CACHE_SIZE, check_interval=GEOIP_CHECK_INTERVAL):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.reader = None
+        self.stamp = None
+        self.checked_at = None
+        self.cache = OrderedDict()  # ip -> código de país o None
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_reader(self):
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return self.reader
+        self.checked_at = now
+
+        if maxminddb is None:
+            return None
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return None
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self.stamp:
+            try:
+                reader = maxminddb.open_database(self.db_path, maxminddb.MODE_MMAP)
+            except Exception as e:
+                print(f"❌ Error abriendo base GeoIP {self.db_path}: {e}")
+                return self.reader
+            if self.reader is not None:
+                self.reader.close()
+            self.reader, self.stamp = reader, stamp
+            self.cache.clear()
+            print(f"🌍 Base GeoIP cargada: {reader.metadata().database_type}")
+        return self.reader
+
+    def country(self, ip):
+        """Código ISO del país (o None si no se conoce)"""
+        if not ip:
+            return None
+        with self.lock:
+            reader = self._ensure_reader()
+            if reader is None:
+                return None
+            if ip in self.cache:
+                self.cache.move_to_end(ip)
+                self.hits += 1
+                return self.cache[ip]
+            self.misses += 1
+
+            try:
+                record = reader.get(ip) or {}
+            except ValueError:
+                record = {}
+            # registered_country como respaldo (rangos anycast o de proveedores)
+            country = (record.get('country') or record.get('registered_country') or {}).get('iso_code')
+
+            self.cache[ip] = country
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return country
+
+    def stats(self):
+        with self.lock:
+            return {
+                'base': os.path.basename(self.db_path) if self.reader is not None else None,
+                'ips_cacheadas': len(self.cache),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses
+            }
+
+geoip = GeoIpResolver()
+
+# ============================================
+# FILTRO DE TRÁFICO DE BOTS
+# ============================================
+
+# Crawlers, previsualizadores de links, navegadores headless y clientes HTTP de scripts.
+# Solo tokens conocidos: los navegadores in-app (Instagram, Facebook, WhatsApp,
+# TikTok) mandan un UA de navegador con el nombre de la app y son personas
+BOT_UA_RE = re.compile(
+    r'crawler|spider|googlebot|google-inspectiontool|adsbot-google|mediapartners-google|bingbot|'
+    r'bingpreview|msnbot|yandex(?:bot|images)|duckduckbot|applebot|slurp|sogou|exabot|seznambot|'
+    r'petalbot|ahrefsbot|semrushbot|mj12bot|dotbot|rogerbot|bytespider|gptbot|claudebot|ccbot|amazonbot|'
+    r'facebookexternalhit|facebookcatalog|twitterbot|linkedinbot|slackbot|discordbot|telegrambot|'
+    r'pinterestbot|redditbot|skypeuripreview|embedly|iframely|'
+    r'headlesschrome|phantomjs|selenium|webdriver|playwright|chrome-lighthouse|google page speed|'
+    r'gtmetrix|pingdom|uptimerobot|statuscake|site24x7|'
+    # Previsualizador de WhatsApp y clientes HTTP: el UA empieza con su nombre (no con Mozilla/)
+    r'^(?:whatsapp|curl|wget|python-requests|python-urllib|python-httpx|aiohttp|go-http-client|java|'
+    r'okhttp|libwww-perl|node-fetch|axios|scrapy)/',
+    re.IGNORECASE
+)
+# Veredictos cacheados por user agent (la cantidad de UAs distintos es chica)
+BOT_UA_CACHE_SIZE = 4096
+# Sesiones seguidas para las heurísticas de comportamiento
+BOT_MAX_SESSIONS = 50000
+# Más de BOT_MAX_CLICKS clics en BOT_CLICK_WINDOW segundos: nadie hace clic tan rápido
+BOT_CLICK_WINDOW = 10
+BOT_MAX_CLICKS = 15
+# Clics sin ningún scroll a partir de los cuales la sesión se considera automatizada
+BOT_NO_SCROLL_CLICKS = 10
+# Segundos entre volcados de los contadores de bots
+BOT_FLUSH_INTERVAL = 30
+
+CLICK_EVENTS = {'click'}
+SCROLL_EVENTS = {'scroll', 'scroll_milestone'}
+
+class BotFilter:
+    """
+    Clasifica eventos al ingresar, antes de encolarlos para analytics.
+
+    - User agent: regex compilada; el veredicto se cachea por UA (LRU).
+    - Sesión (session_id): ráfagas de clics imposibles o muchos clics sin
+      ningún scroll. Una vez marcada, todos los eventos siguientes de la
+      sesión cuentan como bot (los anteriores ya quedaron registrados).
+
+    classify() devuelve el motivo ('user_agent', 'ua_vacio',
+    'clics_imposibles', 'sin_scroll') o None si parece una persona.
+    """
+
+    def __init__(self, ua_cache_size=BOT_UA_CACHE_SIZE, max_sessions=BOT_MAX_SESSIONS):
+        self.ua_cache_size = ua_cache_size
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.ua_verdicts = OrderedDict()  # user agent -> motivo o None
+        self.sessions = OrderedDict()  # session_id -> estado
+        self.ua_hits = 0
+        self.ua_misses = 0
+
+    def classify(self, event_type, user_agent, session_id=None, now=None):
+        reason = self.user_agent_verdict(user_agent or '')
+        if reason or not session_id:
+            return reason
+        return self._session_verdict(session_id, event_type, now if now is not None else time.monotonic())
+
+    def user_agent_verdict(self, user_agent):
+        """Motivo si el user agent es de un bot (cacheado por UA)"""
+        with self.lock:
+            if user_agent in self.ua_verdicts:
+                self.ua_verdicts.move_to_end(user_agent)
+                self.ua_hits += 1
+                return self.ua_verdicts[user_agent]
+            self.ua_misses += 1
+
+        if not user_agent.strip():
+            reason = 'ua_vacio'
+        else:
+            reason = 'user_agent' if BOT_UA_RE.search(user_agent) else None
+
+        with self.lock:
+            self.ua_verdicts[user_agent] = reason
+            if len(self.ua_verdicts) > self.ua_cache_size:
+                self.ua_verdicts.popitem(last=False)
+        return reason
+
+    def _session_verdict(self, session_id, event_type, now):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = {
+                    'clicks': deque(maxlen=BOT_MAX_CLICKS + 1), 'total_clicks': 0, 'scrolled': False, 'bot': None
+                }
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(session_id)
+
+            if session['bot']:
+                return session['bot']
+
+            if event_type in SCROLL_EVENTS:
+                session['scrolled'] = True
+            elif event_type in CLICK_EVENTS:
+                clicks = session['clicks']
+                clicks.append(now)
+                session['total_clicks'] += 1
+                if len(clicks) > BOT_MAX_CLICKS and now - clicks[0] <= BOT_CLICK_WINDOW:
+                    session['bot'] = 'clics_imposibles'
+                elif session['total_clicks'] >= BOT_NO_SCROLL_CLICKS and not session['scrolled']:
+                    session['bot'] = 'sin_scroll'
+
+            return session['bot']
+
+    def stats(self):
+        with self.lock:
+            return {
+                'uas_cacheados': len(self.ua_verdicts),
+                'cache_hits': self.ua_hits,
+                'cache_misses': self.ua_misses,
+                'sesiones': len(self.sessions),
+                'sesiones_bot': sum(1 for session in self.sessions.values() if session['bot'])
+            }
+
+class BotTrafficCounter:
+    """
+    Contador de eventos de bots descartados: en vez de una fila de analytics
+    por evento, un UPSERT por (día, motivo, tipo de evento) cada BOT_FLUSH_INTERVAL.
+    """
+
+    def __init__(self, flush_interval=BOT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}  # (día, motivo, tipo de evento) -> eventos
+        self.totals = {}  # motivo -> eventos desde que arrancó el proceso
+        self.thread = None
+
+    def record(self, reason, event_type):
+        """Contar un evento descartado"""
+        key = (datetime.utcnow().strftime('%Y-%m-%d'), reason, event_type or '')
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + 1
+            self.totals[reason] = self.totals.get(reason, 0) + 1
+        self._ensure_thread()
+
+    def flush(self):
+        """Sumar los contadores pendientes a la tabla bot_traffic"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return 0
+
+        ph = sql_placeholder()
+        rows = [(day, reason, event_type, events) for (day, reason, event_type), events in pending.items()]
+
+        try:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.executemany(f'''
+                    INSERT INTO bot_traffic (day, reason, event_type, events) VALUES ({ph}, {ph}, {ph}, {ph})
+                    ON CONFLICT (day, reason, event_type) DO UPDATE SET events = bot_traffic.events + EXCLUDED.events
+                ''', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"❌ Error volcando contadores de bots: {e}")
+            # Reincorporar lo pendiente para no perder la cuenta
+            with self.lock:
+                for key, events in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + events
+            return 0
+
+        return len(rows)
+
+    def _ensure_thread(self):
+        """Arrancar el hilo de volcado periódico (lazy, después del fork de gunicorn)"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='bot-counter-flush', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+bot_filter = BotFilter()
+bot_traffic = BotTrafficCounter()
+atexit.register(bot_traffic.flush)
+
+def drop_bot_event(event_type, user_agent, session_id=None):
+    """True si el evento es de un bot: se cuenta aparte y no se guarda en analytics"""
+    reason = bot_filter.classify(event_type, user_agent, session_id)
+    if reason is None:
+        return False
+    bot_traffic.record(reason, event_type)
+    return True
+
+# ============================================
+# BUFFER DE ANALYTICS
+# ============================================
+
+# Segundos entre volcados de eventos a la tabla analytics
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '2'))
+# Eventos pendientes que adelantan el volcado
+ANALYTICS_FLUSH_MAX_PENDING = int(os.getenv('ANALYTICS_FLUSH_MAX_PENDING', '500'))
+# Tope de eventos en memoria si la base no responde (se descartan los más viejos)
+ANALYTICS_BUFFER_MAX = int(os.getenv('ANALYTICS_BUFFER_MAX', '50000'))
+
+ANALYTICS_COLUMNS = (
+    'event_type', 'page_url', 'element_id', 'element_text',
+    'user_agent', 'ip_address', 'country', 'referrer',
+    'utm_source', 'utm_medium', 'utm_campaign',
+    'session_id', 'metadata', 'timestamp'
+)
+ANALYTICS_IP_INDEX = ANALYTICS_COLUMNS.index('ip_address')
+ANALYTICS_COUNTRY_INDEX = ANALYTICS_COLUMNS.index('country')
+
+# Columnas de texto repetitivo que se guardan como id de analytics_dimensions
+ANALYTICS_DIMENSIONS = (
+    'page_url', 'element_id', 'element_text', 'user_agent',
+    'referrer', 'utm_source', 'utm_medium', 'utm_campaign'
+)
+# Columnas de la vista `analytics` (las de la tabla original, en el mismo orden)
+ANALYTICS_VIEW_COLUMNS = (
+    'id', 'event_type', 'page_url', 'element_id', 'element_text', 'user_agent', 'ip_address',
+    'country', 'referrer', 'utm_source', 'utm_medium', 'utm_campaign', 'session_id', 'timestamp', 'metadata'
+)
+# Columnas de analytics_facts en el orden de ANALYTICS_COLUMNS
+ANALYTICS_FACT_COLUMNS = tuple(f'{column}_key' if column in ANALYTICS_DIMENSIONS else column
+                               for column in ANALYTICS_COLUMNS)
+# Bytes (UTF-8) máximos de un valor del diccionario: el índice único de
+# PostgreSQL no acepta entradas de más de ~2700 bytes
+ANALYTICS_DIMENSION_MAX_BYTES = 1000
+# Valores del diccionario en memoria por proceso
+ANALYTICS_DIMENSION_CACHE_SIZE = int(os.getenv('ANALYTICS_DIMENSION_CACHE_SIZE', '100000'))
+# Valores por SELECT ... IN (...) al buscar ids nuevos
+ANALYTICS_DIMENSION_LOOKUP_BATCH = 500
+
+class DimensionCache:
+    """
+    (tipo, valor) -> id de analytics_dimensions, en memoria (LRU).
+    Los ids no cambian nunca, así que la cache no se invalida: solo los
+    valores que no están en memoria van a la base (INSERT ... ON CONFLICT
+    DO NOTHING y un SELECT por lote).
+    """
+
+    def __init__(self, max_entries=ANALYTICS_DIMENSION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, conn, rows):
+        """Filas de ANALYTICS_COLUMNS -> filas de ANALYTICS_FACT_COLUMNS"""
+        indexes = [(ANALYTICS_COLUMNS.index(column), column) for column in ANALYTICS_DIMENSIONS]
+        keys = [
+            [(column, truncate_dimension(str(row[index]))) if row[index] is not None else None
+             for index, column in indexes]
+            for row in rows
+        ]
+
+        with self.lock:
+            missing = {key for row_keys in keys for key in row_keys if key is not None and key not in self.ids}
+            self.misses += len(missing)
+            self.hits += sum(1 for row_keys in keys for key in row_keys if key is not None) - len(missing)
+        if missing:
+            self._resolve(conn, missing)
+
+        encoded = []
+        with self.lock:
+            for row, row_keys in zip(rows, keys):
+                row = list(row)
+                for (index, _), key in zip(indexes, row_keys):
+                    row[index] = self.ids.get(key) if key is not None else None
+                    if key is not None:
+                        self.ids.move_to_end(key)
+                encoded.append(tuple(row))
+        return encoded
+
+    def _resolve(self, conn, keys):
+        """Insertar los valores nuevos y traer sus ids (commit propio: el diccionario solo crece)"""
+        ph = sql_placeholder()
+        cursor = conn.cursor()
+        cursor.executemany(f'''
+            INSERT INTO analytics_dimensions (kind, value) VALUES ({ph}, {ph})
+            ON CONFLICT (kind, value) DO NOTHING
+        ''', sorted(keys))
+
+        by_kind = {}
+        for kind, value in keys:
+            by_kind.setdefault(kind, []).append(value)
+
+        found = {}
+        for kind, values in by_kind.items():
+            for start in range(0, len(values), ANALYTICS_DIMENSION_LOOKUP_BATCH):
+                batch = values[start:start + ANALYTICS_DIMENSION_LOOKUP_BATCH]
+                cursor.execute(
+                    f"SELECT id, value FROM analytics_dimensions WHERE kind = {ph} AND value IN ({', '.join([ph] * len(batch))})",
+                    [kind] + batch
+                )
+                for dimension_id, value in cursor.fetchall():
+                    found[(kind, value)] = dimension_id
+        conn.commit()
+
+        with self.lock:
+            self.ids.update(found)
+            while len(self.ids) > self.max_entries:
+                self.ids.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'valores': len(self.ids), 'hits': self.hits, 'misses': self.misses}
+
+def truncate_dimension(value):
+    """Recortar a ANALYTICS_DIMENSION_MAX_BYTES bytes UTF-8 sin partir un carácter"""
+    if len(value) * 4 <= ANALYTICS_DIMENSION_MAX_BYTES:
+        return value
+    encoded = value.encode('utf-8')
+    if len(encoded) <= ANALYTICS_DIMENSION_MAX_BYTES:
+        return value
+    return encoded[:ANALYTICS_DIMENSION_MAX_BYTES].decode('utf-8', 'ignore')
+
+analytics_dimensions = DimensionCache()
+
+class AnalyticsBuffer:
+    """
+    Cola en memoria de eventos de analytics: el request solo encola y un
+    hilo los inserta en lote (executemany) cada ANALYTICS_FLUSH_INTERVAL
+    segundos o antes si se juntan ANALYTICS_FLUSH_MAX_PENDING.
+    El timestamp se toma al encolar, no al insertar; los strings
+    repetitivos se codifican con el diccionario al volcar.
+    """
+
+    def __init__(self, flush_interval=ANALYTICS_FLUSH_INTERVAL, max_pending=ANALYTICS_FLUSH_MAX_PENDING,
+                 max_buffer=ANALYTICS_BUFFER_MAX):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = deque(maxlen=max_buffer)
+        self.dropped = 0
+        self.thread = None
+        # En modo ASGI el volcado lo programa una tarea async (asgi.py), no el hilo
+        self.autostart = True
+
+    def record(self, event_type, **fields):
+        """Encolar un evento (no toca la base de datos)"""
+        # Mismo formato que CURRENT_TIMESTAMP (UTC) en SQLite y PostgreSQL
+        fields['timestamp'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        fields['event_type'] = event_type
+        fields['metadata'] = json.dumps(fields.get('metadata') or {})
+        row = tuple(fields.get(column) for column in ANALYTICS_COLUMNS)
+
+        with self.lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(row)
+            pending_size = len(self.pending)
+
+        if self.autostart:
+            self._ensure_thread()
+        if pending_size >= self.max_pending:
+            self.wakeup.set()
+
+    def drain(self):
+        """
+        Sacar todos los eventos pendientes (filas en el orden de ANALYTICS_COLUMNS)
+        con la IP real y el país resueltos: corre al volcar, fuera del request.
+        """
+        with self.lock:
+            rows = list(self.pending)
+            self.pending.clear()
+        return [self._enrich(row) for row in rows]
+
+    def _enrich(self, row):
+        row = list(row)
+        ip = real_client_ip(row[ANALYTICS_IP_INDEX], row[ANALYTICS_IP_INDEX])
+        row[ANALYTICS_IP_INDEX] = ip
+        row[ANALYTICS_COUNTRY_INDEX] = row[ANALYTICS_COUNTRY_INDEX] or geoip.country(ip)
+        return tuple(row)
+
+    def requeue(self, rows):
+        """Devolver filas que no se pudieron insertar (delante de las nuevas)"""
+        with self.lock:
+            self.pending.extendleft(reversed(rows))
+
+    def encode(self, rows):
+        """Filas de drain() -> filas de analytics_facts (conexión sync propia; modo ASGI)"""
+        conn = get_db_connection()
+        try:
+            return analytics_dimensions.encode(conn, rows)
+        finally:
+            conn.close()
+
+    def after_flush(self):
+        """Jobs incrementales que leen lo recién volcado (sesiones y embudo)"""
+        sessionizer.maybe_run()
+        funnel_builder.maybe_run()
+
+    def insert_sql(self, placeholder):
+        """INSERT para executemany con el placeholder del driver"""
+        return f'''
+            INSERT INTO analytics_facts ({', '.join(ANALYTICS_FACT_COLUMNS)})
+            VALUES ({', '.join([placeholder] * len(ANALYTICS_FACT_COLUMNS))})
+        '''
+
+    def flush(self):
+        """Insertar los eventos pendientes en analytics_facts (strings como ids del diccionario)"""
+        with self.flush_lock:
+            rows = self.drain()
+            if not rows:
+                return 0
+
+            try:
+                conn = get_db_connection()
+                try:
+                    encoded = analytics_dimensions.encode(conn, rows)
+                    cursor = conn.cursor()
+                    cursor.executemany(self.insert_sql(sql_placeholder()), encoded)
+                    conn.commit()
+                finally:
+                    conn.close()
+            except Exception as e:
+                print(f"❌ Error volcando eventos de analytics: {e}")
+                self.requeue(rows)
+                return 0
+
+        self.after_flush()
+        return len(rows)
+
+    def _ensure_thread(self):
+        """Arrancar el hilo de volcado periódico (lazy, después del fork de gunicorn)"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='analytics-flush', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+analytics_buffer = AnalyticsBuffer()
+atexit.register(analytics_buffer.flush)
+
+def record_analytics_event(data, args, user_agent='', ip_address='', referrer=''):
+    """
+    Validar y encolar un evento de /api/analytics/track.
+    Devuelve un mensaje de error o None. Compartido por WSGI y ASGI.
+    """
+    event_type = (data or {}).get('event_type')  # 'click', 'page_view', 'scroll', etc.
+    if not event_type:
+        return 'Tipo de evento requerido'
+
+    # Crawlers y sesiones automatizadas: solo suman a bot_traffic
+    if drop_bot_event(event_type, user_agent, data.get('session_id')):
+        return None
+
+    # UTM y src de la página donde ocurrió el evento (el beacon se manda a
+    # /api/analytics/track sin query string); los de la URL del beacon, si vienen, ganan
+    attribution = url_attribution(data.get('page_url'))
+    metadata = data.get('metadata') or {}
+    if attribution['src'] and isinstance(metadata, dict) and 'src' not in metadata:
+        metadata = {**metadata, 'src': attribution['src']}
+
+    # Se encola y se inserta en lote desde un hilo (el request no espera a la base)
+    analytics_buffer.record(
+        event_type,
+        page_url=data.get('page_url'),
+        element_id=data.get('element_id'),
+        element_text=data.get('element_text'),
+        user_agent=user_agent,
+        ip_address=ip_address,
+        referrer=referrer,
+        utm_source=args.get('utm_source') or attribution['utm_source'],
+        utm_medium=args.get('utm_medium') or attribution['utm_medium'],
+        utm_campaign=args.get('utm_campaign') or attribution['utm_campaign'],
+        session_id=data.get('session_id'),
+        metadata=metadata
+    )
+    return None
+
+def url_attribution(page_url):
+    """utm_source, utm_medium, utm_campaign y src de la query string de una URL"""
+    try:
+        query = dict(parse_qsl(urlparse(str(page_url or '')).query))
+    except ValueError:
+        query = {}
+    return {name: query.get(name, '') for name in ('utm_source', 'utm_medium', 'utm_campaign', 'src')}
+
+# ============================================
+# ARCHIVO EN FRÍO DE ANALYTICS
+# ============================================
+
+try:
+    import pyarrow
+    import pyarrow.compute as pyarrow_compute
+    import pyarrow.dataset as pyarrow_dataset
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:  # El archivo es opcional: sin pyarrow todo queda en la tabla
+    pyarrow = None
+
+# Directorio de los archivos Parquet (uno por corrida de archivado)
+ANALYTICS_ARCHIVE_DIR = os.getenv('ANALYTICS_ARCHIVE_DIR', os.path.join(os.path.dirname(__file__), 'archive', 'analytics'))
+# Días completos que quedan en la tabla; lo anterior se archiva
+ANALYTICS_ARCHIVE_AFTER_DAYS = int(os.getenv('ANALYTICS_ARCHIVE_AFTER_DAYS', '90'))
+# Filas leídas de la base por lote al exportar (y por row group de Parquet)
+ANALYTICS_ARCHIVE_BATCH_SIZE = 50000
+ANALYTICS_ARCHIVE_COMPRESSION = 'zstd'
+
+def analytics_archive_schema():
+    """Columnas del archivo: las de la vista `analytics`, con los strings ya resueltos"""
+    fields = []
+    for column in ANALYTICS_VIEW_COLUMNS:
+        if column == 'id':
+            fields.append(pyarrow.field(column, pyarrow.int64()))
+        elif column == 'timestamp':
+            fields.append(pyarrow.field(column, pyarrow.timestamp('s')))
+        else:
+            fields.append(pyarrow.field(column, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+def analytics_archive_batch(rows, schema):
+    """Filas de la vista -> RecordBatch (timestamps de SQLite vienen como texto, metadata de PostgreSQL como dict)"""
+    columns = list(zip(*rows))
+    arrays = []
+    for column, values in zip(ANALYTICS_VIEW_COLUMNS, columns):
+        if column == 'timestamp':
+            values = [datetime.fromisoformat(str(value)) if value is not None else None for value in values]
+        elif column == 'metadata':
+            values = [value if value is None or isinstance(value, str) else json.dumps(value) for value in values]
+        arrays.append(pyarrow.array(values, type=schema.field(column).type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+def archive_analytics(keep_days=ANALYTICS_ARCHIVE_AFTER_DAYS, batch_size=ANALYTICS_ARCHIVE_BATCH_SIZE):
+    """
+    Mover los eventos de días cerrados (más viejos que keep_days) a un
+    archivo Parquet comprimido y borrarlos de analytics_facts.
+
+    El archivo se escribe completo (.tmp + rename) antes de tocar la tabla;
+    el registro en analytics_archive y el DELETE van en la misma transacción.
+    El diccionario (analytics_dimensions) no se poda: el archivo guarda los strings.
+
+    Returns:
+        dict: reporte con el rango archivado, filas y tamaño del archivo
+    """
+    if pyarrow is None:
+        raise RuntimeError('pyarrow no está instalado')
+    # Que ningún evento salga de la tabla sin haber pasado a sessions y al embudo
+    sessionizer.run()
+    funnel_builder.run()
+
+    ph = sql_placeholder()
+    day_to = (datetime.utcnow() - timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    report = {'day_to': day_to, 'rows': 0, 'bytes': 0, 'path': None}
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT MIN(timestamp), MAX(id) FROM analytics_facts WHERE timestamp < {ph}', (day_to,))
+        first_timestamp, max_id = cursor.fetchone()
+        if max_id is None:
+            return report
+        day_from = str(first_timestamp)[:10]
+        report['day_from'] = day_from
+
+        os.makedirs(ANALYTICS_ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(ANALYTICS_ARCHIVE_DIR, f'analytics-{day_from}_{day_to}.parquet')
+        tmp_path = f'{path}.tmp'
+        schema = analytics_archive_schema()
+
+        # Recorrido por id (el índice de la PK) hasta el último id del rango
+        last_id = 0
+        with pyarrow_parquet.ParquetWriter(tmp_path, schema, compression=ANALYTICS_ARCHIVE_COMPRESSION) as writer:
+            while True:
+                cursor.execute(f'''
+                    SELECT {', '.join(ANALYTICS_VIEW_COLUMNS)} FROM analytics
+                    WHERE id > {ph} AND id <= {ph} AND timestamp < {ph}
+                    ORDER BY id
+                    LIMIT {int(batch_size)}
+                ''', (last_id, max_id, day_to))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                writer.write_batch(analytics_archive_batch(rows, schema))
+                report['rows'] += len(rows)
+        os.replace(tmp_path, path)
+        report['path'] = path
+        report['bytes'] = os.path.getsize(path)
+
+        try:
+            cursor.execute(f'''
+                INSERT INTO analytics_archive (day_from, day_to, path, rows, bytes)
+                VALUES ({ph}, {ph}, {ph}, {ph}, {ph})
+            ''', (day_from, day_to, path, report['rows'], report['bytes']))
+            cursor.execute(f'DELETE FROM analytics_facts WHERE id <= {ph} AND timestamp < {ph}', (max_id, day_to))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            os.remove(path)
+            raise
+    finally:
+        conn.close()
+
+    return report
+
+def archived_ranges(date_from=None, date_to=None):
+    """Archivos del catálogo que se solapan con [date_from, date_to)"""
+    ph = sql_placeholder()
+    conditions, params = [], []
+    if date_from:
+        conditions.append(f'day_to > {ph}')
+        params.append(date_from)
+    if date_to:
+        conditions.append(f'day_from < {ph}')
+        params.append(date_to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT day_from, day_to, path, rows, bytes FROM analytics_archive {where} ORDER BY day_from', params)
+        return [
+            {'day_from': row[0], 'day_to': row[1], 'path': row[2], 'rows': row[3], 'bytes': row[4]}
+            for row in cursor.fetchall()
+        ]
+    finally:
+        conn.close()
+
+def add_counts(totals, rows):
+    """Sumar filas (clave..., cantidad) en un dict clave -> cantidad"""
+    for row in rows:
+        key = tuple(row[:-1])
+        totals[key] = totals.get(key, 0) + row[-1]
+
+def query_archived_analytics(paths, date_from, date_to):
+    """Agregados de [date_from, date_to) leyendo solo las columnas necesarias de los Parquet"""
+    dataset = pyarrow_dataset.dataset(paths, format='parquet')
+    timestamp = pyarrow_dataset.field('timestamp')
+    table = dataset.to_table(
+        columns=['event_type', 'page_url', 'element_id', 'element_text', 'timestamp'],
+        filter=(timestamp >= datetime.fromisoformat(date_from)) & (timestamp < datetime.fromisoformat(date_to))
+    )
+    table = table.append_column('day', pyarrow_compute.strftime(table['timestamp'], format='%Y-%m-%d'))
+
+    daily = table.group_by(['day', 'event_type']).aggregate([('event_type', 'count')])
+    pages = table.filter(pyarrow_compute.and_(
+        pyarrow_compute.equal(table['event_type'], 'page_view'), pyarrow_compute.is_valid(table['page_url'])
+    )).group_by('page_url').aggregate([('page_url', 'count')])
+    clicks = table.filter(pyarrow_compute.and_(
+        pyarrow_compute.equal(table['event_type'], 'click'), pyarrow_compute.is_valid(table['element_id'])
+    )).group_by(['element_id', 'element_text']).aggregate([('element_id', 'count')])
+
+    return {
+        'daily': list(zip(*(daily[column].to_pylist() for column in ('day', 'event_type', 'event_type_count')))),
+        'pages': list(zip(pages['page_url'].to_pylist(), pages['page_url_count'].to_pylist())),
+        'clicks': list(zip(*(clicks[column].to_pylist() for column in ('element_id', 'element_text', 'element_id_count')))),
+    }
+
+def query_live_analytics(cursor, date_from, date_to):
+    """Los mismos agregados sobre analytics_facts (agrupando por claves enteras)"""
+    ph = sql_placeholder()
+    params = (date_from, date_to)
+    in_range = f'timestamp >= {ph} AND timestamp < {ph}'
+
+    cursor.execute(f'''
+        SELECT DATE(timestamp) as day, event_type, COUNT(*)
+        FROM analytics_facts WHERE {in_range}
+        GROUP BY DATE(timestamp), event_type
+    ''', params)
+    daily = [(str(row[0]), row[1], row[2]) for row in cursor.fetchall()]
+
+    cursor.execute(f'''
+        SELECT d.value, t.visits
+        FROM (
+            SELECT page_url_key, COUNT(*) as visits FROM analytics_facts
+            WHERE {in_range} AND event_type = 'page_view' AND page_url_key IS NOT NULL
+            GROUP BY page_url_key
+        ) t
+        JOIN analytics_dimensions d ON d.id = t.page_url_key
+    ''', params)
+    pages = cursor.fetchall()
+
+    cursor.execute(f'''
+        SELECT de.value, dt.value, t.clicks
+        FROM (
+            SELECT element_id_key, element_text_key, COUNT(*) as clicks FROM analytics_facts
+            WHERE {in_range} AND event_type = 'click' AND element_id_key IS NOT NULL
+            GROUP BY element_id_key, element_text_key
+        ) t
+        JOIN analytics_dimensions de ON de.id = t.element_id_key
+        LEFT JOIN analytics_dimensions dt ON dt.id = t.element_text_key
+    ''', params)
+    clicks = cursor.fetchall()
+
+    return {'daily': daily, 'pages': pages, 'clicks': clicks}
+
+def analytics_archive_stats():
+    """Resumen del catálogo para /api/stats"""
+    archives = archived_ranges()
+    return {
+        'archivos': len(archives),
+        'eventos': sum(archive['rows'] for archive in archives),
+        'bytes': sum(archive['bytes'] for archive in archives),
+        'hasta': archives[-1]['day_to'] if archives else None,
+        'pyarrow': pyarrow is not None
+    }
+
+def query_analytics_history(date_from, date_to, limit=10):
+    """
+    Estadísticas de [date_from, date_to) (fechas 'YYYY-MM-DD') sumando los
+    archivos Parquet del rango y lo que sigue en la tabla.
+    """
+    sources = [{'daily': [], 'pages': [], 'clicks': []}]
+    archives = archived_ranges(date_from, date_to)
+    if archives:
+        if pyarrow is None:
+            raise RuntimeError('pyarrow no está instalado: no se pueden leer los archivos de analytics')
+        sources.append(query_archived_analytics([archive['path'] for archive in archives], date_from, date_to))
+
+    # Si el rango cae entero dentro de lo archivado no hace falta tocar la tabla
+    if not archives or date_to > max(archive['day_to'] for archive in archives):
+        conn = get_db_connection()
+        try:
+            sources.append(query_live_analytics(conn.cursor(), date_from, date_to))
+        finally:
+            conn.close()
+
+    daily, pages, clicks = {}, {}, {}
+    for source in sources:
+        add_counts(daily, source['daily'])
+        add_counts(pages, source['pages'])
+        add_counts(clicks, source['clicks'])
+
+    by_type = {}
+    for (_, event_type), events in daily.items():
+        by_type[event_type] = by_type.get(event_type, 0) + events
+    top_pages = sorted(pages.items(), key=lambda item: item[1], reverse=True)[:limit]
+    top_clicks = sorted(clicks.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    return {
+        'from': date_from,
+        'to': date_to,
+        'archived_files': len(archives),
+        'total_events': sum(by_type.values()),
+        'events_by_type': by_type,
+        'daily_stats': [
+            {'date': day, 'event_type': event_type, 'events': events}
+            for (day, event_type), events in sorted(daily.items(), reverse=True)
+        ],
+        'top_pages': [{'url': url, 'visits': visits} for (url,), visits in top_pages],
+        'top_clicks': [{'id': element_id, 'text': text, 'clicks': count} for (element_id, text), count in top_clicks],
+    }
+
+# ============================================
+# SESIONES DE ANALYTICS
+# ============================================
+
+SESSIONS_CHECKPOINT_KEY = 'sessions_checkpoint'
+# Segundos mínimos entre corridas disparadas por el volcado de analytics
+SESSIONIZE_INTERVAL = float(os.getenv('SESSIONIZE_INTERVAL', '60'))
+# Eventos leídos por lote (cada lote se guarda junto con su checkpoint)
+SESSIONIZE_BATCH_SIZE = 5000
+# Columnas de sessions que se escriben en cada upsert
+SESSION_COLUMNS = (
+    'session_id', 'started_at', 'ended_at', 'duration_seconds', 'time_on_page', 'events', 'page_views',
+    'clicks', 'max_scroll', 'landing_page', 'referrer', 'utm_source', 'utm_medium', 'utm_campaign', 'country'
+)
+# Atribución: primer valor no vacío de la sesión
+SESSION_FIRST_TOUCH = ('referrer', 'utm_source', 'utm_medium', 'utm_campaign', 'country')
+# Segundos hasta que un id de analytics_facts se considera confirmado (PostgreSQL):
+# más que lo que dura la transacción de un volcado
+ANALYTICS_SETTLE_SECONDS = float(os.getenv('ANALYTICS_SETTLE_SECONDS', '30'))
+
+def read_checkpoint(cursor, key):
+    """Último id procesado por un trabajo incremental (app_meta)"""
+    cursor.execute(f'SELECT value FROM app_meta WHERE key = {sql_placeholder()}', (key,))
+    return int(cursor.fetchone()[0])
+
+def save_checkpoint(cursor, key, previous, value):
+    """
+    Avanzar el checkpoint solo si sigue en `previous` (misma transacción que
+    el lote). False si otro proceso ya lo movió: el lote se descarta.
+    """
+    ph = sql_placeholder()
+    cursor.execute(f'UPDATE app_meta SET value = {ph} WHERE key = {ph} AND value = {ph}',
+                   (str(value), key, str(previous)))
+    return cursor.rowcount == 1
+
+class SettledIdBound:
+    """
+    Tope seguro para los checkpoints por id de analytics_facts.
+    En PostgreSQL el id se toma de la secuencia al insertar pero las
+    transacciones confirman en cualquier orden: un id menor puede hacerse
+    visible después de que el checkpoint lo pasó y se perdería. Se anota el
+    id máximo visible y recién se usa como tope cuando pasaron
+    settle_seconds (para entonces todo volcado que tomó un id menor ya
+    confirmó). En SQLite las escrituras son de a una y el máximo ya es seguro.
+    """
+
+    def __init__(self, settle_seconds=ANALYTICS_SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        self.lock = threading.Lock()
+        self.observed = deque()  # [(monotonic, id máximo visible)]
+        self.settled = 0
+
+    def get(self, cursor, wait=False):
+        """Id hasta el que se puede procesar. wait: esperar a que asiente el máximo actual (CLI)"""
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM analytics_facts')
+        max_id = cursor.fetchone()[0]
+        if not is_postgresql_db():
+            return max_id
+        if wait:
+            time.sleep(self.settle_seconds)
+            return max_id
+
+        now = time.monotonic()
+        with self.lock:
+            self.observed.append((now, max_id))
+            while self.observed and now - self.observed[0][0] >= self.settle_seconds:
+                self.settled = max(self.settled, self.observed.popleft()[1])
+            return self.settled
+
+def parse_timestamp(value):
+    """TIMESTAMP de la base (datetime en PostgreSQL, texto en SQLite) -> datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+def event_metadata(value):
+    """metadata de un evento como dict (JSONB llega como dict, TEXT como string)"""
+    if isinstance(value, dict):
+        return value
+    try:
+        metadata = json.loads(value or '{}')
+    except (TypeError, ValueError):
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+def metadata_int(metadata, key):
+    """Entero de la metadata del cliente (0 si falta o no es numérico)"""
+    try:
+        return int(float(metadata.get(key) or 0))
+    except (TypeError, ValueError):
+        return 0
+
+class Sessionizer:
+    """
+    Arma la tabla sessions de forma incremental: lee los eventos con id
+    mayor al checkpoint (app_meta) y hasta el tope de SettledIdBound, los
+    agrupa por session_id y combina cada grupo con la fila ya guardada. El
+    lote y el nuevo checkpoint se guardan en la misma transacción; el
+    UPDATE del checkpoint exige el valor leído, así que si dos procesos
+    corren a la vez uno descarta su lote.
+    """
+
+    def __init__(self, interval=SESSIONIZE_INTERVAL, batch_size=SESSIONIZE_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.bound = SettledIdBound()
+        self.lock = threading.Lock()
+        self.last_run = 0.0
+        self.processed = 0
+        self.conflicts = 0
+
+    def maybe_run(self):
+        """Correr si pasó el intervalo (lo llama el volcado de analytics, nunca un request)"""
+        if time.monotonic() - self.last_run < self.interval:
+            return 0
+        try:
+            return self.run()
+        except Exception as e:
+            print(f"❌ Error armando sesiones: {e}")
+            return 0
+
+    def run(self, wait=False):
+        """Procesar todos los eventos ya confirmados. Devuelve cuántos procesó"""
+        if not self.lock.acquire(blocking=False):
+            return 0
+        try:
+            self.last_run = time.monotonic()
+            total = 0
+            conn = get_db_connection()
+            try:
+                bound = self.bound.get(conn.cursor(), wait)
+                while True:
+                    processed = self._run_batch(conn, bound)
+                    if not processed:
+                        break
+                    total += processed
+            finally:
+                conn.close()
+            self.processed += total
+            return total
+        finally:
+            self.lock.release()
+
+    def _run_batch(self, conn, bound):
+        ph = sql_placeholder()
+        cursor = conn.cursor()
+        checkpoint = read_checkpoint(cursor, SESSIONS_CHECKPOINT_KEY)
+        if checkpoint >= bound:
+            return 0
+
+        cursor.execute(f'''
+            SELECT id, event_type, page_url, referrer, utm_source, utm_medium, utm_campaign,
+                   country, session_id, timestamp, metadata
+            FROM analytics
+            WHERE id > {ph} AND id <= {ph}
+            ORDER BY id
+            LIMIT {int(self.batch_size)}
+        ''', (checkpoint, bound))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        batch = {}
+        for row in rows:
+            if row[8]:
+                self._add_event(batch, row)
+
+        if batch:
+            sessions = self._merge_stored(cursor, batch)
+            cursor.executemany(f'''
+                INSERT INTO sessions ({', '.join(SESSION_COLUMNS)})
+                VALUES ({', '.join([ph] * len(SESSION_COLUMNS))})
+                ON CONFLICT (session_id) DO UPDATE SET
+                {', '.join(f'{column} = EXCLUDED.{column}' for column in SESSION_COLUMNS[1:])}
+            ''', [self._row(session) for session in sessions])
+
+        if not save_checkpoint(cursor, SESSIONS_CHECKPOINT_KEY, checkpoint, rows[-1][0]):
+            # Otro proceso ya guardó este lote
+            conn.rollback()
+            self.conflicts += 1
+            return 0
+        conn.commit()
+        return len(rows)
+
+    def _add_event(self, batch, row):
+        """Sumar un evento a la sesión en armado"""
+        _, event_type, page_url, referrer, utm_source, utm_medium, utm_campaign, country, session_id, timestamp, metadata = row
+        timestamp = parse_timestamp(timestamp)
+        session = batch.get(session_id)
+        if session is None:
+            session = batch[session_id] = {
+                'session_id': session_id, 'started_at': timestamp, 'ended_at': timestamp,
+                'time_on_page': 0, 'events': 0, 'page_views': 0, 'clicks': 0, 'max_scroll': 0,
+                'landing_page': None, 'landing_at': None,
+                'referrer': None, 'utm_source': None, 'utm_medium': None, 'utm_campaign': None, 'country': None,
+            }
+
+        session['events'] += 1
+        session['started_at'] = min(session['started_at'], timestamp)
+        session['ended_at'] = max(session['ended_at'], timestamp)
+
+        metadata = event_metadata(metadata)
+        if event_type == 'page_view':
+            session['page_views'] += 1
+        elif event_type == 'click':
+            session['clicks'] += 1
+        elif event_type in SCROLL_EVENTS:
+            session['max_scroll'] = max(session['max_scroll'], min(metadata_int(metadata, 'scroll_percent'), 100))
+        elif event_type in ('time_on_page', 'page_exit'):
+            session['time_on_page'] = max(session['time_on_page'], metadata_int(metadata, 'time_seconds'))
+
+        # Landing: la primera página vista (o la del primer evento si no hubo page_view)
+        is_view = event_type == 'page_view'
+        if page_url and (session['landing_page'] is None or
+                         (is_view and (session['landing_at'] is None or timestamp < session['landing_at']))):
+            session['landing_page'] = page_url
+            session['landing_at'] = timestamp if is_view else None
+
+        values = {'referrer': referrer, 'utm_source': utm_source, 'utm_medium': utm_medium,
+                  'utm_campaign': utm_campaign, 'country': country}
+        for column in SESSION_FIRST_TOUCH:
+            if not session[column] and values[column]:
+                session[column] = values[column]
+
+    def _merge_stored(self, cursor, batch):
+        """Combinar las sesiones del lote con las filas ya guardadas"""
+        ph = sql_placeholder()
+        session_ids = list(batch)
+        stored = {}
+        for start in range(0, len(session_ids), ANALYTICS_DIMENSION_LOOKUP_BATCH):
+            chunk = session_ids[start:start + ANALYTICS_DIMENSION_LOOKUP_BATCH]
+            cursor.execute(
+                f"SELECT {', '.join(SESSION_COLUMNS)} FROM sessions WHERE session_id IN ({', '.join([ph] * len(chunk))})",
+                chunk
+            )
+            for row in cursor.fetchall():
+                stored[row[0]] = dict(zip(SESSION_COLUMNS, row))
+
+        for session_id, session in batch.items():
+            previous = stored.get(session_id)
+            if previous is None:
+                continue
+            previous_start = parse_timestamp(previous['started_at'])
+            # Los eventos nuevos pueden ser anteriores (volcados de otro worker)
+            if previous['landing_page'] and not (session['landing_at'] and session['landing_at'] < previous_start):
+                session['landing_page'] = previous['landing_page']
+            for column in SESSION_FIRST_TOUCH:
+                if previous[column] and (session['started_at'] >= previous_start or not session[column]):
+                    session[column] = previous[column]
+            session['started_at'] = min(session['started_at'], previous_start)
+            session['ended_at'] = max(session['ended_at'], parse_timestamp(previous['ended_at']))
+            for column in ('events', 'page_views', 'clicks'):
+                session[column] += previous[column] or 0
+            for column in ('time_on_page', 'max_scroll'):
+                session[column] = max(session[column], previous[column] or 0)
+        return batch.values()
+
+    def _row(self, session):
+        """Sesión -> fila de SESSION_COLUMNS (timestamps en el formato de CURRENT_TIMESTAMP)"""
+        session['duration_seconds'] = int((session['ended_at'] - session['started_at']).total_seconds())
+        values = dict(session)
+        for column in ('started_at', 'ended_at'):
+            values[column] = session[column].strftime('%Y-%m-%d %H:%M:%S')
+        return tuple(values[column] for column in SESSION_COLUMNS)
+
+    def stats(self):
+        return {'eventos_procesados': self.processed, 'conflictos': self.conflicts}
+
+sessionizer = Sessionizer()
+
+def query_sessions(date_from, date_to, utm_source=None, landing_page=None, limit=10):
+    """Métricas de sesiones iniciadas en [date_from, date_to), opcionalmente por fuente o landing"""
+    ph = sql_placeholder()
+    conditions = [f'started_at >= {ph}', f'started_at < {ph}']
+    params = [date_from, date_to]
+    if utm_source is not None:
+        conditions.append(f'utm_source = {ph}')
+        params.append(utm_source)
+    if landing_page is not None:
+        conditions.append(f'landing_page = {ph}')
+        params.append(landing_page)
+    where = ' AND '.join(conditions)
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT COUNT(*), AVG(duration_seconds), AVG(time_on_page), AVG(page_views), AVG(max_scroll),
+                   COUNT(CASE WHEN page_views <= 1 AND clicks = 0 AND max_scroll < 25 THEN 1 END),
+                   COUNT(CASE WHEN clicks > 0 THEN 1 END)
+            FROM sessions WHERE {where}
+        ''', params)
+        total, duration, time_on_page, page_views, max_scroll, bounces, clicked = cursor.fetchone()
+
+        breakdowns = {}
+        for name, column in (('by_source', 'utm_source'), ('by_landing', 'landing_page')):
+            cursor.execute(f'''
+                SELECT COALESCE({column}, ''), COUNT(*), AVG(time_on_page), AVG(max_scroll),
+                       COUNT(CASE WHEN clicks > 0 THEN 1 END)
+                FROM sessions WHERE {where}
+                GROUP BY COALESCE({column}, '')
+                ORDER BY COUNT(*) DESC
+                LIMIT {int(limit)}
+            ''', params)
+            breakdowns[name] = [
+                {'value': row[0], 'sessions': row[1], 'avg_time_on_page': round(float(row[2] or 0), 1),
+                 'avg_max_scroll': round(float(row[3] or 0), 1), 'click_rate': round(row[4] / row[1], 4)}
+                for row in cursor.fetchall()
+            ]
+    finally:
+        conn.close()
+
+    return {
+        'from': date_from,
+        'to': date_to,
+        'sessions': total,
+        'avg_duration_seconds': round(float(duration or 0), 1),
+        'avg_time_on_page': round(float(time_on_page or 0), 1),
+        'avg_page_views': round(float(page_views or 0), 2),
+        'avg_max_scroll': round(float(max_scroll or 0), 1),
+        'bounce_rate': round(bounces / total, 4) if total else 0.0,
+        'click_rate': round(clicked / total, 4) if total else 0.0,
+        **breakdowns
+    }
+
+# ============================================
+# EMBUDO DE CONVERSIÓN Y ATRIBUCIÓN
+# ============================================
+
+FUNNEL_EVENTS_CHECKPOINT_KEY = 'funnel_events_checkpoint'
+# Ids de analytics_facts recorridos por lote (rango de la PK)
+FUNNEL_EVENTS_BATCH_SIZE = 20000
+FUNNEL_SALES_BATCH_SIZE = 500
+# Segundos que una venta con sck espera a que su clic de /go/<slug> llegue al embudo
+# (volcado + ANALYTICS_SETTLE_SECONDS + SESSIONIZE_INTERVAL); después se atribuye solo por src
+FUNNEL_CLICK_WAIT_SECONDS = float(os.getenv('FUNNEL_CLICK_WAIT_SECONDS', '900'))
+# Eventos que suman al embudo (los demás solo avanzan el checkpoint)
+FUNNEL_EVENT_TYPES = ('page_view', 'click', 'outbound_click')
+# Clics directos al checkout (los de /go/<slug> ya cuentan como outbound_click)
+CHECKOUT_HOSTS = ('go.hotmart.com', 'pay.hotmart.com')
+FUNNEL_DIMENSIONS = ('utm_source', 'utm_medium', 'utm_campaign', 'src')
+FUNNEL_COUNTERS = ('page_views', 'cta_clicks', 'purchases', 'revenue')
+
+def is_checkout_click(event_type, metadata):
+    """True si el evento es un clic hacia el checkout (paso 2 del embudo)"""
+    if event_type == 'outbound_click':
+        return True
+    if event_type != 'click':
+        return False
+    return urlparse(str(metadata.get('href') or '')).hostname in CHECKOUT_HOSTS
+
+def hotmart_origin(data):
+    """src y sck con los que llegó la compra (Hotmart los devuelve en purchase.origin)"""
+    if not isinstance(data, dict):
+        data = event_metadata(data)
+    origin = (data.get('data', {}).get('purchase') or {}).get('origin') or {}
+    return origin.get('src') or '', origin.get('sck') or ''
+
+class FunnelBuilder:
+    """
+    Mantiene funnel_daily a partir de analytics y hotmart_events sin joins
+    sobre las tablas crudas y suma contadores por lote por
+    (día, utm_source, utm_medium, utm_campaign, src). Los eventos avanzan
+    con un checkpoint (mismo esquema que Sessionizer); las ventas, con la
+    columna processed de hotmart_events, porque un reenvío de Hotmart
+    actualiza la fila existente (mismo id) en vez de insertar otra.
+
+    Todo se atribuye al primer contacto de la visita: un evento con sesión
+    toma los UTM de sessions y el src de su landing, no los del botón (los
+    CTA del sitio llevan UTM fijos). Por eso los eventos no pasan del
+    checkpoint de Sessionizer. Sin sesión (links de Telegram o emails) se
+    usan los UTM y el src del propio evento.
+
+    Las compras se atribuyen por el src/sck que Hotmart devuelve: /go/<slug>
+    agrega un sck por clic y el embudo guarda a qué dimensiones corresponde
+    en attribution_clicks.
+    """
+
+    def __init__(self, interval=SESSIONIZE_INTERVAL):
+        self.interval = interval
+        self.bound = SettledIdBound()
+        self.lock = threading.Lock()
+        self.last_run = 0.0
+        self.events = 0
+        self.sales = 0
+        self.conflicts = 0
+
+    def maybe_run(self):
+        """Correr si pasó el intervalo (lo llama el volcado de analytics, nunca un request)"""
+        if time.monotonic() - self.last_run < self.interval:
+            return 0
+        try:
+            return self.run()
+        except Exception as e:
+            print(f"❌ Error actualizando el embudo: {e}")
+            return 0
+
+    def run(self, wait=False):
+        """Procesar eventos y ventas pendientes (primero eventos: alimentan attribution_clicks)"""
+        if not self.lock.acquire(blocking=False):
+            return 0
+        try:
+            self.last_run = time.monotonic()
+            total = 0
+            conn = get_db_connection()
+            try:
+                bound = self.bound.get(conn.cursor(), wait)
+                while True:
+                    processed = self._events_batch(conn, bound)
+                    if not processed:
+                        break
+                    total += processed
+                while True:
+                    processed = self._sales_batch(conn)
+                    if not processed:
+                        break
+                    total += processed
+            finally:
+                conn.close()
+            return total
+        finally:
+            self.lock.release()
+
+    def _events_batch(self, conn, bound):
+        ph = sql_placeholder()
+        cursor = conn.cursor()
+        checkpoint = read_checkpoint(cursor, FUNNEL_EVENTS_CHECKPOINT_KEY)
+        # Solo eventos ya volcados a sessions (de ahí sale el primer contacto)
+        bound = min(bound, read_checkpoint(cursor, SESSIONS_CHECKPOINT_KEY))
+        if bound <= checkpoint:
+            return 0
+        upper = min(checkpoint + FUNNEL_EVENTS_BATCH_SIZE, bound)
+
+        cursor.execute(f'''
+            SELECT event_type, utm_source, utm_medium, utm_campaign, session_id, timestamp, metadata
+            FROM analytics
+            WHERE id > {ph} AND id <= {ph} AND event_type IN ({', '.join([ph] * len(FUNNEL_EVENT_TYPES))})
+        ''', (checkpoint, upper, *FUNNEL_EVENT_TYPES))
+        rows = cursor.fetchall()
+        first_touch = self._first_touch(cursor, {row[4] for row in rows if row[4]})
+
+        counters = {}
+        clicks = {}
+        for event_type, utm_source, utm_medium, utm_campaign, session_id, timestamp, metadata in rows:
+            metadata = event_metadata(metadata)
+            dimensions = first_touch.get(session_id) or (
+                utm_source or '', utm_medium or '', utm_campaign or '', str(metadata.get('src') or ''))
+            timestamp = parse_timestamp(timestamp)
+            key = (timestamp.strftime('%Y-%m-%d'), *dimensions)
+            if event_type == 'page_view':
+                self._add(counters, key, page_views=1)
+            elif is_checkout_click(event_type, metadata):
+                self._add(counters, key, cta_clicks=1)
+            if event_type == 'outbound_click' and metadata.get('sck'):
+                ref = (str(metadata.get('src') or ''), str(metadata['sck']))
+                clicks[ref] = ref + dimensions + (timestamp.strftime('%Y-%m-%d %H:%M:%S'),)
+
+        self._save_counters(cursor, counters)
+        if clicks:
+            columns = ('hotmart_src', 'sck') + FUNNEL_DIMENSIONS + ('last_seen',)
+            cursor.executemany(f'''
+                INSERT INTO attribution_clicks ({', '.join(columns)})
+                VALUES ({', '.join([ph] * len(columns))})
+                ON CONFLICT (hotmart_src, sck) DO UPDATE SET
+                {', '.join(f'{column} = EXCLUDED.{column}' for column in columns[2:])}
+            ''', list(clicks.values()))
+
+        if not save_checkpoint(cursor, FUNNEL_EVENTS_CHECKPOINT_KEY, checkpoint, upper):
+            conn.rollback()
+            self.conflicts += 1
+            return 0
+        conn.commit()
+        self.events += upper - checkpoint
+        return upper - checkpoint
+
+    def _first_touch(self, cursor, session_ids):
+        """session_id -> (utm_source, utm_medium, utm_campaign, src de la landing) según sessions"""
+        ph = sql_placeholder()
+        session_ids = list(session_ids)
+        first_touch = {}
+        for start in range(0, len(session_ids), ANALYTICS_DIMENSION_LOOKUP_BATCH):
+            chunk = session_ids[start:start + ANALYTICS_DIMENSION_LOOKUP_BATCH]
+            cursor.execute(f'''
+                SELECT session_id, utm_source, utm_medium, utm_campaign, landing_page
+                FROM sessions WHERE session_id IN ({', '.join([ph] * len(chunk))})
+            ''', chunk)
+            for session_id, utm_source, utm_medium, utm_campaign, landing_page in cursor.fetchall():
+                first_touch[session_id] = (utm_source or '', utm_medium or '', utm_campaign or '',
+                                           url_attribution(landing_page)['src'])
+        return first_touch
+
+    def _sales_batch(self, conn):
+        ph = sql_placeholder()
+        cursor = conn.cursor()
+        # data como texto: se compara al marcar la fila (un reenvío puede pisarla mientras tanto)
+        data_text = 'data::text' if is_postgresql_db() else 'data'
+        cursor.execute(f'''
+            SELECT id, transaction_id, created_at, {data_text}
+            FROM hotmart_events
+            WHERE processed = FALSE
+            ORDER BY id
+            LIMIT {FUNNEL_SALES_BATCH_SIZE}
+        ''')
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        counters = {}
+        deferred = set()
+        now = datetime.utcnow()
+        for event_id, transaction_id, created_at, raw in rows:
+            # Evento y precio del último payload: en PostgreSQL el reenvío solo actualiza data
+            data = event_metadata(raw)
+            if data.get('event') != 'PURCHASE_COMPLETE' or not transaction_id:
+                continue
+            src, sck = hotmart_origin(data)
+            # Clic de /go/<slug> que originó la compra; si no está, el src con que llegó
+            dimensions = ('', '', '', src or sck)
+            if src or sck:
+                cursor.execute(f'''
+                    SELECT {', '.join(FUNNEL_DIMENSIONS)} FROM attribution_clicks
+                    WHERE hotmart_src = {ph} AND sck = {ph}
+                ''', (src, sck))
+                click = cursor.fetchone()
+                if click:
+                    dimensions = tuple(click)
+                elif sck and (now - parse_timestamp(created_at).replace(tzinfo=None)).total_seconds() < FUNNEL_CLICK_WAIT_SECONDS:
+                    # El clic todavía no pasó por el embudo: la venta queda pendiente
+                    deferred.add(event_id)
+                    continue
+            day = parse_timestamp(created_at).strftime('%Y-%m-%d')
+            try:
+                revenue = float((data.get('data', {}).get('product') or {}).get('price') or 0)
+            except (TypeError, ValueError):
+                revenue = 0.0
+
+            # Reenvíos de Hotmart (SQLite los reinserta con otro id): una sola vez por transacción
+            cursor.execute(f'''
+                INSERT INTO attributed_sales (transaction_id, day, utm_source, utm_medium, utm_campaign, src, revenue)
+                VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+                ON CONFLICT (transaction_id) DO NOTHING
+            ''', (transaction_id, day, *dimensions, revenue))
+            if cursor.rowcount == 1:
+                self._add(counters, (day, *dimensions), purchases=1, revenue=revenue)
+
+        self._save_counters(cursor, counters)
+        # Solo si data no cambió: si llegó un reenvío, la fila queda pendiente para el próximo lote
+        marked = 0
+        for event_id, _, _, raw in rows:
+            if event_id in deferred:
+                continue
+            cursor.execute(f'UPDATE hotmart_events SET processed = TRUE WHERE id = {ph} AND {data_text} = {ph}',
+                           (event_id, raw))
+            marked += cursor.rowcount
+        conn.commit()
+        self.sales += marked
+        return marked
+
+    def _add(self, counters, key, **increments):
+        totals = counters.setdefault(key, dict.fromkeys(FUNNEL_COUNTERS, 0))
+        for name, value in increments.items():
+            totals[name] += value
+
+    def _save_counters(self, cursor, counters):
+        """Sumar los contadores del lote a funnel_daily"""
+        if not counters:
+            return
+        ph = sql_placeholder()
+        columns = ('day',) + FUNNEL_DIMENSIONS + FUNNEL_COUNTERS
+        cursor.executemany(f'''
+            INSERT INTO funnel_daily ({', '.join(columns)})
+            VALUES ({', '.join([ph] * len(columns))})
+            ON CONFLICT (day, {', '.join(FUNNEL_DIMENSIONS)}) DO UPDATE SET
+            {', '.join(f'{name} = funnel_daily.{name} + EXCLUDED.{name}' for name in FUNNEL_COUNTERS)}
+        ''', [key + tuple(totals[name] for name in FUNNEL_COUNTERS) for key, totals in counters.items()])
+
+    def stats(self):
+        return {'eventos_procesados': self.events, 'ventas_procesadas': self.sales, 'conflictos': self.conflicts}
+
+funnel_builder = FunnelBuilder()
+
+def query_funnel(date_from, date_to, group_by=FUNNEL_DIMENSIONS, filters=None, limit=50):
+    """Embudo y ingresos de [date_from, date_to) agrupados por las dimensiones pedidas"""
+    ph = sql_placeholder()
+    conditions = [f'day >= {ph}', f'day < {ph}']
+    params = [date_from, date_to]
+    for column, value in (filters or {}).items():
+        conditions.append(f'{column} = {ph}')
+        params.append(value)
+    where = ' AND '.join(conditions)
+    sums = ', '.join(f'SUM({name})' for name in FUNNEL_COUNTERS)
+
+    def funnel_row(values):
+        page_views, cta_clicks, purchases, revenue = (values[0] or 0, values[1] or 0, values[2] or 0, float(values[3] or 0))
+        return {
+            'page_views': page_views,
+            'cta_clicks': cta_clicks,
+            'purchases': purchases,
+            'revenue': round(revenue, 2),
+            'click_rate': round(cta_clicks / page_views, 4) if page_views else None,
+            'conversion_rate': round(purchases / cta_clicks, 4) if cta_clicks else None,
+            'revenue_per_click': round(revenue / cta_clicks, 2) if cta_clicks else None,
+        }
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {sums} FROM funnel_daily WHERE {where}', params)
+        totals = funnel_row(cursor.fetchone())
+
+        rows = []
+        if group_by:
+            columns = ', '.join(group_by)
+            cursor.execute(f'''
+                SELECT {columns}, {sums}
+                FROM funnel_daily WHERE {where}
+                GROUP BY {columns}
+                ORDER BY SUM(revenue) DESC, SUM(cta_clicks) DESC, SUM(page_views) DESC
+                LIMIT {int(limit)}
+            ''', params)
+            rows = [
+                {**dict(zip(group_by, row[:len(group_by)])), **funnel_row(row[len(group_by):])}
+                for row in cursor.fetchall()
+            ]
+    finally:
+        conn.close()
+
+    return {'from': date_from, 'to': date_to, 'group_by': list(group_by), 'totals': totals, 'rows': rows}
+
+# ============================================
+# MÉTRICAS DE ENGAGEMENT (NUMPY)
+# ============================================
+
+try:
+    import numpy
+except ImportError:  # Las métricas de engagement son opcionales: sin numpy el endpoint responde error
+    numpy = None
+
+# Filas por fetchmany al cargar un rango (cursor del lado del servidor en PostgreSQL)
+ENGAGEMENT_CHUNK_SIZE = 100000
+# Rangos calculados en memoria por proceso
+ENGAGEMENT_CACHE_SIZE = 64
+# Segundos de validez de un rango que incluye hoy (los días cerrados no cambian)
+ENGAGEMENT_CACHE_TTL = 300
+ENGAGEMENT_PERCENTILES = (50, 90, 99)
+SCROLL_HISTOGRAM_BINS = tuple(range(0, 101, 10))
+SCROLL_THRESHOLDS = (25, 50, 75, 90)
+TIME_EVENTS = ('time_on_page', 'page_exit')
+# Filas de la consulta convertidas de a chunk en un solo paso (session_id queda como objeto)
+ENGAGEMENT_ROW_DTYPE = [('page', 'i8'), ('session', 'O'), ('scroll', '?'), ('value', 'f8')]
+# Multiplicador impar de 64 bits para mezclar página y sesión en la clave de visita
+VISIT_KEY_MIX = 0x9E3779B97F4A7C15
+
+def engagement_number_sql(key):
+    """Valor numérico de metadata extraído por la base (no se parsea JSON en Python)"""
+    if is_postgresql_db():
+        return f"CASE WHEN jsonb_typeof(metadata->'{key}') = 'number' THEN (metadata->>'{key}')::float END"
+    return f"CASE WHEN json_type(metadata, '$.{key}') IN ('integer', 'real') THEN json_extract(metadata, '$.{key}') END"
+
+def load_engagement_chunks(cursor, date_from, date_to, chunk_size=ENGAGEMENT_CHUNK_SIZE):
+    """Filas (page_url_key, session_id, es_scroll, valor) de [date_from, date_to), de a chunk_size (valor -1 si falta)"""
+    ph = sql_placeholder()
+    scroll_types = ', '.join(f"'{event_type}'" for event_type in sorted(SCROLL_EVENTS))
+    event_types = ', '.join([ph] * (len(SCROLL_EVENTS) + len(TIME_EVENTS)))
+    cursor.execute(f'''
+        SELECT COALESCE(page_url_key, -1), session_id,
+               CASE WHEN event_type IN ({scroll_types}) THEN 1 ELSE 0 END,
+               COALESCE(CASE WHEN event_type IN ({scroll_types}) THEN {engagement_number_sql('scroll_percent')}
+                             ELSE {engagement_number_sql('time_seconds')} END, -1)
+        FROM analytics_facts
+        WHERE timestamp >= {ph} AND timestamp < {ph}
+          AND event_type IN ({event_types}) AND session_id IS NOT NULL
+    ''', (date_from, date_to, *sorted(SCROLL_EVENTS), *TIME_EVENTS))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+def engagement_arrays(chunks):
+    """
+    Chunks de filas -> columnas NumPy (páginas, sesiones, es_scroll, valores).
+    Las sesiones se guardan como hash de 64 bits: agrupar por enteros evita
+    ordenar strings (una colisión entre millones de sesiones es despreciable).
+    """
+    blocks = [numpy.array(rows, dtype=ENGAGEMENT_ROW_DTYPE) for rows in chunks]
+    if not blocks:
+        return (numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64),
+                numpy.empty(0, dtype=bool), numpy.empty(0, dtype=numpy.float64))
+    block = numpy.concatenate(blocks)
+    sessions = numpy.fromiter(map(hash, block['session']), dtype=numpy.int64, count=len(block))
+    return block['page'], sessions, block['scroll'], block['value']
+
+def per_visit_max(pages, sessions, values):
+    """
+    Máximo por visita (sesión + página): time_on_page y scroll llegan como
+    eventos periódicos y cuenta el último/más profundo. Ordena por clave y
+    reduce por segmentos, sin loops de Python.
+    """
+    if not len(values):
+        return pages, values
+    keys = sessions.view(numpy.uint64) ^ (pages.astype(numpy.uint64) * numpy.uint64(VISIT_KEY_MIX))
+    order = numpy.argsort(keys)
+    keys = keys[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    return pages[order][starts], numpy.maximum.reduceat(values[order], starts)
+
+def distribution(values):
+    """Cantidad, promedio y percentiles de una serie"""
+    if not len(values):
+        return {'visits': 0, 'mean': None, **{f'p{pct}': None for pct in ENGAGEMENT_PERCENTILES}}
+    percentiles = numpy.percentile(values, ENGAGEMENT_PERCENTILES)
+    return {
+        'visits': int(len(values)),
+        'mean': round(float(values.mean()), 1),
+        **{f'p{pct}': round(float(value), 1) for pct, value in zip(ENGAGEMENT_PERCENTILES, percentiles)}
+    }
+
+def compute_engagement(arrays, page_limit=10):
+    """Distribuciones de tiempo en página y profundidad de scroll, generales y por página"""
+    pages, sessions, is_scroll, values = arrays
+    valid = values >= 0
+
+    time_mask = valid & ~is_scroll
+    scroll_mask = valid & is_scroll
+    time_pages, time_values = per_visit_max(pages[time_mask], sessions[time_mask], values[time_mask])
+    scroll_pages, scroll_values = per_visit_max(pages[scroll_mask], sessions[scroll_mask], values[scroll_mask])
+    scroll_values = numpy.clip(scroll_values, 0, 100)
+
+    histogram, edges = numpy.histogram(scroll_values, bins=SCROLL_HISTOGRAM_BINS)
+    scroll = {
+        'visits': int(len(scroll_values)),
+        'mean': round(float(scroll_values.mean()), 1) if len(scroll_values) else None,
+        'histogram': [
+            {'from': int(low), 'to': int(high), 'visits': int(count)}
+            for low, high, count in zip(edges[:-1], edges[1:], histogram)
+        ],
+        'reached': {
+            str(threshold): round(float((scroll_values >= threshold).mean()), 4) if len(scroll_values) else None
+            for threshold in SCROLL_THRESHOLDS
+        }
+    }
+
+    # Comparación por página: las de más visitas con tiempo medido
+    page_ids, visits = numpy.unique(numpy.concatenate((time_pages, scroll_pages)), return_counts=True)
+    top_pages = page_ids[numpy.argsort(-visits, kind='stable')][:page_limit]
+    per_page = []
+    for page in top_pages:
+        page_scroll = scroll_values[scroll_pages == page]
+        per_page.append({
+            'page_key': int(page),
+            'time_on_page': distribution(time_values[time_pages == page]),
+            'scroll_mean': round(float(page_scroll.mean()), 1) if len(page_scroll) else None,
+            'scroll_reached_75': round(float((page_scroll >= 75).mean()), 4) if len(page_scroll) else None,
+        })
+
+    return {
+        'events': int(len(values)),
+        'time_on_page': distribution(time_values),
+        'scroll_depth': scroll,
+        'pages': per_page
+    }
+
+class EngagementCache:
+    """Resultados por (rango, páginas) en memoria (LRU); los rangos abiertos vencen a los ENGAGEMENT_CACHE_TTL segundos"""
+
+    def __init__(self, max_entries=ENGAGEMENT_CACHE_SIZE, ttl=ENGAGEMENT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or time.monotonic() < entry[0]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, closed):
+        with self.lock:
+            self.entries[key] = (None if closed else time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'rangos': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+engagement_cache = EngagementCache()
+
+def engagement_metrics(date_from, date_to, page_limit=10):
+    """
+    Métricas de engagement de [date_from, date_to) (fechas 'YYYY-MM-DD') sobre
+    analytics_facts, cacheadas por rango. Lo archivado en Parquet no se incluye.
+    """
+    if numpy is None:
+        raise RuntimeError('numpy no está instalado')
+
+    key = (date_from, date_to, page_limit)
+    cached = engagement_cache.get(key)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        # PostgreSQL: cursor con nombre para traer los chunks del servidor de a uno
+        cursor = conn.cursor(name='engagement') if is_postgresql_db() else conn.cursor()
+        arrays = engagement_arrays(load_engagement_chunks(cursor, date_from, date_to))
+        loaded = time.perf_counter()
+        result = compute_engagement(arrays, page_limit)
+
+        page_keys = [page['page_key'] for page in result['pages'] if page['page_key'] >= 0]
+        urls = {}
+        if page_keys:
+            ph = sql_placeholder()
+            lookup = conn.cursor()
+            lookup.execute(f"SELECT id, value FROM analytics_dimensions WHERE id IN ({', '.join([ph] * len(page_keys))})", page_keys)
+            urls = dict(lookup.fetchall())
+    finally:
+        conn.close()
+
+    for page in result['pages']:
+        page['url'] = urls.get(page.pop('page_key'))
+    result.update({
+        'from': date_from,
+        'to': date_to,
+        'load_ms': round((loaded - started) * 1000, 1),
+        'compute_ms': round((time.perf_counter() - loaded) * 1000, 1)
+    })
+
+    closed = date_to <= datetime.utcnow().strftime('%Y-%m-%d')
+    engagement_cache.put(key, result, closed)
+    return result
+
+# ============================================
+# PODA DE SUSCRIPCIONES PUSH
+# ============================================
+
+# Días sin uso ni entrega exitosa para considerar una suscripción vencida
+PUSH_PRUNE_IDLE_DAYS = int(os.getenv('PUSH_PRUNE_IDLE_DAYS', '90'))
+# Fallos de entrega consecutivos antes de eliminar la suscripción
+PUSH_PRUNE_MAX_FAILURES = int(os.getenv('PUSH_PRUNE_MAX_FAILURES', '3'))
+PUSH_PRUNE_BATCH_SIZE = int(os.getenv('PUSH_PRUNE_BATCH_SIZE', '500'))
+
+ACTIVE_SUBS_FILTER = "COALESCE(status, 'active') = 'active'"
+
+def get_active_subscriptions():
+    """Suscripciones vivas (las únicas que deben recibir campañas; ver server/push_test.py)"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT id, endpoint, p256dh, auth
+            FROM push_subs
+            WHERE {ACTIVE_SUBS_FILTER}
+        ''')
+        return [
+            {'id': row[0], 'endpoint': row[1], 'keys': {'p256dh': row[2], 'auth': row[3]}}
+            for row in cursor.fetchall()
+        ]
+    finally:
+        conn.close()
+
+def record_push_results(cursor, delivered_ids, failed_ids):
+    """
+    Actualizar historial de entrega de un lote de suscripciones.
+    failed_ids: solo rechazos definitivos del push service (4xx salvo 429);
+    429 y 5xx son transitorios y no deben sumar al límite de fallos.
+    """
+    ph = sql_placeholder()
+    if delivered_ids:
+        cursor.executemany(f'''
+            UPDATE push_subs
+            SET last_used = CURRENT_TIMESTAMP, last_success = CURRENT_TIMESTAMP,
+                failure_count = 0, status = 'active'
+            WHERE id = {ph}
+        ''', [(sub_id,) for sub_id in delivered_ids])
+    if failed_ids:
+        cursor.executemany(f'''
+            UPDATE push_subs
+            SET failure_count = COALESCE(failure_count, 0) + 1
+            WHERE id = {ph}
+        ''', [(sub_id,) for sub_id in failed_ids])
+
+def delete_subscriptions(cursor, sub_ids):
+    """Eliminar suscripciones por id (un DELETE por lote)"""
+    if not sub_ids:
+        return 0
+    ph = sql_placeholder()
+    marks = ', '.join([ph] * len(sub_ids))
+    cursor.execute(f'DELETE FROM push_subs WHERE id IN ({marks})', list(sub_ids))
+    return len(sub_ids)
+
+def prune_stale_subscriptions(idle_days=PUSH_PRUNE_IDLE_DAYS, max_failures=PUSH_PRUNE_MAX_FAILURES,
+                              batch_size=PUSH_PRUNE_BATCH_SIZE):
+    """
+    Reducir el conjunto de suscripciones activas antes de las campañas.
+    No se sondea con pushes: sw.js muestra una notificación por cada push
+    (los navegadores lo exigen), así que solo se usa el historial guardado.
+
+    1. elimina las que acumulan max_failures fallos definitivos
+    2. marca como 'stale' las que no se usan ni reciben entregas hace idle_days
+       (quedan fuera del fan-out y se reactivan si el navegador se resuscribe)
+
+    Returns:
+        dict: reporte con el tamaño del conjunto activo antes y después
+    """
+    ph = sql_placeholder()
+    cutoff = datetime.utcnow() - timedelta(days=idle_days)
+    cutoff_param = cutoff if is_postgresql_db() else cutoff.strftime('%Y-%m-%d %H:%M:%S')
+    idle_filter = f'''
+        {ACTIVE_SUBS_FILTER}
+        AND last_used < {ph}
+        AND (last_success IS NULL OR last_success < {ph})
+    '''
+
+    report = {'removed': 0, 'marked_stale': 0}
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT COUNT(*) FROM push_subs WHERE {ACTIVE_SUBS_FILTER}')
+        report['active_before'] = cursor.fetchone()[0]
+
+        # 1. Eliminar las que acumulan demasiados fallos
+        while True:
+            cursor.execute(f'''
+                SELECT id FROM push_subs
+                WHERE COALESCE(failure_count, 0) >= {ph}
+                LIMIT {int(batch_size)}
+            ''', (max_failures,))
+            sub_ids = [row[0] for row in cursor.fetchall()]
+            if not sub_ids:
+                break
+            report['removed'] += delete_subscriptions(cursor, sub_ids)
+            conn.commit()
+
+        # 2. Envejecer las inactivas
+        while True:
+            cursor.execute(f'''
+                SELECT id FROM push_subs
+                WHERE {idle_filter}
+                LIMIT {int(batch_size)}
+            ''', (cutoff_param, cutoff_param))
+            sub_ids = [row[0] for row in cursor.fetchall()]
+            if not sub_ids:
+                break
+            marks = ', '.join([ph] * len(sub_ids))
+            cursor.execute(f"UPDATE push_subs SET status = 'stale' WHERE id IN ({marks})", sub_ids)
+            report['marked_stale'] += len(sub_ids)
+            conn.commit()
+
+        cursor.execute(f'SELECT COUNT(*) FROM push_subs WHERE {ACTIVE_SUBS_FILTER}')
+        report['active_after'] = cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+    before = report['active_before']
+    report['shrink_pct'] = round(100 * (before - report['active_after']) / before, 2) if before else 0.0
+    return report
+
+# ============================================
+# CATÁLOGO DE PRODUCTOS
+# ============================================
+
+# Segundos entre relecturas de la tabla products (0 = en cada request)
+CATALOG_REFRESH_INTERVAL = float(os.getenv('CATALOG_REFRESH_INTERVAL', 30))
+
+def slugify(text):
+    """'Enciclopedia de Plantas' -> 'enciclopedia-de-plantas'"""
+    normalized = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', '-', normalized.lower()).strip('-')
+
+class ProductCatalog:
+    """
+    Snapshot en memoria de la tabla products.
+    Cada producto lleva un `version` (hash de su fila) y el catálogo uno global:
+    los requests leen el snapshot sin consultar la base, que se relee como
+    mucho cada refresh_interval segundos. Los fragmentos HTML se cachean por
+    (slug, version), así que solo se re-renderiza lo que cambió; el dict de
+    fragmentos solo se modifica con fragments_lock tomado.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.snapshot = {'version': None, 'loaded_at': None, 'products': [], 'by_slug': {}}
+        self.loaded_at = None
+        self.fragments = {}
+        self.lock = threading.Lock()
+        # Aparte de self.lock: un request no espera a que termine una relectura
+        self.fragments_lock = threading.Lock()
+
+    def get(self):
+        """Snapshot vigente (recargado si venció)"""
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.refresh_interval:
+            return self.snapshot
+
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= self.refresh_interval:
+                try:
+                    self._reload()
+                except Exception as e:
+                    # Con la base caída se sigue sirviendo el último snapshot
+                    print(f"❌ Error cargando catálogo: {e}")
+                    if self.loaded_at is None:
+                        raise
+                self.loaded_at = time.monotonic()
+        return self.snapshot
+
+    def refresh(self):
+        """Releer la tabla ya, fuera del camino de los requests (modo ASGI)"""
+        with self.lock:
+            self._reload()
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Forzar relectura en el próximo get()"""
+        self.loaded_at = None
+
+    def product(self, slug):
+        """Producto activo por slug (o None)"""
+        return self.get()['by_slug'].get(slug)
+
+    def _reload(self):
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, slug, name, description, price, currency, hotmart_link, category
+                FROM products
+                WHERE COALESCE(status, 'active') = 'active'
+                ORDER BY id
+            ''')
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        products = []
+        by_slug = {}
+        for product_id, slug, name, description, price, currency, hotmart_link, category in rows:
+            product = {
+                'id': product_id,
+                'slug': slug or slugify(name),
+                'name': name,
+                'description': description or '',
+                'price': float(price) if price is not None else None,
+                'currency': currency or 'USD',
+                'hotmart_link': hotmart_link or '',
+                'category': category or ''
+            }
+            # Filas repetidas (mismo slug): gana la más vieja
+            if product['slug'] in by_slug:
+                continue
+            product['version'] = hashlib.sha256(json.dumps(product, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+            products.append(product)
+            by_slug[product['slug']] = product
+
+        version = hashlib.sha256(''.join(p['version'] for p in products).encode('utf-8')).hexdigest()[:12]
+        if version == self.snapshot['version']:
+            return
+
+        self.snapshot = {
+            'version': version,
+            'loaded_at': datetime.now().isoformat(),
+            'products': products,
+            'by_slug': by_slug
+        }
+        # Fragmentos de versiones que ya no existen
+        current = {(p['slug'], p['version']) for p in products}
+        with self.fragments_lock:
+            self.fragments = {key: html for key, html in self.fragments.items() if key in current}
+        print(f"🛍️  Catálogo cargado: {len(products)} productos (versión {version})")
+
+    def fragment(self, product):
+        """HTML de la tarjeta del producto, cacheado por versión"""
+        key = (product['slug'], product['version'])
+        html = self.fragments.get(key)
+        if html is None:
+            html = render_product_fragment(product)
+            with self.fragments_lock:
+                # Un snapshot más nuevo ya podó esta versión: no se vuelve a cachear
+                current = self.snapshot['by_slug'].get(product['slug'])
+                if current is not None and current['version'] == product['version']:
+                    self.fragments[key] = html
+        return html
+
+def render_product_fragment(product):
+    """Tarjeta HTML de un producto (para incrustar en páginas)"""
+    price = f"{product['currency']} {product['price']:.2f}" if product['price'] is not None else ''
+    link = tracked_link(product['slug'], 'web', 'fragmento', 'catalogo')
+    return (
+        f'<article class="product-card" data-product="{html_escape(product["slug"])}" data-version="{product["version"]}">'
+        f'<h3>{html_escape(product["name"])}</h3>'
+        f'<p>{html_escape(product["description"])}</p>'
+        f'<p class="product-price">{html_escape(price)}</p>'
+        f'<a class="cta-button" href="{html_escape(link)}">Comprar ahora</a>'
+        f'</article>'
+    )
+
+def public_product(product):
+    """Producto tal como lo expone /api/products"""
+    return {key: value for key, value in product.items() if key != 'id'}
+
+catalog = ProductCatalog(CATALOG_REFRESH_INTERVAL)
+
+# ============================================
+# LINKS DE SALIDA (/go/<slug>)
+# ============================================
+
+# Parámetros de atribución que /go/<slug> pasa al link de Hotmart
+GO_PASSTHROUGH_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_content', 'utm_term', 'src', 'sck')
+# Bytes aleatorios del sck que /go agrega a cada clic (16 caracteres en base64 url)
+GO_CLICK_REF_BYTES = 12
+
+link_table = {'version': None, 'links': {}}
+
+def resolve_link(slug):
+    """Link de Hotmart de un producto (tabla en memoria, rearmada por versión del catálogo)"""
+    snapshot = catalog.get()
+    if link_table['version'] != snapshot['version']:
+        link_table['links'] = {p['slug']: p['hotmart_link'] for p in snapshot['products'] if p['hotmart_link']}
+        link_table['version'] = snapshot['version']
+    return link_table['links'].get(slug)
+
+def outbound_click(slug, args, user_agent='', ip_address='', referrer=''):
+    """
+    Resolver /go/<slug> y encolar el clic en analytics.
+    Devuelve la URL de destino (con los parámetros de atribución) o None.
+    Compartido por el modo WSGI (Flask) y el ASGI (asgi.py).
+    """
+    target = resolve_link(slug)
+    if not target:
+        return None
+
+    params = {name: args[name] for name in GO_PASSTHROUGH_PARAMS if args.get(name)}
+    # Referencia del clic: Hotmart la devuelve en la venta y el embudo la resuelve
+    # a la visita (attribution_clicks). Un sck propio del link se respeta
+    params.setdefault('sck', secrets.token_urlsafe(GO_CLICK_REF_BYTES))
+    target = f"{target}{'&' if '?' in target else '?'}{urlencode(params)}"
+
+    # sid: sesión de analytics.js (el clic se atribuye a los UTM con que llegó la visita)
+    session_id = args.get('sid') or None
+
+    # Los previsualizadores de links también siguen /go: se redirigen pero no cuentan como clic
+    if drop_bot_event('outbound_click', user_agent, session_id):
+        return target
+
+    analytics_buffer.record(
+        'outbound_click',
+        page_url=referrer,
+        element_id=slug,
+        user_agent=user_agent,
+        ip_address=ip_address,
+        referrer=referrer,
+        utm_source=params.get('utm_source', ''),
+        utm_medium=params.get('utm_medium', ''),
+        utm_campaign=params.get('utm_campaign', ''),
+        session_id=session_id,
+        metadata={'src': params.get('src', ''), 'sck': params['sck'], 'target': target}
+    )
+    return target
+
+def tracked_link(slug, source, medium, campaign, src=None, base=''):
+    """URL de /go/<slug> con UTM (base: BASE_URL para links absolutos)"""
+    params = {
+        'utm_source': source,
+        'utm_medium': medium,
+        'utm_campaign': campaign,
+        'src': src or f"{source}-{slug}"
+    }
+    return f"{base}/go/{slug}?{urlencode(params)}"
+
+# ============================================
+# ÍNDICE DE FAQS
+# ============================================
+
+FAQS_JSON_PATH = os.path.join(os.path.dirname(__file__), 'faqs-tienda.json')
+# Segundos entre chequeos de cambios (tabla faqs y faqs-tienda.json)
+FAQ_REFRESH_INTERVAL = float(os.getenv('FAQ_REFRESH_INTERVAL', 60))
+# Puntaje mínimo (0-1) para responder; por debajo se deriva a soporte
+FAQ_MIN_SCORE = float(os.getenv('FAQ_MIN_SCORE', 0.45))
+
+# Palabras que no aportan al buscar
+FAQ_STOPWORDS = {
+    'el', 'la', 'los', 'las', 'un', 'una', 'unos', 'unas', 'de', 'del', 'al', 'a', 'en', 'y', 'o',
+    'que', 'con', 'por', 'para', 'como', 'es', 'se', 'me', 'mi', 'lo', 'le', 'su', 'sus', 'hay',
+    'puedo', 'tengo', 'tiene', 'son', 'esta', 'este', 'esto', 'cual', 'cuales', 'si', 'no'
+}
+
+def faq_words(text):
+    """Palabras normalizadas (sin acentos ni stopwords) de un texto"""
+    return [word for word in slugify(text).split('-') if len(word) > 1 and word not in FAQ_STOPWORDS]
+
+class FaqIndex:
+    """
+    Índice en memoria de las FAQs (tabla faqs + faqs-tienda.json).
+    Puntaje de una pregunta contra cada FAQ: fracción del peso (idf) de
+    las palabras de la pregunta que aparecen en la FAQ (pregunta + keywords),
+    combinada con la similitud de texto de difflib para desempatar.
+    Se relee como mucho cada refresh_interval segundos y solo se reindexa
+    si cambió el contenido.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.faqs = []
+        self.postings = {}
+        self.idf = {}
+        self.version = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.refresh_interval:
+            return
+
+        with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.refresh_interval:
+                return
+            try:
+                self._reload()
+            except Exception as e:
+                # Con la base caída se sigue respondiendo con el último índice
+                print(f"❌ Error cargando FAQs: {e}")
+                if self.version is None:
+                    raise
+            self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        """Rearmar el índice ya, fuera del camino de los requests (modo ASGI)"""
+        with self.lock:
+            self._reload()
+            self.loaded_at = time.monotonic()
+
+    def _reload(self):
+        faqs = []
+
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT question, answer, keywords FROM faqs ORDER BY id')
+            for question, answer, keywords in cursor.fetchall():
+                # keywords: TEXT[] en PostgreSQL, texto separado por comas en SQLite
+                if isinstance(keywords, str):
+                    keywords = keywords.split(',')
+                faqs.append((question, answer, ' '.join(keywords or [])))
+        finally:
+            conn.close()
+
+        if os.path.exists(FAQS_JSON_PATH):
+            with open(FAQS_JSON_PATH, 'r', encoding='utf-8') as f:
+                faqs.extend((item['q'], item['a'], '') for item in json.load(f))
+
+        version = hashlib.sha256(json.dumps(faqs, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+        if version == self.version:
+            return
+
+        # Sin repetidas (init_db las insertaba en cada arranque)
+        unique = {}
+        for question, answer, keywords in faqs:
+            unique.setdefault(' '.join(faq_words(question)) or question, (question, answer, keywords))
+        entries = list(unique.values())
+
+        postings = {}
+        for position, (question, _, keywords) in enumerate(entries):
+            for word in set(faq_words(f"{question} {keywords}")):
+                postings.setdefault(word, set()).add(position)
+
+        total = len(entries)
+        self.idf = {word: math.log(1 + total / len(positions)) for word, positions in postings.items()}
+        self.faqs = [{'question': q, 'answer': a, 'normalized': ' '.join(faq_words(q))} for q, a, _ in entries]
+        self.postings = postings
+        self.version = version
+        print(f"❓ FAQs indexadas: {total} (versión {version})")
+
+    def match(self, text):
+        """
+        Mejor FAQ para una pregunta libre: {'question', 'answer', 'score'} o
+        None si no hay ninguna con puntaje suficiente
+        """
+        self._ensure_loaded()
+        words = faq_words(text)
+        if not words:
+            return None
+
+        # Palabras que no están en ninguna FAQ pesan como las más raras
+        max_idf = max(self.idf.values(), default=1.0)
+        weights = {word: self.idf.get(word, max_idf) for word in set(words)}
+        total_weight = sum(weights.values())
+
+        scores = {}
+        for word, weight in weights.items():
+            for position in self.postings.get(word, ()):
+                scores[position] = scores.get(position, 0.0) + weight / total_weight
+        if not scores:
+            return None
+
+        normalized = ' '.join(words)
+        best_score, best = 0.0, None
+        for position, coverage in scores.items():
+            similarity = SequenceMatcher(None, normalized, self.faqs[position]['normalized']).ratio()
+            score = 0.7 * coverage + 0.3 * similarity
+            if score > best_score:
+                best_score, best = score, self.faqs[position]
+
+        if best_score < FAQ_MIN_SCORE:
+            return None
+        return {'question': best['question'], 'answer': best['answer'], 'score': round(best_score, 3)}
+
+faq_index = FaqIndex(FAQ_REFRESH_INTERVAL)
+
+# ============================================
+# BOT DE TELEGRAM (WEBHOOK)
+# ============================================
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
+# Secreto que Telegram manda en X-Telegram-Bot-Api-Secret-Token (set_webhook)
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+# Segundos máximos esperando encolar un update
+TELEGRAM_ENQUEUE_TIMEOUT = 5
+TELEGRAM_BOT_PATH = os.path.join(os.path.dirname(__file__), 'telegram', 'bot.py')
+
+def load_bot_module():
+    """
+    Cargar telegram/bot.py por ruta: la carpeta se llama igual que el
+    paquete python-telegram-bot, así que no se puede importar como telegram.bot
+    """
+    spec = importlib.util.spec_from_file_location('robot_telegram_bot', TELEGRAM_BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+bot_products = {'version': None, 'products': []}
+
+def catalog_for_bot():
+    """
+    Productos del catálogo en el formato que usan los handlers del bot.
+    Devuelve la misma lista mientras no cambie la versión del catálogo
+    (el bot rearma teclados e índice solo cuando cambia). El bot la llama
+    con asyncio.to_thread: catalog.get() puede releer la base.
+    """
+    snapshot = catalog.get()
+    if bot_products['version'] != snapshot['version']:
+        bot_products['products'] = [
+            {
+                'nombre': p['name'],
+                'slug': p['slug'],
+                'precio': f"{p['currency']} {p['price']:g}" if p['price'] is not None else '',
+                'descripcion': p['description'],
+                # Los clics pasan por /go/<slug> para quedar registrados
+                'link': f"{BASE_URL}/go/{p['slug']}"
+            }
+            for p in snapshot['products']
+        ]
+        bot_products['version'] = snapshot['version']
+    return bot_products['products']
+
+class TelegramWebhookBot:
+    """
+    Aplicación de python-telegram-bot corriendo dentro del proceso web.
+    Tiene su propio event loop en un hilo; el endpoint del webhook solo
+    encola el update y responde, y la aplicación procesa hasta
+    TELEGRAM_CONCURRENT_UPDATES updates en paralelo. Sin polling.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.module = None
+        self.application = None
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def process(self, data):
+        """Encolar un update recibido por el webhook"""
+        self._ensure_started()
+        update = self.module.Update.de_json(data, self.application.bot)
+        future = asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop)
+        future.result(timeout=TELEGRAM_ENQUEUE_TIMEOUT)
+
+    def _ensure_started(self):
+        """Arrancar la aplicación (lazy, después del fork de gunicorn)"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            ready = threading.Event()
+            errors = []
+            self.thread = threading.Thread(target=self._run, args=(ready, errors), name='telegram-webhook', daemon=True)
+            self.thread.start()
+            ready.wait()
+            if errors:
+                raise errors[0]
+
+    def _run(self, ready, errors):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self.module = load_bot_module()
+            application = self.module.build_application(self.token, webhook=True)
+            application.bot_data['catalogo'] = catalog_for_bot
+            application.bot_data['registrar_chat'] = register_chat_from_bot
+            application.bot_data['difundir'] = start_broadcast_from_bot
+            application.bot_data['faq'] = faq_index.match
+            self.module.register_handlers(application)
+            loop.run_until_complete(application.initialize())
+            loop.run_until_complete(application.start())
+        except Exception as e:
+            print(f"❌ Error iniciando bot de Telegram: {e}")
+            errors.append(e)
+            ready.set()
+            loop.close()
+            return
+
+        self.application, self.loop = application, loop
+        print(f"🤖 Bot de Telegram en modo webhook (@{application.bot.username})")
+        ready.set()
+        loop.run_forever()
+
+    def stop(self):
+        """Terminar de procesar los updates encolados y cerrar la aplicación"""
+        if self.loop is None or not self.thread.is_alive():
+            return
+
+        async def shutdown():
+            await self.application.stop()
+            await self.application.shutdown()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(timeout=10)
+        except Exception as e:
+            print(f"❌ Error deteniendo bot de Telegram: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+def telegram_secret_ok(secret):
+    """Comparar el secreto del webhook en tiempo constante"""
+    return bool(TELEGRAM_WEBHOOK_SECRET) and hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET)
+
+telegram_bot = TelegramWebhookBot(TELEGRAM_BOT_TOKEN)
+atexit.register(telegram_bot.stop)
+
+# ============================================
+# DIFUSIÓN POR TELEGRAM
+# ============================================
+
+# Límite global de Telegram: ~30 mensajes/s por bot (se deja margen)
+BROADCAST_RATE = float(os.getenv('TELEGRAM_BROADCAST_RATE', '25'))
+# Envíos en vuelo a la vez
+BROADCAST_CONCURRENCY = int(os.getenv('TELEGRAM_BROADCAST_CONCURRENCY', '10'))
+# Chats por lote: el progreso se guarda al terminar cada lote
+BROADCAST_BATCH_SIZE = int(os.getenv('TELEGRAM_BROADCAST_BATCH_SIZE', '200'))
+BROADCAST_MAX_RETRIES = 3
+# 429 seguidos tolerados por chat antes de darlo por fallido
+BROADCAST_MAX_RATE_LIMITS = int(os.getenv('TELEGRAM_BROADCAST_MAX_RATE_LIMITS', '5'))
+
+def register_telegram_chat(chat_id, first_name=None, username=None):
+    """Guardar (o reactivar) un chat que hizo /start"""
+    ph = sql_placeholder()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            INSERT INTO telegram_chats (chat_id, first_name, username) VALUES ({ph}, {ph}, {ph})
+            ON CONFLICT (chat_id) DO UPDATE SET
+                first_name = EXCLUDED.first_name,
+                username = EXCLUDED.username,
+                status = 'active',
+                last_seen = CURRENT_TIMESTAMP
+        ''', (chat_id, first_name, username))
+        conn.commit()
+    finally:
+        conn.close()
+
+def create_broadcast(message):
+    """Crear una difusión y devolver su id"""
+    ph = sql_placeholder()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if is_postgresql_db():
+            cursor.execute(f'INSERT INTO telegram_broadcasts (message) VALUES ({ph}) RETURNING id', (message,))
+            broadcast_id = cursor.fetchone()[0]
+        else:
+            cursor.execute(f'INSERT INTO telegram_broadcasts (message) VALUES ({ph})', (message,))
+            broadcast_id = cursor.lastrowid
+        conn.commit()
+        return broadcast_id
+    finally:
+        conn.close()
+
+def load_broadcast(broadcast_id=None):
+    """Difusión por id, o la última sin terminar si no se indica id"""
+    ph = sql_placeholder()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        columns = 'id, message, status, last_chat_id, sent_count, failed_count, blocked_count'
+        if broadcast_id is None:
+            cursor.execute(f"SELECT {columns} FROM telegram_broadcasts WHERE status = 'running' ORDER BY id DESC LIMIT 1")
+        else:
+            cursor.execute(f'SELECT {columns} FROM telegram_broadcasts WHERE id = {ph}', (broadcast_id,))
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+
+    if not row:
+        return None
+    keys = ['id', 'message', 'status', 'last_chat_id', 'sent', 'failed', 'blocked']
+    return dict(zip(keys, row))
+
+def next_broadcast_chats(after_chat_id, limit):
+    """Siguiente lote de chats activos (orden por chat_id, para poder retomar)"""
+    ph = sql_placeholder()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT chat_id FROM telegram_chats
+            WHERE status = 'active' AND chat_id > {ph}
+            ORDER BY chat_id
+            LIMIT {ph}
+        ''', (after_chat_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def save_broadcast_progress(broadcast, blocked_chat_ids, finished=False):
+    """Guardar el avance de un lote y desactivar los chats bloqueados (un UPDATE por lote)"""
+    ph = sql_placeholder()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if blocked_chat_ids:
+            marks = ', '.join([ph] * len(blocked_chat_ids))
+            cursor.execute(f"UPDATE telegram_chats SET status = 'blocked' WHERE chat_id IN ({marks})", list(blocked_chat_ids))
+        cursor.execute(f'''
+            UPDATE telegram_broadcasts
+            SET last_chat_id = {ph}, sent_count = {ph}, failed_count = {ph}, blocked_count = {ph},
+                status = {ph}, finished_at = {'CURRENT_TIMESTAMP' if finished else 'finished_at'}
+            WHERE id = {ph}
+        ''', (
+            broadcast['last_chat_id'], broadcast['sent'], broadcast['failed'], broadcast['blocked'],
+            'done' if finished else 'running', broadcast['id']
+        ))
+        conn.commit()
+    finally:
+        conn.close()
+
+class SendRateLimiter:
+    """
+    Reparte los envíos a un ritmo fijo (mensajes/s) entre todas las tareas.
+    Un 429 con retry_after frena a todas, no solo a la que lo recibió.
+    Se usa desde un único event loop, así que no necesita lock.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+async def send_broadcast_message(bot, chat_id, text, limiter, semaphore):
+    """
+    Enviar un mensaje de la difusión a un chat.
+    Devuelve 'sent', 'blocked' (el usuario bloqueó el bot o el chat no existe) o 'failed'.
+    """
+    from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError, TelegramError
+
+    async with semaphore:
+        attempt = 0
+        rate_limited = 0
+        while attempt <= BROADCAST_MAX_RETRIES:
+            await limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
+                return 'sent'
+            except RetryAfter as e:
+                # 429: esperar lo que pide Telegram y reintentar (con su propio tope)
+                rate_limited += 1
+                if rate_limited > BROADCAST_MAX_RATE_LIMITS:
+                    print(f"❌ Error enviando a {chat_id}: {rate_limited - 1} reintentos por 429")
+                    return 'failed'
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                print(f"⏳ Telegram pidió esperar {retry_after}s (429)")
+                limiter.pause(retry_after)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return 'blocked'
+                print(f"❌ Error enviando a {chat_id}: {e}")
+                return 'failed'
+            except (TimedOut, NetworkError) as e:
+                attempt += 1
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                print(f"❌ Error enviando a {chat_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+async def run_broadcast(broadcast_id, bot):
+    """
+    Enviar (o retomar) una difusión a todos los chats activos.
+    El avance se guarda por lote: si se interrumpe, al retomarla se reenvía
+    como mucho el último lote incompleto. Cada chat recibe un solo mensaje,
+    así que el límite por chat de Telegram (1 msg/s) no se alcanza.
+    """
+    broadcast = await asyncio.to_thread(load_broadcast, broadcast_id)
+    if not broadcast:
+        raise ValueError(f"Difusión {broadcast_id} no encontrada")
+    if broadcast['status'] == 'done':
+        return broadcast
+
+    limiter = SendRateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = time.monotonic()
+    print(f"📣 Difusión #{broadcast['id']}: desde chat {broadcast['last_chat_id']}")
+
+    while True:
+        chat_ids = await asyncio.to_thread(next_broadcast_chats, broadcast['last_chat_id'], BROADCAST_BATCH_SIZE)
+        if not chat_ids:
+            break
+
+        results = await asyncio.gather(*(
+            send_broadcast_message(bot, chat_id, broadcast['message'], limiter, semaphore)
+            for chat_id in chat_ids
+        ))
+        blocked = [chat_id for chat_id, result in zip(chat_ids, results) if result == 'blocked']
+        broadcast['sent'] += results.count('sent')
+        broadcast['failed'] += results.count('failed')
+        broadcast['blocked'] += len(blocked)
+        broadcast['last_chat_id'] = chat_ids[-1]
+        await asyncio.to_thread(save_broadcast_progress, broadcast, blocked)
+
+        elapsed = time.monotonic() - started
+        print(f"   📤 enviados: {broadcast['sent']} | bloqueados: {broadcast['blocked']} | fallidos: {broadcast['failed']} ({broadcast['sent'] / elapsed:.1f} msg/s)")
+
+    await asyncio.to_thread(save_broadcast_progress, broadcast, [], True)
+    broadcast['status'] = 'done'
+    print(f"✅ Difusión #{broadcast['id']} terminada")
+    return broadcast
+
+async def run_broadcast_standalone(broadcast_id):
+    """Correr una difusión desde la línea de comandos (sin el proceso web)"""
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    request_pool = HTTPXRequest(connection_pool_size=BROADCAST_CONCURRENCY)
+    async with Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_URL, request=request_pool) as bot:
+        return await run_broadcast(broadcast_id, bot)
+
+async def register_chat_from_bot(chat, user):
+    """Hook del bot: guardar el chat en /start sin bloquear el event loop"""
+    try:
+        await asyncio.to_thread(register_telegram_chat, chat.id, user.first_name if user else None, user.username if user else None)
+    except Exception as e:
+        print(f"❌ Error guardando chat de Telegram {chat.id}: {e}")
+
+async def start_broadcast_from_bot(text, admin_chat_id):
+    """Hook del bot (/anunciar): crear la difusión y correrla en segundo plano"""
+    broadcast_id = await asyncio.to_thread(create_broadcast, text)
+    application = telegram_bot.application
+
+    async def run_and_report():
+        try:
+            report = await run_broadcast(broadcast_id, application.bot)
+            summary = f"✅ Difusión #{broadcast_id} terminada: {report['sent']} enviados, {report['blocked']} bloqueados, {report['failed']} fallidos"
+        except Exception as e:
+            summary = f"❌ Difusión #{broadcast_id} interrumpida: {e}"
+        print(summary)
+        await application.bot.send_message(chat_id=admin_chat_id, text=summary)
+
+    application.create_task(run_and_report())
+    return broadcast_id
+
+# ============================================
+# CONTROL DE ADMISIÓN
+# ============================================
+
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', '1') != '0'
+# Requests a la vez usando la base por proceso, y cuántos quedan reservados para webhooks
+ADMISSION_DB_SLOTS = int(os.getenv('ADMISSION_DB_SLOTS', '8'))
+ADMISSION_DB_RESERVED = int(os.getenv('ADMISSION_DB_RESERVED', '2'))
+# Requests esperando un slot de base antes de rechazar con 503
+ADMISSION_DB_MAX_WAITING = int(os.getenv('ADMISSION_DB_MAX_WAITING', '16'))
+# Segundos máximos esperando un slot de base
+ADMISSION_DB_WAIT_TIMEOUT = 2.0
+# Eventos de analytics sin volcar a partir de los cuales se rechazan beacons con 503
+ADMISSION_SHED_BACKLOG = int(os.getenv('ADMISSION_SHED_BACKLOG', str(ANALYTICS_BUFFER_MAX * 4 // 5)))
+# IPs con bucket en memoria (se descartan las menos recientes)
+ADMISSION_MAX_CLIENTS = 20000
+
+# Clases de endpoints: per_ip y total son (tokens por segundo, ráfaga)
+ADMISSION_CLASSES = {
+    # Ventas y bot: sin límite por IP (Hotmart y Telegram llaman desde pocas IPs) y con slots reservados
+    'webhook': {'paths': ('/webhook/hotmart', '/telegram/webhook'), 'priority': True, 'uses_db': True},
+    'beacon': {'paths': ('/api/analytics/track', '/api/push/track'), 'per_ip': (10, 30), 'total': (500, 1000),
+               'shed_on_backlog': True},
+    'faq': {'paths': ('/api/faq',), 'per_ip': (2, 10), 'total': (200, 400)},
+    'subscribe': {'paths': ('/api/push/subscribe',), 'per_ip': (0.2, 5), 'total': (50, 100), 'uses_db': True},
+}
+
+class AdmissionController:
+    """
+    Admisión de requests a endpoints públicos (en memoria, por proceso).
+
+    1. Token buckets por (clase, IP) y por clase: si se agotan, 429 con Retry-After.
+    2. Beacons: si la cola de analytics no se vacía (base lenta), 503 inmediato.
+    3. Slots de base: las clases que consultan la base toman un slot; los
+       webhooks pueden usar todos y el resto deja ADMISSION_DB_RESERVED libres.
+       Con más de ADMISSION_DB_MAX_WAITING esperando, 503 sin hacer cola.
+
+    Los slots solo reservan algo con varios requests por proceso: workers
+    gthread (gunicorn.conf.py) o el modo ASGI, no workers sync.
+    """
+
+    def __init__(self, classes, db_slots=ADMISSION_DB_SLOTS, db_reserved=ADMISSION_DB_RESERVED,
+                 db_max_waiting=ADMISSION_DB_MAX_WAITING, db_wait_timeout=ADMISSION_DB_WAIT_TIMEOUT,
+                 max_clients=ADMISSION_MAX_CLIENTS):
+        self.classes = classes
+        self.by_path = {path: name for name, config in classes.items() for path in config['paths']}
+        self.db_slots = db_slots
+        self.db_reserved = min(db_reserved, db_slots - 1)
+        self.db_max_waiting = db_max_waiting
+        self.db_wait_timeout = db_wait_timeout
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # (clase, ip) -> [tokens, último uso]
+        self.totals = {}  # clase -> [tokens, último uso]
+        self.db_cond = threading.Condition()
+        self.db_in_use = 0
+        self.db_waiting = 0
+        self.counters = {name: {'admitted': 0, 'shed_429': 0, 'shed_503': 0} for name in classes}
+
+    def classify(self, path):
+        """Clase del endpoint (None si no tiene control de admisión)"""
+        return self.by_path.get(path)
+
+    def _take(self, bucket, rate, burst, now):
+        """Sacar un token. Devuelve 0 o los segundos hasta el próximo token"""
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / rate
+
+    def _check_rate(self, name, ip):
+        config = self.classes[name]
+        now = time.monotonic()
+        with self.lock:
+            if 'per_ip' in config:
+                rate, burst = config['per_ip']
+                key = (name, ip)
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = [burst, now]
+                    if len(self.buckets) > self.max_clients:
+                        self.buckets.popitem(last=False)
+                else:
+                    self.buckets.move_to_end(key)
+                wait = self._take(bucket, rate, burst, now)
+                if wait:
+                    return wait
+
+            if 'total' in config:
+                rate, burst = config['total']
+                bucket = self.totals.setdefault(name, [burst, now])
+                return self._take(bucket, rate, burst, now)
+        return 0
+
+    def admit(self, name, ip, use_db_slot=True):
+        """
+        Decidir si se atiende un request de la clase `name`.
+        Devuelve None si se admite o (status, segundos para Retry-After).
+        Si devuelve None y la clase usa la base, hay que llamar a release().
+        """
+        config = self.classes[name]
+        wait = self._check_rate(name, ip)
+        if wait:
+            self._count(name, 'shed_429')
+            return 429, wait
+
+        if config.get('shed_on_backlog') and len(analytics_buffer.pending) >= ADMISSION_SHED_BACKLOG:
+            self._count(name, 'shed_503')
+            return 503, analytics_buffer.flush_interval
+
+        if use_db_slot and config.get('uses_db') and not self._acquire_db(config.get('priority', False)):
+            self._count(name, 'shed_503')
+            return 503, 1
+
+        self._count(name, 'admitted')
+        return None
+
+    def _acquire_db(self, priority):
+        limit = self.db_slots if priority else self.db_slots - self.db_reserved
+        with self.db_cond:
+            # Cola llena: rechazar rápido en vez de acumular requests colgados
+            if not priority and self.db_waiting >= self.db_max_waiting:
+                return False
+            self.db_waiting += 1
+            try:
+                acquired = self.db_cond.wait_for(lambda: self.db_in_use < limit, timeout=self.db_wait_timeout)
+            finally:
+                self.db_waiting -= 1
+            if acquired:
+                self.db_in_use += 1
+            return acquired
+
+    def release(self):
+        """Devolver el slot de base tomado por admit()"""
+        with self.db_cond:
+            self.db_in_use -= 1
+            self.db_cond.notify_all()
+
+    def _count(self, name, outcome):
+        with self.lock:
+            self.counters[name][outcome] += 1
+
+    def stats(self):
+        with self.lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+            clients = len(self.buckets)
+        return {
+            'clases': counters,
+            'ips_con_bucket': clients,
+            'slots_base': {'en_uso': self.db_in_use, 'esperando': self.db_waiting, 'total': self.db_slots,
+                           'reservados_webhook': self.db_reserved}
+        }
+
+admission = AdmissionController(ADMISSION_CLASSES)
+
+def admission_client_ip():
+    """IP del cliente para los buckets (la que vio el proxy, no la que dice el cliente)"""
+    return real_client_ip(request.headers.get('X-Forwarded-For'), request.remote_addr)
+
+def shed_response(status, retry_after):
+    """429/503 con Retry-After (segundos enteros, como mínimo 1)"""
+    message = 'Demasiadas solicitudes' if status == 429 else 'Servidor sobrecargado, reintentá en unos segundos'
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+@app.before_request
+def admission_check():
+    """Aplicar el control de admisión antes de tocar la base"""
+    if not ADMISSION_ENABLED:
+        return None
+    name = admission.classify(request.path)
+    if name is None:
+        return None
+
+    rejection = admission.admit(name, admission_client_ip())
+    if rejection:
+        return shed_response(*rejection)
+    g.admission_db_slot = ADMISSION_CLASSES[name].get('uses_db', False)
+    return None
+
+@app.teardown_request
+def admission_release(exc):
+    """Liberar el slot de base al terminar el request (también si falló)"""
+    if g.pop('admission_db_slot', False):
+        admission.release()
+
 # ============================================
 # RUTAS PRINCIPALES
 # ============================================
@@ -286,7 +3447,7 @@ def init_db():
 @app.route('/')
 def index():
     """Página principal"""
-    return send_from_directory(SITE_DIR, 'index.html')
+    return send_site_file('index.html')
 
 @app.route('/test')
 def test():
@@ -301,27 +3462,287 @@ def test():
 @app.route('/ventas')
 def ventas():
     """Página de ventas principal - Enciclopedia Plantas Medicinales"""
-    return send_from_directory(SITE_DIR, 'ventas-plantas-medicinales.html')
+    return send_site_file('ventas-plantas-medicinales.html')
 
 @app.route('/plantas-medicinales')
 def plantas():
     """Alias para página de ventas"""
-    return send_from_directory(SITE_DIR, 'ventas-plantas-medicinales.html')
+    return send_site_file('ventas-plantas-medicinales.html')
+
+# ============================================
+# CACHE DE PÁGINAS HTML EN MEMORIA
+# ============================================
+
+try:
+    import brotli
+except ImportError:  # Brotli es opcional: sin él solo se cachea gzip
+    brotli = None
+
+# Tope de memoria de la cache (bytes, sumando todas las variantes)
+PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+# Segundos entre chequeos de cambios del archivo (evita un stat por request)
+PAGE_CACHE_CHECK_INTERVAL = float(os.getenv('PAGE_CACHE_CHECK_INTERVAL', 2))
+
+class PageCache:
+    """
+    Cache LRU en memoria de páginas HTML de /site.
+    Guarda los bytes, las variantes gzip/br y el ETag de cada página para
+    servir las landings sin stat/open/read por request. Se revalida contra
+    el archivo en disco (mtime y tamaño) como mucho cada check_interval
+    segundos y desaloja las menos usadas al superar max_bytes.
+    """
+
+    def __init__(self, max_bytes, check_interval):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, file_path, precompressed=None):
+        """
+        Devolver la entrada de file_path, cargándola si no está o cambió.
+        precompressed: {encoding: ruta} con variantes de scripts/build_static.py
+        Devuelve None si el archivo no existe.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry and now - entry['checked_at'] < self.check_interval:
+                self.entries.move_to_end(file_path)
+                self.hits += 1
+                return entry
+
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            self.discard(file_path)
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry and entry['stamp'] == stamp:
+                entry['checked_at'] = now
+                self.entries.move_to_end(file_path)
+                self.hits += 1
+                return entry
+
+        entry = self._load(file_path, stamp, precompressed or {})
+        entry['checked_at'] = now
+
+        with self.lock:
+            self.misses += 1
+            self._remove(file_path)
+            # Una página más grande que todo el tope se sirve pero no se guarda
+            if entry['bytes'] <= self.max_bytes:
+                self.entries[file_path] = entry
+                self.size += entry['bytes']
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= evicted['bytes']
+
+        return entry
+
+    def _load(self, file_path, stamp, precompressed):
+        """Leer la página y sus variantes (precomprimidas o comprimidas acá)"""
+        with open(file_path, 'rb') as f:
+            body = f.read()
+
+        encodings = {}
+        if precompressed:
+            for encoding, path in precompressed.items():
+                with open(path, 'rb') as f:
+                    encodings[encoding] = f.read()
+        else:
+            gz_body = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz_body) < len(body):
+                encodings['gzip'] = gz_body
+            if brotli is not None:
+                br_body = brotli.compress(body, quality=11)
+                if len(br_body) < len(body):
+                    encodings['br'] = br_body
+
+        return {
+            'stamp': stamp,
+            'body': body,
+            'encodings': encodings,
+            'etag': hashlib.sha256(body).hexdigest()[:16],
+            'last_modified': datetime.fromtimestamp(stamp[0] / 1e9),
+            'bytes': len(body) + sum(len(data) for data in encodings.values()),
+        }
+
+    def _remove(self, file_path):
+        entry = self.entries.pop(file_path, None)
+        if entry:
+            self.size -= entry['bytes']
+
+    def discard(self, file_path):
+        """Sacar una página de la cache"""
+        with self.lock:
+            self._remove(file_path)
+
+    def stats(self):
+        """Contadores para /api/stats"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'paginas': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0
+            }
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES, PAGE_CACHE_CHECK_INTERVAL)
+
+def send_cached_page(file_path, precompressed=None):
+    """
+    Servir una página HTML desde la cache en memoria (no-cache + ETag,
+    el navegador revalida y recibe 304). None si el archivo no existe.
+    """
+    entry = page_cache.get(file_path, precompressed)
+    if entry is None:
+        return None
+
+    encoding = choose_content_encoding(entry)
+    response = app.response_class(entry['encodings'][encoding] if encoding else entry['body'], mimetype='text/html')
+    response.set_etag(f"{entry['etag']}-{encoding or 'identity'}")
+    response.last_modified = entry['last_modified']
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
 
 # ============================================
 # SERVIR ARCHIVOS ESTÁTICOS
 # ============================================
 
+# Salida de scripts/build_static.py (assets con hash + variantes .gz/.br)
+STATIC_DIST_DIR = os.path.join(SITE_DIR, 'dist')
+STATIC_MANIFEST_PATH = os.path.join(STATIC_DIST_DIR, 'manifest.json')
+# Segundos entre chequeos de cambios del manifest (evita un stat por request)
+STATIC_MANIFEST_CHECK_INTERVAL = 2
+IMMUTABLE_MAX_AGE = 31536000  # 1 año
+CONTENT_ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+
+static_manifest = {'mtime': None, 'checked_at': 0.0, 'files': {}, 'by_path': {}}
+static_manifest_lock = threading.Lock()
+
+def load_static_manifest():
+    """Cargar (o recargar si cambió) el manifest de assets precompilados"""
+    now = time.monotonic()
+    if now - static_manifest['checked_at'] < STATIC_MANIFEST_CHECK_INTERVAL:
+        return static_manifest
+
+    with static_manifest_lock:
+        static_manifest['checked_at'] = now
+        try:
+            mtime = os.path.getmtime(STATIC_MANIFEST_PATH)
+        except OSError:
+            # Sin build: se sirven los archivos originales de /site
+            static_manifest.update(mtime=None, files={}, by_path={})
+            return static_manifest
+
+        if mtime != static_manifest['mtime']:
+            try:
+                with open(STATIC_MANIFEST_PATH, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"❌ Error leyendo manifest de estáticos: {e}")
+                return static_manifest
+            files = data.get('files', {})
+            by_path = {entry['path']: (original, entry) for original, entry in files.items()}
+            # Assets con hash de builds anteriores (HTML viejo en caché de navegadores)
+            for path, entry in data.get('previous', {}).items():
+                by_path.setdefault(path, (entry['original'], entry))
+            static_manifest.update(mtime=mtime, files=files, by_path=by_path)
+
+    return static_manifest
+
+def choose_content_encoding(entry):
+    """Elegir la mejor variante precomprimida según Accept-Encoding"""
+    for encoding in ('br', 'gzip'):
+        if encoding in entry.get('encodings', {}) and request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def send_site_file(rel_path):
+    """
+    Servir un archivo de /site usando el build precomprimido si existe.
+
+    - Assets pedidos por su nombre con hash: Cache-Control immutable (1 año)
+    - HTML y URLs estables: no-cache + ETag, el navegador revalida y recibe 304
+    """
+    manifest = load_static_manifest()
+
+    if rel_path in manifest['files']:
+        original, entry = rel_path, manifest['files'][rel_path]
+    elif rel_path in manifest['by_path']:
+        original, entry = manifest['by_path'][rel_path]
+    else:
+        # Sin build: las páginas HTML igual se sirven desde la cache en memoria
+        file_path = safe_join(SITE_DIR, rel_path) if rel_path.endswith('.html') else None
+        response = send_cached_page(file_path) if file_path else None
+        return response or send_from_directory(SITE_DIR, rel_path)
+
+    is_immutable = entry.get('immutable') and rel_path == entry['path']
+
+    if original.endswith('.html') and not is_immutable:
+        file_path = os.path.join(STATIC_DIST_DIR, entry['path'])
+        precompressed = {encoding: file_path + CONTENT_ENCODING_SUFFIXES[encoding] for encoding in entry.get('encodings', {})}
+        response = send_cached_page(file_path, precompressed)
+        if response:
+            return response
+
+    encoding = choose_content_encoding(entry)
+    file_path = os.path.join(STATIC_DIST_DIR, entry['path']) + CONTENT_ENCODING_SUFFIXES.get(encoding, '')
+
+    mimetype, file_encoding = mimetypes.guess_type(original)
+    if file_encoding == 'gzip':
+        # Archivos que ya son .gz en origen (sitemap-N.xml.gz): se sirven tal cual
+        mimetype = 'application/gzip'
+
+    response = send_file(
+        file_path,
+        mimetype=mimetype or 'application/octet-stream',
+        download_name=os.path.basename(original),
+        conditional=True,
+        etag=f"{entry['etag']}-{encoding or 'identity'}",
+        max_age=IMMUTABLE_MAX_AGE if is_immutable else 0
+    )
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    if is_immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    return response
+
 @app.route('/<path:filename>')
 def serve_static(filename):
     """Servir archivos estáticos (CSS, JS, imágenes)"""
-    return send_from_directory(SITE_DIR, filename)
+    if filename.endswith('/'):
+        filename += 'index.html'
+    return send_site_file(filename)
 
 @app.route('/assets/<path:filename>')
 def serve_assets(filename):
     """Servir assets (iconos, imágenes)"""
-    assets_dir = os.path.join(SITE_DIR, 'assets')
-    return send_from_directory(assets_dir, filename)
+    return send_site_file(f'assets/{filename}')
 
 # ============================================
 # API ENDPOINTS
@@ -352,104 +3773,94 @@ def push_subscribe():
         else:
             cursor.execute('SELECT id FROM push_subs WHERE endpoint = ?', (endpoint,))
         
-        if cursor.fetchone():
+        existing = cursor.fetchone()
+        if existing:
+            # El navegador sigue vivo: reactivar si había sido marcada como vencida
+            record_push_results(cursor, [existing[0]], [])
+            conn.commit()
+            conn.close()
             return jsonify({'message': 'Ya suscrito'}), 200
         
-        # Insertar nueva suscripción
+        # Insertar nueva suscripción (con país para segmentar campañas)
+        ip_address = real_client_ip(request.headers.get('X-Forwarded-For'), request.remote_addr)
+        values = (endpoint, p256dh, auth, request.headers.get('User-Agent', ''), ip_address, geoip.country(ip_address))
         if is_postgresql:
             cursor.execute('''
-                INSERT INTO push_subs (endpoint, p256dh, auth) 
-                VALUES (%s, %s, %s)
-            ''', (endpoint, p256dh, auth))
+                INSERT INTO push_subs (endpoint, p256dh, auth, user_agent, ip_address, country) 
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', values)
         else:
             cursor.execute('''
-                INSERT INTO push_subs (endpoint, p256dh, auth) 
-                VALUES (?, ?, ?)
-            ''', (endpoint, p256dh, auth))
+                INSERT INTO push_subs (endpoint, p256dh, auth, user_agent, ip_address, country) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', values)
         
         conn.commit()
         conn.close()
         
         return jsonify({'message': 'Suscrito correctamente'}), 200
-        
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/analytics/track', methods=['POST'])
-def track_event():
-    """Trackear eventos de analytics (clics, visitas, etc.)"""
+@app.route('/api/push/track', methods=['POST'])
+def push_track():
+    """
+    Registrar apertura/clic de una notificación (beacon desde sw.js)
+    Body: {"notification_id": 12, "event": "open" | "click"}
+    """
+    error = record_push_event(request.get_json(force=True, silent=True) or {})
+    if error:
+        return jsonify({'error': error}), 400
+    return '', 204
+
+@app.route('/api/push/stats', methods=['GET'])
+def push_stats():
+    """CTR por campaña de notificaciones push"""
     try:
-        data = request.json
-        event_type = data.get('event_type')  # 'click', 'page_view', 'scroll', etc.
-        
-        if not event_type:
-            return jsonify({'error': 'Tipo de evento requerido'}), 400
-        
-        # Obtener información del request
-        user_agent = request.headers.get('User-Agent', '')
-        ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
-        referrer = request.headers.get('Referer', '')
-        
-        # Extraer parámetros UTM de la URL
-        utm_source = request.args.get('utm_source', '')
-        utm_medium = request.args.get('utm_medium', '')
-        utm_campaign = request.args.get('utm_campaign', '')
-        
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # Detectar tipo de base de datos
-        db_url = os.getenv('DATABASE_URL')
-        is_postgresql = db_url and db_url.startswith('postgresql')
-        
-        if is_postgresql:
-            cursor.execute('''
-                INSERT INTO analytics (
-                    event_type, page_url, element_id, element_text,
-                    user_agent, ip_address, referrer,
-                    utm_source, utm_medium, utm_campaign,
-                    session_id, metadata
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                event_type,
-                data.get('page_url'),
-                data.get('element_id'),
-                data.get('element_text'),
-                user_agent,
-                ip_address,
-                referrer,
-                utm_source,
-                utm_medium,
-                utm_campaign,
-                data.get('session_id'),
-                json.dumps(data.get('metadata', {}))
-            ))
-        else:
-            # SQLite
-            cursor.execute('''
-                INSERT INTO analytics (
-                    event_type, page_url, element_id, element_text,
-                    user_agent, ip_address, referrer,
-                    utm_source, utm_medium, utm_campaign,
-                    session_id, metadata
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                event_type,
-                data.get('page_url'),
-                data.get('element_id'),
-                data.get('element_text'),
-                user_agent,
-                ip_address,
-                referrer,
-                utm_source,
-                utm_medium,
-                utm_campaign,
-                data.get('session_id'),
-                json.dumps(data.get('metadata', {}))
-            ))
-        
-        conn.commit()
+
+        cursor.execute('''
+            SELECT id, title, sent_count, opened_count, clicked_count, sent_at
+            FROM notifications
+            ORDER BY created_at DESC
+            LIMIT 50
+        ''')
+
+        campaigns = []
+        for row in cursor.fetchall():
+            sent, opened, clicked = row[2] or 0, row[3] or 0, row[4] or 0
+            campaigns.append({
+                'id': row[0],
+                'title': row[1],
+                'sent': sent,
+                'opened': opened,
+                'clicked': clicked,
+                'open_rate': round(opened / sent, 4) if sent else 0,
+                'ctr': round(clicked / opened, 4) if opened else 0,
+                'sent_at': row[5].isoformat() if hasattr(row[5], 'isoformat') else row[5]
+            })
+
         conn.close()
+        return jsonify({'notifications': campaigns}), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/track', methods=['POST'])
+def track_event():
+    """Trackear eventos de analytics (clics, visitas, etc.)"""
+    try:
+        error = record_analytics_event(
+            request.json,
+            request.args,
+            user_agent=request.headers.get('User-Agent', ''),
+            ip_address=request.headers.get('X-Forwarded-For', request.remote_addr),
+            referrer=request.headers.get('Referer', '')
+        )
+        if error:
+            return jsonify({'error': error}), 400
         
         return jsonify({'status': 'success'}), 200
         
@@ -476,7 +3887,7 @@ def get_analytics_stats():
                     COUNT(CASE WHEN event_type = 'page_view' THEN 1 END) as page_views,
                     COUNT(CASE WHEN event_type = 'click' THEN 1 END) as clicks,
                     COUNT(CASE WHEN timestamp >= CURRENT_DATE THEN 1 END) as events_today
-                FROM analytics
+                FROM analytics_facts
             ''')
         else:
             cursor.execute('''
@@ -486,30 +3897,41 @@ def get_analytics_stats():
                     COUNT(CASE WHEN event_type = 'page_view' THEN 1 END) as page_views,
                     COUNT(CASE WHEN event_type = 'click' THEN 1 END) as clicks,
                     COUNT(CASE WHEN DATE(timestamp) = DATE('now') THEN 1 END) as events_today
-                FROM analytics
+                FROM analytics_facts
             ''')
         
         general_stats = cursor.fetchone()
         
-        # Páginas más visitadas
+        # Páginas más visitadas (GROUP BY sobre la clave entera, el texto se une al final)
         cursor.execute('''
-            SELECT page_url, COUNT(*) as visits
-            FROM analytics 
-            WHERE event_type = 'page_view' AND page_url IS NOT NULL
-            GROUP BY page_url
-            ORDER BY visits DESC
-            LIMIT 10
+            SELECT d.value, t.visits
+            FROM (
+                SELECT page_url_key, COUNT(*) as visits
+                FROM analytics_facts
+                WHERE event_type = 'page_view' AND page_url_key IS NOT NULL
+                GROUP BY page_url_key
+                ORDER BY visits DESC
+                LIMIT 10
+            ) t
+            JOIN analytics_dimensions d ON d.id = t.page_url_key
+            ORDER BY t.visits DESC
         ''')
         top_pages = [{'url': row[0], 'visits': row[1]} for row in cursor.fetchall()]
         
         # Elementos más clickeados
         cursor.execute('''
-            SELECT element_id, element_text, COUNT(*) as clicks
-            FROM analytics 
-            WHERE event_type = 'click' AND element_id IS NOT NULL
-            GROUP BY element_id, element_text
-            ORDER BY clicks DESC
-            LIMIT 10
+            SELECT de.value, dt.value, t.clicks
+            FROM (
+                SELECT element_id_key, element_text_key, COUNT(*) as clicks
+                FROM analytics_facts
+                WHERE event_type = 'click' AND element_id_key IS NOT NULL
+                GROUP BY element_id_key, element_text_key
+                ORDER BY clicks DESC
+                LIMIT 10
+            ) t
+            JOIN analytics_dimensions de ON de.id = t.element_id_key
+            LEFT JOIN analytics_dimensions dt ON dt.id = t.element_text_key
+            ORDER BY t.clicks DESC
         ''')
         top_clicks = [{'id': row[0], 'text': row[1], 'clicks': row[2]} for row in cursor.fetchall()]
         
@@ -517,7 +3939,7 @@ def get_analytics_stats():
         if is_postgresql:
             cursor.execute('''
                 SELECT DATE(timestamp) as date, COUNT(*) as events
-                FROM analytics 
+                FROM analytics_facts
                 WHERE timestamp >= CURRENT_DATE - INTERVAL '7 days'
                 GROUP BY DATE(timestamp)
                 ORDER BY date DESC
@@ -525,7 +3947,7 @@ def get_analytics_stats():
         else:
             cursor.execute('''
                 SELECT DATE(timestamp) as date, COUNT(*) as events
-                FROM analytics 
+                FROM analytics_facts
                 WHERE timestamp >= DATE('now', '-7 days')
                 GROUP BY DATE(timestamp)
                 ORDER BY date DESC
@@ -533,6 +3955,17 @@ def get_analytics_stats():
         
         daily_stats = [{'date': row[0].isoformat() if hasattr(row[0], 'isoformat') else str(row[0]), 'events': row[1]} for row in cursor.fetchall()]
         
+        # Países (resueltos por GeoIP al volcar los eventos)
+        cursor.execute('''
+            SELECT country, COUNT(*) as events, COUNT(DISTINCT session_id) as sessions
+            FROM analytics_facts
+            WHERE country IS NOT NULL
+            GROUP BY country
+            ORDER BY events DESC
+            LIMIT 20
+        ''')
+        top_countries = [{'country': row[0], 'events': row[1], 'sessions': row[2]} for row in cursor.fetchall()]
+        
         conn.close()
         
         return jsonify({
@@ -545,12 +3978,100 @@ def get_analytics_stats():
             },
             'top_pages': top_pages,
             'top_clicks': top_clicks,
+            'top_countries': top_countries,
             'daily_stats': daily_stats
         }), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/analytics/sessions', methods=['GET'])
+def get_analytics_sessions():
+    """Métricas de sesiones (?from=&to= YYYY-MM-DD incluidos, opcional utm_source y landing)"""
+    try:
+        date_to = datetime.strptime(request.args.get('to') or datetime.utcnow().strftime('%Y-%m-%d'), '%Y-%m-%d')
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from') else date_to - timedelta(days=6)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas: usar from=YYYY-MM-DD y to=YYYY-MM-DD'}), 400
+    if date_to < date_from:
+        return jsonify({'error': 'El rango está invertido'}), 400
+
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+        return jsonify(query_sessions(
+            date_from.strftime('%Y-%m-%d'), (date_to + timedelta(days=1)).strftime('%Y-%m-%d'),
+            utm_source=request.args.get('utm_source'), landing_page=request.args.get('landing'), limit=limit
+        )), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/funnel', methods=['GET'])
+def get_analytics_funnel():
+    """
+    Embudo visitas -> clics al checkout -> compras e ingresos por atribución.
+    ?from=&to= (YYYY-MM-DD, incluidos), ?group=utm_source,utm_campaign (por defecto las 4
+    dimensiones) y filtros exactos por utm_source, utm_medium, utm_campaign o src.
+    """
+    try:
+        date_to = datetime.strptime(request.args.get('to') or datetime.utcnow().strftime('%Y-%m-%d'), '%Y-%m-%d')
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from') else date_to - timedelta(days=29)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas: usar from=YYYY-MM-DD y to=YYYY-MM-DD'}), 400
+    if date_to < date_from:
+        return jsonify({'error': 'El rango está invertido'}), 400
+
+    group_by = tuple(name for name in request.args.get('group', ','.join(FUNNEL_DIMENSIONS)).split(',') if name)
+    if any(name not in FUNNEL_DIMENSIONS for name in group_by):
+        return jsonify({'error': f"group admite: {', '.join(FUNNEL_DIMENSIONS)}"}), 400
+    filters = {name: request.args[name] for name in FUNNEL_DIMENSIONS if name in request.args}
+
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+        return jsonify(query_funnel(
+            date_from.strftime('%Y-%m-%d'), (date_to + timedelta(days=1)).strftime('%Y-%m-%d'),
+            group_by=group_by, filters=filters, limit=limit
+        )), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/engagement', methods=['GET'])
+def get_analytics_engagement():
+    """Tiempo en página y profundidad de scroll (?from=&to= YYYY-MM-DD incluidos, ?pages=N)"""
+    try:
+        date_to = datetime.strptime(request.args.get('to') or datetime.utcnow().strftime('%Y-%m-%d'), '%Y-%m-%d')
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from') else date_to - timedelta(days=6)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas: usar from=YYYY-MM-DD y to=YYYY-MM-DD'}), 400
+    if date_to < date_from:
+        return jsonify({'error': 'El rango está invertido'}), 400
+
+    try:
+        page_limit = min(int(request.args.get('pages', 10)), 50)
+        return jsonify(engagement_metrics(
+            date_from.strftime('%Y-%m-%d'), (date_to + timedelta(days=1)).strftime('%Y-%m-%d'), page_limit
+        )), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/history', methods=['GET'])
+def get_analytics_history():
+    """Estadísticas de un rango de fechas (?from=YYYY-MM-DD&to=YYYY-MM-DD, ambos incluidos), archivo incluido"""
+    try:
+        date_from = datetime.strptime(request.args.get('from', ''), '%Y-%m-%d')
+        date_to = datetime.strptime(request.args.get('to') or datetime.utcnow().strftime('%Y-%m-%d'), '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas: usar from=YYYY-MM-DD y to=YYYY-MM-DD'}), 400
+    if date_to < date_from:
+        return jsonify({'error': 'El rango está invertido'}), 400
+
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+        return jsonify(query_analytics_history(
+            date_from.strftime('%Y-%m-%d'), (date_to + timedelta(days=1)).strftime('%Y-%m-%d'), limit
+        )), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/analytics/dashboard', methods=['GET'])
 def analytics_dashboard():
     """Dashboard de analytics - página HTML"""
@@ -685,38 +4206,68 @@ def analytics_dashboard():
 
 @app.route('/api/faq', methods=['GET'])
 def get_faq():
-    """Obtener FAQ basado en pregunta"""
+    """Obtener FAQ basado en pregunta (desde el índice en memoria)"""
     try:
-        question = request.args.get('q', '').lower()
+        question = request.args.get('q', '').strip()
         if not question:
             return jsonify({'error': 'Pregunta requerida'}), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Buscar coincidencias
-        cursor.execute('SELECT question, answer FROM faqs')
-        faqs = cursor.fetchall()
-        
-        # Buscar la mejor coincidencia
-        questions = [faq[0].lower() for faq in faqs]
-        matches = get_close_matches(question, questions, n=1, cutoff=0.6)
+        match = faq_index.match(question)
+        if match:
+            return jsonify(match), 200
         
-        if matches:
-            best_match = matches[0]
-            for faq in faqs:
-                if faq[0].lower() == best_match:
-                    return jsonify({
-                        'question': faq[0],
-                        'answer': faq[1]
-                    }), 200
-        
-        conn.close()
         return jsonify({'error': 'No se encontró respuesta'}), 404
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+HOTMART_EVENT_COLUMNS = (
+    'event_type, transaction_id, buyer_email, buyer_name, buyer_country, '
+    'product_name, product_price, currency, purchase_date, data'
+)
+
+def hotmart_insert_sql(is_postgresql):
+    """INSERT de un evento de Hotmart (reenvíos de la misma transacción lo actualizan)"""
+    if is_postgresql:
+        return f'''
+            INSERT INTO hotmart_events ({HOTMART_EVENT_COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (transaction_id) DO UPDATE SET
+                processed = FALSE,
+                data = EXCLUDED.data
+        '''
+    # SQLite - usar INSERT OR REPLACE
+    return f'INSERT OR REPLACE INTO hotmart_events ({HOTMART_EVENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+def hotmart_event_values(data):
+    """Valores para hotmart_insert_sql extraídos del payload del webhook"""
+    event_data = data.get('data', {})
+    buyer = event_data.get('buyer', {})
+    product = event_data.get('product', {})
+    transaction = event_data.get('transaction', {})
+    return (
+        data.get('event'),
+        transaction.get('transaction_id'),
+        buyer.get('email'),
+        buyer.get('name'),
+        buyer.get('country'),
+        product.get('name'),
+        product.get('price'),
+        transaction.get('currency', 'USD'),
+        transaction.get('purchase_date'),
+        json.dumps(data)
+    )
+
+def process_hotmart_event(data):
+    """Acciones posteriores a guardar el evento"""
+    if data.get('event') == 'PURCHASE_COMPLETE':
+        event_data = data.get('data', {})
+        buyer_email = event_data.get('buyer', {}).get('email')
+        product_name = event_data.get('product', {}).get('name')
+        if buyer_email:
+            print(f"✅ Nueva venta: {buyer_email} - {product_name}")
+            
+            # Aquí podrías enviar notificación push, email, etc.
+
 @app.route('/webhook/hotmart', methods=['POST'])
 def hotmart_webhook():
     """Webhook para eventos de Hotmart"""
@@ -725,76 +4276,16 @@ def hotmart_webhook():
         signature = request.headers.get('X-Hotmart-Hottok')
         
         data = request.json
-        event_type = data.get('event')
-        event_data = data.get('data', {})
         
         # Guardar evento en base de datos con datos estructurados
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # Detectar tipo de base de datos
-        db_url = os.getenv('DATABASE_URL')
-        is_postgresql = db_url and db_url.startswith('postgresql')
-        
-        # Extraer datos del comprador
-        buyer = event_data.get('buyer', {})
-        product = event_data.get('product', {})
-        transaction = event_data.get('transaction', {})
-        
-        if is_postgresql:
-            cursor.execute('''
-                INSERT INTO hotmart_events (
-                    event_type, transaction_id, buyer_email, buyer_name, 
-                    buyer_country, product_name, product_price, currency, 
-                    purchase_date, data
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (transaction_id) DO UPDATE SET
-                    processed = FALSE,
-                    data = EXCLUDED.data
-            ''', (
-                event_type,
-                transaction.get('transaction_id'),
-                buyer.get('email'),
-                buyer.get('name'),
-                buyer.get('country'),
-                product.get('name'),
-                product.get('price'),
-                transaction.get('currency', 'USD'),
-                transaction.get('purchase_date'),
-                json.dumps(data)
-            ))
-        else:
-            # SQLite - usar INSERT OR REPLACE
-            cursor.execute('''
-                INSERT OR REPLACE INTO hotmart_events (
-                    event_type, transaction_id, buyer_email, buyer_name, 
-                    buyer_country, product_name, product_price, currency, 
-                    purchase_date, data
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                event_type,
-                transaction.get('transaction_id'),
-                buyer.get('email'),
-                buyer.get('name'),
-                buyer.get('country'),
-                product.get('name'),
-                product.get('price'),
-                transaction.get('currency', 'USD'),
-                transaction.get('purchase_date'),
-                json.dumps(data)
-            ))
-        
+        cursor.execute(hotmart_insert_sql(is_postgresql_db()), hotmart_event_values(data))
         conn.commit()
         conn.close()
         
         # Procesar evento
-        if event_type == 'PURCHASE_COMPLETE':
-            buyer_email = buyer.get('email')
-            product_name = product.get('name')
-            if buyer_email:
-                print(f"✅ Nueva venta: {buyer_email} - {product_name}")
-                
-                # Aquí podrías enviar notificación push, email, etc.
+        process_hotmart_event(data)
         
         return jsonify({'status': 'success'}), 200
         
@@ -802,6 +4293,108 @@ def hotmart_webhook():
         print(f"❌ Error en webhook Hotmart: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    """Recibir updates del bot de Telegram (reemplaza al polling)"""
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_WEBHOOK_SECRET:
+        return jsonify({'error': 'Bot de Telegram no configurado'}), 404
+
+    # Verificar el secreto registrado con set_webhook
+    if not telegram_secret_ok(request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')):
+        print("❌ Webhook de Telegram con secreto inválido")
+        return jsonify({'error': 'Invalid secret token'}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'update_id' not in data:
+        return jsonify({'error': 'Update inválido'}), 400
+
+    try:
+        telegram_bot.process(data)
+    except Exception as e:
+        # Con un error Telegram reintenta el mismo update más tarde
+        print(f"❌ Error encolando update de Telegram: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    return '', 200
+
+# ============================================
+# RUTAS DEL CATÁLOGO
+# ============================================
+
+@app.route('/go/<slug>')
+def go_link(slug):
+    """Redirigir al link de compra registrando el clic (sin esperar a la base)"""
+    try:
+        target = outbound_click(
+            slug,
+            request.args,
+            user_agent=request.headers.get('User-Agent', ''),
+            ip_address=request.headers.get('X-Forwarded-For', request.remote_addr),
+            referrer=request.headers.get('Referer', '')
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if not target:
+        return jsonify({'error': 'Link no encontrado'}), 404
+
+    response = redirect(target, code=302)
+    # Cada clic tiene que llegar al servidor para contarse
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def catalog_response(payload, version):
+    """JSON con ETag de la versión del catálogo (304 si no cambió)"""
+    response = jsonify(payload)
+    response.set_etag(version)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/products', methods=['GET'])
+def get_products():
+    """Catálogo de productos activos (desde el snapshot en memoria)"""
+    try:
+        snapshot = catalog.get()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    category = request.args.get('category')
+    products = [p for p in snapshot['products'] if not category or p['category'] == category]
+
+    return catalog_response({
+        'version': snapshot['version'],
+        'total': len(products),
+        'products': [public_product(p) for p in products]
+    }, f"{snapshot['version']}-{category or 'all'}")
+
+@app.route('/api/products/<slug>', methods=['GET'])
+def get_product(slug):
+    """Un producto por slug"""
+    try:
+        product = catalog.product(slug)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if not product:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    return catalog_response(public_product(product), product['version'])
+
+@app.route('/api/products/<slug>/fragment', methods=['GET'])
+def get_product_fragment(slug):
+    """Tarjeta HTML del producto renderizada en el servidor"""
+    try:
+        product = catalog.product(slug)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    if not product:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+
+    response = app.response_class(catalog.fragment(product), mimetype='text/html')
+    response.set_etag(product['version'])
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 # ============================================
 # RUTAS DE ADMINISTRACIÓN
 # ============================================
@@ -828,6 +4421,8 @@ def get_stats():
         # Estadísticas de suscripciones
         cursor.execute('SELECT COUNT(*) FROM push_subs')
         total_subs = cursor.fetchone()[0]
+        cursor.execute(f'SELECT COUNT(*) FROM push_subs WHERE {ACTIVE_SUBS_FILTER}')
+        active_subs = cursor.fetchone()[0]
         
         # Estadísticas de FAQs
         cursor.execute('SELECT COUNT(*) FROM faqs')
@@ -843,7 +4438,23 @@ def get_stats():
                 'ventas_hoy': sales_stats[3] or 0
             },
             'suscripciones': total_subs,
-            'faqs': total_faqs
+            'suscripciones_activas': active_subs,
+            'faqs': total_faqs,
+            'productos': len(catalog.get()['products']),
+            'cache_paginas': page_cache.stats(),
+            'admision': admission.stats(),
+            'bots': {'descartados': dict(bot_traffic.totals), 'filtro': bot_filter.stats()},
+            'geoip': geoip.stats(),
+            'diccionario_analytics': analytics_dimensions.stats(),
+            'archivo_analytics': analytics_archive_stats(),
+            'sesiones': sessionizer.stats(),
+            'embudo': funnel_builder.stats(),
+            'engagement': engagement_cache.stats(),
+            'arranque': {
+                'total_ms': round(startup_report['total'] * 1000, 1) if startup_report['total'] is not None else None,
+                'fases_ms': {name: round(seconds * 1000, 1) for name, seconds in startup_report['phases']},
+                'migro': startup_report['migrated']
+            }
         }), 200
         
     except Exception as e:
@@ -892,6 +4503,85 @@ def not_found(e):
     """Página no encontrada - redirigir a inicio"""
     return redirect('/')
 
+# ============================================
+# ARRANQUE: PREFLIGHT Y PRECALENTADO
+# ============================================
+
+# Páginas que se piden una vez al arrancar (carga la cache HTML y las rutas de Flask)
+WARM_PATHS = ('/', '/ventas')
+
+# Desglose del último arranque: [(fase, segundos)]
+startup_report = {'phases': [], 'total': None, 'migrated': None}
+
+def stored_schema_version():
+    """Versión del esquema guardada en app_meta (None si la base es nueva)"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM app_meta WHERE key = 'schema_version'")
+        row = cursor.fetchone()
+        return row[0] if row else None
+    except Exception:
+        # Sin tabla app_meta: base nueva o anterior al versionado
+        return None
+    finally:
+        conn.close()
+
+def preflight():
+    """
+    Verificar la base con una sola conexión y correr init_db() solo si el
+    esquema cambió. Devuelve True si migró.
+    """
+    if stored_schema_version() == str(SCHEMA_VERSION):
+        print(f"✅ Esquema al día (versión {SCHEMA_VERSION}), sin migraciones")
+        return False
+    init_db()
+    return True
+
+def warm_pages():
+    """Pedir las páginas principales para cargar la cache HTML (br, gzip e identity)"""
+    with app.test_client() as client:
+        for path in WARM_PATHS:
+            for encoding in ('br', 'gzip', 'identity'):
+                client.get(path, headers={'Accept-Encoding': encoding})
+
+def startup(run_preflight=True):
+    """
+    Preparar el proceso antes del primer request: preflight de la base y
+    snapshots/caches cargados. Con gunicorn corre una vez en el master
+    (preload_app, ver gunicorn.conf.py) y los workers heredan todo al forkear.
+    """
+    started = time.perf_counter()
+    phases = [('imports', IMPORT_SECONDS)]
+
+    if run_preflight:
+        phase_started = time.perf_counter()
+        startup_report['migrated'] = preflight()
+        phases.append(('preflight', time.perf_counter() - phase_started))
+
+    # Una caché que no carga no frena el arranque: se reintenta en el primer request
+    for name, warm in (
+        ('catálogo', catalog.refresh),
+        ('faqs', faq_index.refresh),
+        ('manifest estático', load_static_manifest),
+        ('páginas', warm_pages),
+    ):
+        phase_started = time.perf_counter()
+        try:
+            warm()
+        except Exception as e:
+            print(f"⚠️  No se pudo precalentar {name}: {e}")
+        phases.append((name, time.perf_counter() - phase_started))
+
+    startup_report['phases'] = phases
+    startup_report['total'] = IMPORT_SECONDS + time.perf_counter() - started
+    print(f"⏱️  Arranque en {startup_report['total'] * 1000:.0f} ms: " +
+          ' | '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in phases))
+    return startup_report
+
+# Tiempo de importar este módulo (dependencias + definiciones)
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 # ============================================
 # MAIN
 # ============================================
@@ -902,58 +4592,85 @@ if __name__ == '__main__':
         init_db()
         sys.exit(0)
     
-    # Verificar conexión rápida a PostgreSQL
-    print("🔗 Verificando conexión a PostgreSQL...")
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        conn.close()
-        print("✅ Conexión a PostgreSQL exitosa")
-        
-        # Solo inicializar si es necesario
-        print("📊 Verificando si necesitamos inicializar tablas...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'push_subs')")
-        tables_exist = cursor.fetchone()[0]
-        conn.close()
-        
-        if not tables_exist:
-            print("📊 Inicializando base de datos PostgreSQL...")
-            init_db()
-            print("✅ Base de datos PostgreSQL inicializada correctamente")
-        else:
-            print("✅ Tablas ya existen, saltando inicialización")
-            
-    except Exception as e:
-        print(f"❌ Error conectando a PostgreSQL: {e}")
-        print("📊 Intentando inicializar base de datos...")
+    # Modo mantenimiento: python app.py --prune-subs
+    if len(sys.argv) > 1 and sys.argv[1] == '--prune-subs':
+        print("🧹 Podando suscripciones push vencidas...")
+        report = prune_stale_subscriptions()
+        print(f"   Activas antes: {report['active_before']}")
+        print(f"   Eliminadas: {report['removed']}")
+        print(f"   Marcadas como vencidas: {report['marked_stale']}")
+        print(f"✅ Activas ahora: {report['active_after']} (-{report['shrink_pct']}%)")
+        sys.exit(0)
+    
+    # Armado de sesiones pendiente: python app.py --sessionize
+    if len(sys.argv) > 1 and sys.argv[1] == '--sessionize':
+        print("🧩 Armando sesiones desde el checkpoint...")
+        processed = sessionizer.run(wait=True)
+        print(f"✅ Eventos procesados: {processed}")
+        sys.exit(0)
+    
+    # Embudo y atribución pendientes: python app.py --build-funnel
+    if len(sys.argv) > 1 and sys.argv[1] == '--build-funnel':
+        print("🔻 Actualizando embudo de conversión desde los checkpoints...")
+        # El embudo lee el primer contacto de sessions: primero las sesiones pendientes
+        sessionizer.run(wait=True)
+        processed = funnel_builder.run(wait=True)
+        print(f"✅ Filas procesadas: {processed}")
+        sys.exit(0)
+    
+    # Archivo en frío: python app.py --archive-analytics [días_a_conservar]
+    if len(sys.argv) > 1 and sys.argv[1] == '--archive-analytics':
+        keep_days = int(sys.argv[2]) if len(sys.argv) > 2 else ANALYTICS_ARCHIVE_AFTER_DAYS
+        print(f"🧊 Archivando analytics de más de {keep_days} días...")
         try:
-            init_db()
-            print("✅ Base de datos PostgreSQL inicializada correctamente")
-        except Exception as e2:
-            print(f"❌ Error crítico: {e2}")
+            report = archive_analytics(keep_days)
+        except RuntimeError as e:
+            print(f"❌ Error: {e}")
+            sys.exit(1)
+        if not report['rows']:
+            print(f"✅ Nada para archivar antes de {report['day_to']}")
+            sys.exit(0)
+        print(f"   Rango: {report['day_from']} -> {report['day_to']}")
+        print(f"   Eventos: {report['rows']}")
+        print(f"✅ Archivo: {report['path']} ({report['bytes'] / 1024:.1f} KB)")
+        sys.exit(0)
+    
+    # Difusión por Telegram: python app.py --broadcast "mensaje" | --broadcast-resume [id]
+    if len(sys.argv) > 1 and sys.argv[1] in ('--broadcast', '--broadcast-resume'):
+        if not TELEGRAM_BOT_TOKEN:
+            print("❌ Error: TELEGRAM_BOT_TOKEN no configurado en .env")
             sys.exit(1)
+        if sys.argv[1] == '--broadcast':
+            if len(sys.argv) < 3 or not sys.argv[2].strip():
+                print('❌ Uso: python app.py --broadcast "mensaje"')
+                sys.exit(1)
+            broadcast_id = create_broadcast(sys.argv[2])
+        else:
+            pending = load_broadcast(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+            if not pending:
+                print("✅ No hay difusiones pendientes")
+                sys.exit(0)
+            broadcast_id = pending['id']
+        report = asyncio.run(run_broadcast_standalone(broadcast_id))
+        print(f"   Enviados: {report['sent']} | Bloqueados: {report['blocked']} | Fallidos: {report['failed']}")
+        sys.exit(0)
+    
+    # Preflight (migraciones solo si cambió el esquema) y caches precargadas
+    try:
+        startup()
+    except Exception as e:
+        print(f"❌ Error crítico: {e}")
+        sys.exit(1)
     
     # Configuración para Railway
     port = int(os.environ.get('PORT', 5000))  # Railway usa puerto 5000 por defecto
     host = '0.0.0.0'  # Siempre escuchar en todas las interfaces
     debug = False  # Siempre modo producción en Railway
     
-    print(f"🌐 Configuración del servidor:")
-    print(f"   Host: {host}")
-    print(f"   Puerto: {port}")
-    print(f"   Debug: {debug}")
-    print(f"   Variable PORT: {os.environ.get('PORT', 'NO DEFINIDA')}")
-    print(f"   Todas las variables de entorno:")
-    for key, value in os.environ.items():
-        if 'PORT' in key or 'RAILWAY' in key:
-            print(f"     {key}: {value}")
-    
     # Levantar servidor
     print("🚀 Robot de Ventas Hotmart - Backend Flask")
-    print(f"📊 Base de datos: PostgreSQL")
+    print(f"🌐 Escuchando en {host}:{port} (debug: {debug})")
+    print(f"📊 Base de datos: {'PostgreSQL' if is_postgresql_db() else 'SQLite'}")
     print(f"🔐 Webhook secret: {'*' * len(HOTMART_SECRET)}")
     print("=" * 60)
     
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ASGI - Modo async del servidor web
+Las rutas de mucho tráfico y poco trabajo (beacons de analytics y push,
+/go/<slug>, /api/faq y los webhooks) se atienden en el event loop con
+drivers async (asyncpg para PostgreSQL, aiosqlite para SQLite); el resto
+de la app Flask se sirve igual que antes a través de asgiref (WsgiToAsgi).
+La lógica de negocio es la misma de app.py: acá solo cambia el transporte.
+
+Uso: uvicorn asgi:application --host 0.0.0.0 --port $PORT --workers 2
+"""
+
+import os
+import json
+import math
+import asyncio
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+
+try:
+    import asyncpg
+except ImportError:  # Solo hace falta con PostgreSQL
+    asyncpg = None
+
+try:
+    import aiosqlite
+except ImportError:  # Solo hace falta con SQLite
+    aiosqlite = None
+
+import app as web
+
+# Conexiones del pool de asyncpg por worker
+ASGI_DB_POOL_SIZE = int(os.getenv('ASGI_DB_POOL_SIZE', '5'))
+# Tope del body de los endpoints async (beacons y webhooks son chicos)
+ASGI_MAX_BODY = 1024 * 1024
+
+# ============================================
+# BASE DE DATOS ASYNC
+# ============================================
+
+def to_asyncpg_sql(sql):
+    """%s -> $1, $2... (asyncpg usa parámetros numerados)"""
+    parts = sql.split('%s')
+    return ''.join(part + (f'${i}' if i < len(parts) else '') for i, part in enumerate(parts, 1))
+
+async def init_asyncpg_connection(conn):
+    """Timestamps y decimales como texto: mismas filas que se le pasan a psycopg2"""
+    for type_name in ('timestamp', 'numeric'):
+        await conn.set_type_codec(type_name, encoder=str, decoder=str, schema='pg_catalog', format='text')
+
+class AsyncDatabase:
+    """
+    Misma base que get_db_connection() pero con drivers async.
+    Recibe SQL con el placeholder de sql_placeholder() (%s o ?).
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.conn = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        if web.is_postgresql_db():
+            if asyncpg is None:
+                raise RuntimeError('asyncpg no instalado (pip install asyncpg)')
+            self.pool = await asyncpg.create_pool(
+                os.getenv('DATABASE_URL'), min_size=1, max_size=ASGI_DB_POOL_SIZE, init=init_asyncpg_connection
+            )
+            print(f"🔗 Pool asyncpg listo ({ASGI_DB_POOL_SIZE} conexiones)")
+        else:
+            if aiosqlite is None:
+                raise RuntimeError('aiosqlite no instalado (pip install aiosqlite)')
+            self.conn = await aiosqlite.connect('robot.db')
+            print("🔗 Conectado a SQLite con aiosqlite")
+
+    async def execute(self, sql, params=()):
+        if self.pool is not None:
+            await self.pool.execute(to_asyncpg_sql(sql), *params)
+            return
+        # Una sola conexión SQLite: las escrituras se serializan
+        async with self.lock:
+            await self.conn.execute(sql, params)
+            await self.conn.commit()
+
+    async def executemany(self, sql, rows):
+        if self.pool is not None:
+            await self.pool.executemany(to_asyncpg_sql(sql), rows)
+            return
+        async with self.lock:
+            await self.conn.executemany(sql, rows)
+            await self.conn.commit()
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+        if self.conn is not None:
+            await self.conn.close()
+
+db = AsyncDatabase()
+
+# ============================================
+# REQUEST / RESPONSE
+# ============================================
+
+class Request:
+    """Lo mínimo de un request HTTP que usan los endpoints async"""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+
+    @property
+    def remote_addr(self):
+        client = self.scope.get('client')
+        return client[0] if client else ''
+
+    def header(self, name, default=''):
+        return self.headers.get(name.lower(), default)
+
+    async def body(self):
+        chunks = []
+        size = 0
+        while True:
+            message = await self.receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > ASGI_MAX_BODY:
+                raise ValueError('Body demasiado grande')
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def json(self):
+        """Body como JSON (None si no es JSON válido)"""
+        try:
+            return json.loads(await self.body() or b'null')
+        except ValueError:
+            return None
+
+async def send_response(send, status, body=b'', content_type='application/json', headers=()):
+    """Enviar una respuesta completa"""
+    raw_headers = [(b'content-length', str(len(body)).encode('latin-1'))]
+    if body:
+        raw_headers.append((b'content-type', content_type.encode('latin-1')))
+    raw_headers.extend((name.encode('latin-1'), value.encode('latin-1')) for name, value in headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, status, payload):
+    await send_response(send, status, json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                        'application/json; charset=utf-8')
+
+def client_ip(request):
+    """Misma IP que guarda la ruta WSGI (se resuelve la real al volcar)"""
+    return request.header('X-Forwarded-For', request.remote_addr)
+
+async def send_shed(send, status, retry_after):
+    """429/503 del control de admisión (mismo cuerpo que shed_response)"""
+    message = 'Demasiadas solicitudes' if status == 429 else 'Servidor sobrecargado, reintentá en unos segundos'
+    body = json.dumps({'error': message}, ensure_ascii=False).encode('utf-8')
+    await send_response(send, status, body, 'application/json; charset=utf-8',
+                        headers=[('retry-after', str(max(1, math.ceil(retry_after))))])
+
+# ============================================
+# ENDPOINTS ASYNC
+# ============================================
+
+async def track_event(request, send):
+    """POST /api/analytics/track"""
+    error = web.record_analytics_event(
+        await request.json(),
+        request.args,
+        user_agent=request.header('User-Agent'),
+        ip_address=client_ip(request),
+        referrer=request.header('Referer')
+    )
+    if error:
+        await send_json(send, 400, {'error': error})
+        return
+    await send_json(send, 200, {'status': 'success'})
+
+async def push_track(request, send):
+    """POST /api/push/track"""
+    data = await request.json()
+    error = web.record_push_event(data if isinstance(data, dict) else {})
+    if error:
+        await send_json(send, 400, {'error': error})
+        return
+    await send_response(send, 204)
+
+async def go_link(request, send, slug):
+    """GET /go/<slug>"""
+    target = web.outbound_click(
+        slug,
+        request.args,
+        user_agent=request.header('User-Agent'),
+        ip_address=client_ip(request),
+        referrer=request.header('Referer')
+    )
+    if not target:
+        await send_json(send, 404, {'error': 'Link no encontrado'})
+        return
+    # Cada clic tiene que llegar al servidor para contarse
+    await send_response(send, 302, headers=[('location', target), ('cache-control', 'no-store')])
+
+async def get_faq(request, send):
+    """GET /api/faq?q=..."""
+    question = request.args.get('q', '').strip()
+    if not question:
+        await send_json(send, 400, {'error': 'Pregunta requerida'})
+        return
+
+    match = web.faq_index.match(question)
+    if match:
+        await send_json(send, 200, match)
+        return
+    await send_json(send, 404, {'error': 'No se encontró respuesta'})
+
+async def hotmart_webhook(request, send):
+    """POST /webhook/hotmart"""
+    data = await request.json()
+    try:
+        await db.execute(web.hotmart_insert_sql(web.is_postgresql_db()), web.hotmart_event_values(data))
+        web.process_hotmart_event(data)
+    except Exception as e:
+        print(f"❌ Error en webhook Hotmart: {e}")
+        await send_json(send, 500, {'error': str(e)})
+        return
+    await send_json(send, 200, {'status': 'success'})
+
+async def telegram_webhook(request, send):
+    """POST /telegram/webhook"""
+    if not web.TELEGRAM_BOT_TOKEN or not web.TELEGRAM_WEBHOOK_SECRET:
+        await send_json(send, 404, {'error': 'Bot de Telegram no configurado'})
+        return
+
+    if not web.telegram_secret_ok(request.header('X-Telegram-Bot-Api-Secret-Token')):
+        print("❌ Webhook de Telegram con secreto inválido")
+        await send_json(send, 403, {'error': 'Invalid secret token'})
+        return
+
+    data = await request.json()
+    if not isinstance(data, dict) or 'update_id' not in data:
+        await send_json(send, 400, {'error': 'Update inválido'})
+        return
+
+    try:
+        # El bot tiene su propio loop en un hilo; encolar puede bloquear
+        await asyncio.to_thread(web.telegram_bot.process, data)
+    except Exception as e:
+        print(f"❌ Error encolando update de Telegram: {e}")
+        await send_json(send, 500, {'error': str(e)})
+        return
+    await send_response(send, 200)
+
+# (método, ruta) -> endpoint; /go/<slug> se resuelve por prefijo
+ROUTES = {
+    ('POST', '/api/analytics/track'): track_event,
+    ('POST', '/api/push/track'): push_track,
+    ('GET', '/api/faq'): get_faq,
+    ('POST', '/webhook/hotmart'): hotmart_webhook,
+    ('POST', '/telegram/webhook'): telegram_webhook,
+}
+
+def match_route(method, path):
+    """Endpoint async y argumentos, o (None, None) para delegar en Flask"""
+    endpoint = ROUTES.get((method, path))
+    if endpoint:
+        return endpoint, ()
+    if method in ('GET', 'HEAD') and path.startswith('/go/'):
+        slug = path[len('/go/'):]
+        if slug and '/' not in slug:
+            return go_link, (slug,)
+    return None, None
+
+# ============================================
+# TAREAS DE FONDO
+# ============================================
+
+async def flush_analytics():
+    """Volcar la cola de analytics con el driver async"""
+    buffer = web.analytics_buffer
+    # drain() resuelve países (GeoIP) y encode() el diccionario de strings
+    # con la conexión sync: fuera del event loop. El INSERT va por el driver async
+    rows = await asyncio.to_thread(buffer.drain)
+    if not rows:
+        return 0
+    try:
+        encoded = await asyncio.to_thread(buffer.encode, rows)
+        await db.executemany(buffer.insert_sql(web.sql_placeholder()), encoded)
+    except Exception as e:
+        print(f"❌ Error volcando eventos de analytics: {e}")
+        buffer.requeue(rows)
+        return 0
+    await asyncio.to_thread(buffer.after_flush)
+    return len(rows)
+
+async def analytics_flusher():
+    """Reemplaza al hilo de AnalyticsBuffer: programa los volcados desde el loop"""
+    buffer = web.analytics_buffer
+    while True:
+        # El wakeup es un threading.Event: se espera en un hilo
+        await asyncio.to_thread(buffer.wakeup.wait, buffer.flush_interval)
+        buffer.wakeup.clear()
+        await flush_analytics()
+
+async def snapshot_refresher():
+    """
+    Releer catálogo y FAQs en un hilo antes de que venzan: así un request
+    nunca paga en el event loop la consulta (sync) de un snapshot vencido.
+    """
+    interval = max(1.0, min(web.CATALOG_REFRESH_INTERVAL, web.FAQ_REFRESH_INTERVAL) / 2)
+    while True:
+        for refresh in (web.catalog.refresh, web.faq_index.refresh):
+            try:
+                await asyncio.to_thread(refresh)
+            except Exception as e:
+                print(f"❌ Error refrescando snapshot: {e}")
+        await asyncio.sleep(interval)
+
+# ============================================
+# APLICACIÓN ASGI
+# ============================================
+
+class Application:
+    """Endpoints async + la app Flask para todo lo demás"""
+
+    def __init__(self, flask_app):
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.tasks = []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http':
+            endpoint, args = match_route(scope['method'], scope['path'])
+            if endpoint:
+                request = Request(scope, receive)
+                name = web.admission.classify(scope['path']) if web.ADMISSION_ENABLED else None
+                if name:
+                    # Sin slot de base sync: acá la espera la maneja el pool de asyncpg
+                    ip = web.real_client_ip(request.header('X-Forwarded-For'), request.remote_addr)
+                    rejection = web.admission.admit(name, ip, use_db_slot=False)
+                    if rejection:
+                        await send_shed(send, *rejection)
+                        return
+                try:
+                    await endpoint(request, send, *args)
+                except Exception as e:
+                    await send_json(send, 500, {'error': str(e)})
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    print(f"❌ Error iniciando modo ASGI: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        # uvicorn no tiene preload: cada worker hace su preflight (una consulta
+        # si el esquema está al día) y carga sus caches antes de aceptar requests
+        await asyncio.to_thread(web.startup)
+        await db.connect()
+        # El volcado de analytics pasa a la tarea async (sin hilo propio)
+        web.analytics_buffer.autostart = False
+        self.tasks = [asyncio.create_task(analytics_flusher()), asyncio.create_task(snapshot_refresher())]
+        print("🚀 Modo ASGI listo")
+
+    async def shutdown(self):
+        web.analytics_buffer.wakeup.set()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        flushed = await flush_analytics()
+        if flushed:
+            print(f"✅ {flushed} eventos de analytics volcados al cerrar")
+        await db.close()
+
+application = Application(web.app)
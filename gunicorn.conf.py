@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Configuración de gunicorn (se lee sola desde el directorio del proyecto)
+
+preload_app: app.py se importa una sola vez en el master, el preflight de la
+base (migraciones) corre una vez y no por worker, y los workers heredan al
+forkear el catálogo, las FAQs y la cache de páginas ya cargados.
+
+gthread: cada worker atiende varios requests a la vez con hilos. Con workers
+sync (uno por vez) los slots de base y el carril reservado para webhooks del
+control de admisión (ver app.py) no tendrían nada que repartir.
+"""
+
+import os
+
+preload_app = True
+worker_class = 'gthread'
+# Hilos por worker: más que ADMISSION_DB_SLOTS para que la reserva de webhooks tenga efecto
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+def on_starting(server):
+    """Antes de crear los workers: preflight y caches (una vez por deploy)"""
+    import app
+    app.startup()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bench ASGI - Comparar el modo WSGI (gunicorn) con el ASGI (uvicorn)
+Levanta cada servidor con la misma cantidad de workers, lo inunda con
+beacons de analytics, clics en /go/<slug> y consultas a /api/faq con
+C requests concurrentes y reporta requests/s, latencia p50/p99 y errores.
+Usa la base configurada (DATABASE_URL o robot.db): los beacons quedan
+guardados en analytics, conviene correrlo contra una copia.
+
+Ambos servidores arrancan con ADMISSION_ENABLED=0: todos los requests salen
+de 127.0.0.1 y los buckets por IP del control de admisión responderían 429
+a casi todo, midiendo el rechazo y no el servidor.
+
+Uso: python scripts/bench_asgi.py [--workers 2] [--concurrency 200] [--requests 5000] [--slug SLUG]
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+ROOT_PATH = os.path.join(os.path.dirname(__file__), '..')
+STARTUP_TIMEOUT = 30
+# Sin control de admisión: un solo cliente local agotaría los buckets por IP
+SERVER_ENV = {'ADMISSION_ENABLED': '0'}
+# UA de navegador: el de httpx coincide con BOT_UA_RE y los beacons se descartarían
+CLIENT_HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36'}
+
+def free_port():
+    """Puerto TCP libre en localhost"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def server_command(mode, port, workers):
+    """Comando para levantar app.py en modo WSGI o ASGI"""
+    if mode == 'wsgi':
+        return [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+                '--log-level', 'warning', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(workers), '--log-level', 'warning', '--no-access-log']
+
+def wait_until_ready(port, process):
+    """Esperar a que el servidor acepte conexiones"""
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"El servidor terminó con código {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('El servidor no arrancó a tiempo')
+
+def build_requests(slug):
+    """Mezcla de requests: (método, ruta, body JSON)"""
+    beacon = {'event_type': 'click', 'page_url': '/', 'element_id': 'cta', 'session_id': 'bench'}
+    return [
+        ('POST', '/api/analytics/track?utm_source=bench', beacon),
+        ('GET', f'/go/{slug}?utm_source=bench&src=bench', None),
+        ('GET', '/api/faq?q=como+recibo+el+producto', None),
+    ]
+
+async def flood(base_url, requests, total, concurrency):
+    """Disparar `total` requests con `concurrency` en vuelo. Devuelve (latencias, errores, segundos)"""
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        # Un cliente (una conexión keep-alive) por worker: un pool compartido
+        # entre cientos de tareas se vuelve el cuello de botella del benchmark
+        limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30, headers=CLIENT_HEADERS) as client:
+            for i in counter:
+                method, path, body = requests[i % len(requests)]
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return latencies, errors, elapsed
+
+def percentile(values, pct):
+    """Percentil (nearest-rank) de una lista ordenada"""
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+def run_mode(mode, args):
+    """Levantar un servidor, calentar, medir y bajarlo"""
+    port = free_port()
+    env = dict(os.environ, **SERVER_ENV)
+    process = subprocess.Popen(server_command(mode, port, args.workers), cwd=ROOT_PATH, env=env)
+    try:
+        wait_until_ready(port, process)
+        base_url = f'http://127.0.0.1:{port}'
+        requests = build_requests(args.slug)
+        # Calentar: snapshots de catálogo y FAQs cargados en cada worker
+        asyncio.run(flood(base_url, requests, args.workers * 50, args.workers * 5))
+        latencies, errors, elapsed = asyncio.run(flood(base_url, requests, args.requests, args.concurrency))
+    finally:
+        process.terminate()
+        process.wait(timeout=15)
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'errors': errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Comparar WSGI (gunicorn) y ASGI (uvicorn)')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--slug', default='enciclopedia-plantas-medicinales')
+    parser.add_argument('--json', action='store_true', help='Imprimir resultados como JSON')
+    args = parser.parse_args()
+
+    print(f"🏁 Benchmark WSGI vs ASGI: {args.workers} workers, {args.concurrency} concurrentes, {args.requests} requests")
+    print("⚠️  Control de admisión desactivado en ambos servidores (ADMISSION_ENABLED=0)")
+    print("=" * 60)
+
+    results = []
+    for mode in ('wsgi', 'asgi'):
+        print(f"⏱️  Midiendo {mode.upper()}...")
+        results.append(run_mode(mode, args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("=" * 60)
+    for result in results:
+        print(f"   {result['mode'].upper()}: {result['rps']:.0f} req/s | p50 {result['p50_ms']:.1f} ms | "
+              f"p99 {result['p99_ms']:.1f} ms | errores {result['errors']}")
+    wsgi, asgi = results
+    print(f"📊 ASGI/WSGI: x{asgi['rps'] / wsgi['rps']:.2f} req/s, p99 x{asgi['p99_ms'] / wsgi['p99_ms']:.2f}")
+
+if __name__ == '__main__':
+    main()
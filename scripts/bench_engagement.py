@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bench Engagement - Métricas de engagement con NumPy vs Python puro
+Genera N eventos sintéticos de scroll y time_on_page (mismas filas que
+devuelve la consulta de /api/analytics/engagement), los procesa en chunks
+con compute_engagement() de app.py y con el loop equivalente en Python
+puro, verifica que den lo mismo y compara tiempos.
+Con --db mide además la ruta completa (consulta + cálculo) contra la base
+configurada (DATABASE_URL o robot.db).
+
+Uso: python scripts/bench_engagement.py [--events 2000000] [--sessions 200000] [--pages 50] [--db DESDE HASTA]
+"""
+
+import os
+import sys
+import time
+import math
+import argparse
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+
+CHUNK_SIZE = app.ENGAGEMENT_CHUNK_SIZE
+SEED = 42
+
+def synthetic_chunks(events, sessions, pages):
+    """Chunks de filas (page_url_key, session_id, es_scroll, valor) como los de la base"""
+    rng = numpy.random.default_rng(SEED)
+    page_keys = rng.integers(1, pages + 1, events)
+    session_ids = rng.integers(0, sessions, events)
+    is_scroll = rng.random(events) < 0.6
+    # time_on_page: latidos cada 30s; scroll: porcentaje 0-100
+    values = numpy.where(is_scroll, rng.integers(0, 101, events), rng.integers(1, 40, events) * 30).astype(float)
+    values[rng.random(events) < 0.01] = -1  # metadata sin número (COALESCE de la consulta)
+
+    rows = list(zip(
+        page_keys.tolist(),
+        [f'session_{session}' for session in session_ids.tolist()],
+        is_scroll.astype(int).tolist(),
+        values.tolist()
+    ))
+    return [rows[start:start + CHUNK_SIZE] for start in range(0, events, CHUNK_SIZE)]
+
+def python_percentile(values, pct):
+    """Percentil con interpolación lineal (el mismo método que numpy.percentile)"""
+    position = (len(values) - 1) * pct / 100
+    low = math.floor(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+def python_engagement(chunks, page_limit):
+    """Las mismas métricas que compute_engagement() con dicts y loops"""
+    time_visits = {}
+    scroll_visits = {}
+    events = 0
+    for rows in chunks:
+        for page, session, is_scroll, value in rows:
+            events += 1
+            if value < 0:
+                continue
+            visits = scroll_visits if is_scroll else time_visits
+            key = (session, page)
+            if key not in visits or value > visits[key]:
+                visits[key] = value
+
+    times = sorted(time_visits.values())
+    scrolls = [min(max(value, 0), 100) for value in scroll_visits.values()]
+    histogram = [0] * (len(app.SCROLL_HISTOGRAM_BINS) - 1)
+    for value in scrolls:
+        histogram[min(int(value // 10), len(histogram) - 1)] += 1
+
+    per_page = {}
+    for (_, page), value in time_visits.items():
+        per_page.setdefault(page, [[], []])[0].append(value)
+    for (_, page), value in scroll_visits.items():
+        per_page.setdefault(page, [[], []])[1].append(min(max(value, 0), 100))
+    top_pages = sorted(per_page.items(), key=lambda item: (-(len(item[1][0]) + len(item[1][1])), item[0]))[:page_limit]
+
+    return {
+        'events': events,
+        'time_on_page': {f'p{pct}': round(python_percentile(times, pct), 1) for pct in app.ENGAGEMENT_PERCENTILES},
+        'histogram': histogram,
+        'pages': [(page, round(python_percentile(sorted(page_times), 50), 1)) for page, (page_times, _) in top_pages],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Métricas de engagement: NumPy vs Python puro')
+    parser.add_argument('--events', type=int, default=2000000)
+    parser.add_argument('--sessions', type=int, default=200000)
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--db', nargs=2, metavar=('DESDE', 'HASTA'), help='Medir también contra la base (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    print(f"🏁 Engagement: {args.events} eventos, {args.sessions} sesiones, {args.pages} páginas")
+    print("=" * 60)
+
+    print("⏳ Generando eventos sintéticos...")
+    chunks = synthetic_chunks(args.events, args.sessions, args.pages)
+
+    started = time.perf_counter()
+    result = app.compute_engagement(app.engagement_arrays(chunks))
+    numpy_seconds = time.perf_counter() - started
+    print(f"⏱️  NumPy: {numpy_seconds:.2f}s")
+
+    started = time.perf_counter()
+    expected = python_engagement(chunks, 10)
+    python_seconds = time.perf_counter() - started
+    print(f"⏱️  Python puro: {python_seconds:.2f}s")
+
+    same = (
+        result['events'] == expected['events']
+        and all(result['time_on_page'][name] == value for name, value in expected['time_on_page'].items())
+        and [bucket['visits'] for bucket in result['scroll_depth']['histogram']] == expected['histogram']
+        and [(page['page_key'], page['time_on_page']['p50']) for page in result['pages']] == expected['pages']
+    )
+    print(f"{'✅' if same else '❌'} Mismos resultados: p50/p90/p99 "
+          f"{result['time_on_page']['p50']}/{result['time_on_page']['p90']}/{result['time_on_page']['p99']} s")
+
+    if args.db:
+        date_to = (app.datetime.strptime(args.db[1], '%Y-%m-%d') + app.timedelta(days=1)).strftime('%Y-%m-%d')
+        metrics = app.engagement_metrics(args.db[0], date_to)
+        print(f"🗄️  Base: {metrics['events']} eventos | carga {metrics['load_ms']:.0f} ms | cálculo {metrics['compute_ms']:.0f} ms")
+
+    print("=" * 60)
+    print(f"📊 NumPy x{python_seconds / numpy_seconds:.1f} más rápido ({args.events / numpy_seconds / 1e6:.1f} M eventos/s)")
+
+if __name__ == '__main__':
+    main()
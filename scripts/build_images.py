@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build Images - Variantes responsive de /site/assets
+Crea /site/assets/responsive/<imagen>-<ancho>w.(avif|webp|jpg),
+reescribe los <img> del HTML de /site con <picture>, srcset/sizes y
+lazy loading, y reporta los bytes ahorrados por página.
+
+Cache incremental en scripts/image-variants.json: solo se reprocesan
+imágenes cuyo contenido (o configuración) cambió.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+from PIL import Image, ImageOps, features
+
+SITE_PATH = os.path.join(os.path.dirname(__file__), '..', 'site')
+ASSETS_PATH = os.path.join(SITE_PATH, 'assets')
+OUTPUT_PATH = os.path.join(ASSETS_PATH, 'responsive')
+CACHE_PATH = os.path.join(os.path.dirname(__file__), 'image-variants.json')
+
+SOURCE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+# Formato de variante que puede reemplazarse por una copia del original
+SOURCE_FORMATS = {'.jpg': 'jpg', '.jpeg': 'jpg'}
+WIDTHS = [320, 640, 960, 1280]
+# Formatos en orden de preferencia para <source>; JPEG queda como fallback del <img>
+FORMATS = {
+    'avif': {'pillow': 'AVIF', 'mime': 'image/avif', 'options': {'quality': 55}},
+    'webp': {'pillow': 'WEBP', 'mime': 'image/webp', 'options': {'quality': 78, 'method': 6}},
+    'jpg': {'pillow': 'JPEG', 'mime': 'image/jpeg', 'options': {'quality': 80, 'optimize': True, 'progressive': True}},
+}
+
+# Ancho en CSS de cada clase de imagen (ver estilos de index.html)
+SIZES_BY_CLASS = {
+    'hero-image': '(max-width: 900px) calc(100vw - 40px), 860px',
+    'section-image': '(max-width: 900px) calc(100vw - 40px), 860px',
+    'book-image': '200px',
+}
+DEFAULT_SIZES = '100vw'
+
+# Dispositivo de referencia para el reporte: móvil de 360px con DPR 2
+REPORT_VIEWPORT = 360
+REPORT_DPR = 2
+REPORT_CSS_WIDTH_BY_CLASS = {'book-image': 200}
+
+# Atributos que genera este script (se regeneran en cada corrida)
+GENERATED_ATTRS = {'srcset', 'sizes', 'width', 'height', 'loading', 'decoding', 'fetchpriority', 'data-responsive'}
+
+PICTURE_RE = re.compile(r'<picture data-responsive>\s*(?:<source\b[^>]*>\s*)*(<img\b[^>]*>)\s*</picture>')
+IMG_RE = re.compile(r'<img\b[^>]*>')
+ATTR_RE = re.compile(r'([\w-]+)(?:\s*=\s*"([^"]*)")?')
+
+def enabled_formats():
+    """AVIF depende de cómo se compiló Pillow"""
+    return [name for name in FORMATS if name != 'avif' or features.check('avif')]
+
+def settings_signature():
+    """Cambia si cambian anchos/formatos/calidad: invalida toda la cache"""
+    settings = {
+        'widths': WIDTHS,
+        'formats': {name: FORMATS[name]['options'] for name in enabled_formats()},
+        'keep_smaller_original': True,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def file_hash(path):
+    """Hash SHA-256 del archivo"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_cache():
+    """Cargar cache incremental (vacía si no existe o cambió la configuración)"""
+    if not os.path.exists(CACHE_PATH):
+        return {}
+    with open(CACHE_PATH, 'r', encoding='utf-8') as f:
+        cache = json.load(f)
+    if cache.get('settings') != settings_signature():
+        print("♻️  Configuración cambiada: se regeneran todas las variantes")
+        return {}
+    return cache.get('images', {})
+
+def save_cache(images):
+    """Guardar cache con dimensiones y variantes de cada imagen"""
+    with open(CACHE_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'settings': settings_signature(), 'images': images}, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+def variants_exist(entry):
+    """Verificar que los archivos de la cache siguen en disco"""
+    return all(os.path.exists(os.path.join(SITE_PATH, variant['path'])) for variant in entry['variants'])
+
+def process_image(rel_path):
+    """Generar todas las variantes (formato x ancho) de una imagen"""
+    source_path = os.path.join(SITE_PATH, rel_path)
+    stem, extension = os.path.splitext(os.path.basename(rel_path))
+    source_format = SOURCE_FORMATS.get(extension.lower())
+    source_bytes = os.path.getsize(source_path)
+
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        width, height = image.size
+
+        # Nunca agrandar: anchos menores al original + el original mismo
+        widths = sorted({w for w in WIDTHS if w < width} | {min(width, max(WIDTHS))})
+
+        variants = []
+        for target_width in widths:
+            target_height = round(height * target_width / width)
+            resized = image if target_width == width else image.resize((target_width, target_height), Image.LANCZOS)
+
+            for name in enabled_formats():
+                fmt = FORMATS[name]
+                frame = resized.convert('RGB') if name == 'jpg' and resized.mode != 'RGB' else resized
+                out_rel = f"assets/responsive/{stem}-{target_width}w.{name}"
+                out_path = os.path.join(SITE_PATH, out_rel)
+                frame.save(out_path, fmt['pillow'], **fmt['options'])
+                # Re-codificar a ancho completo puede engordar el archivo: queda el original
+                if target_width == width and name == source_format and os.path.getsize(out_path) >= source_bytes:
+                    shutil.copyfile(source_path, out_path)
+                variants.append({
+                    'path': out_rel,
+                    'format': name,
+                    'width': target_width,
+                    'height': target_height,
+                    'bytes': os.path.getsize(out_path),
+                })
+
+    return {
+        'hash': file_hash(source_path),
+        'width': width,
+        'height': height,
+        'bytes': source_bytes,
+        'variants': variants,
+    }
+
+def build_variants():
+    """Procesar /site/assets de forma incremental. Devuelve la cache actualizada"""
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    cache = load_cache()
+    images = {}
+
+    for filename in sorted(os.listdir(ASSETS_PATH)):
+        if os.path.splitext(filename)[1].lower() not in SOURCE_EXTENSIONS:
+            continue
+        rel_path = f"assets/{filename}"
+        cached = cache.get(rel_path)
+
+        if cached and cached['hash'] == file_hash(os.path.join(SITE_PATH, rel_path)) and variants_exist(cached):
+            images[rel_path] = cached
+            print(f"⏭️  Sin cambios: {rel_path}")
+            continue
+
+        images[rel_path] = process_image(rel_path)
+        print(f"✅ Procesada: {rel_path} ({len(images[rel_path]['variants'])} variantes)")
+
+    # Borrar variantes huérfanas (imagen eliminada o anchos que ya no se generan)
+    keep = {variant['path'] for entry in images.values() for variant in entry['variants']}
+    for filename in os.listdir(OUTPUT_PATH):
+        if f"assets/responsive/{filename}" not in keep:
+            os.remove(os.path.join(OUTPUT_PATH, filename))
+            print(f"🗑️  Eliminada variante huérfana: {filename}")
+
+    save_cache(images)
+    return images
+
+def parse_attrs(tag):
+    """<img a="1" b> -> [('a', '1'), ('b', None)] respetando el orden"""
+    inner = tag[len('<img'):-1].rstrip('/')
+    return [(match.group(1), match.group(2)) for match in ATTR_RE.finditer(inner)]
+
+def render_attrs(attrs):
+    """[('a', '1'), ('b', None)] -> ' a="1" b'"""
+    return ''.join(f' {name}="{value}"' if value is not None else f' {name}' for name, value in attrs)
+
+def srcset_for(entry, fmt):
+    """srcset de un formato ordenado por ancho"""
+    return ', '.join(f"/{v['path']} {v['width']}w" for v in entry['variants'] if v['format'] == fmt)
+
+def responsive_img(tag, images, is_first):
+    """Convertir un <img> de /assets en <picture> con variantes"""
+    attrs = [(name, value) for name, value in parse_attrs(tag) if name not in GENERATED_ATTRS]
+    src = dict(attrs).get('src') or ''
+    rel_path = src.lstrip('/')
+
+    if rel_path not in images:
+        return tag, None
+
+    entry = images[rel_path]
+    css_class = (dict(attrs).get('class') or '').split()
+    sizes = next((SIZES_BY_CLASS[c] for c in css_class if c in SIZES_BY_CLASS), DEFAULT_SIZES)
+
+    # La primera imagen suele ser el LCP: no diferirla
+    loading = [('loading', 'eager'), ('fetchpriority', 'high')] if is_first else [('loading', 'lazy')]
+    img_attrs = attrs + [
+        ('srcset', srcset_for(entry, 'jpg')),
+        ('sizes', sizes),
+        ('width', str(entry['width'])),
+        ('height', str(entry['height'])),
+    ] + loading + [('decoding', 'async'), ('data-responsive', None)]
+
+    sources = ''.join(
+        f'<source type="{FORMATS[fmt]["mime"]}" srcset="{srcset_for(entry, fmt)}" sizes="{sizes}">'
+        for fmt in enabled_formats() if fmt != 'jpg'
+    )
+    return f'<picture data-responsive>{sources}<img{render_attrs(img_attrs)}></picture>', (entry, css_class)
+
+def mobile_bytes(entry, css_class):
+    """Bytes que descarga el móvil de referencia con el mejor formato disponible"""
+    css_width = next((REPORT_CSS_WIDTH_BY_CLASS[c] for c in css_class if c in REPORT_CSS_WIDTH_BY_CLASS), REPORT_VIEWPORT)
+    needed = css_width * REPORT_DPR
+    widths = sorted({v['width'] for v in entry['variants']})
+    chosen = next((w for w in widths if w >= needed), widths[-1])
+    return min(v['bytes'] for v in entry['variants'] if v['width'] == chosen)
+
+def rewrite_html(images):
+    """Reescribir los <img> de cada HTML de /site y reportar ahorro por página"""
+    report = []
+
+    for dirpath, dirnames, filenames in os.walk(SITE_PATH):
+        dirnames[:] = sorted(d for d in dirnames if d not in ('dist', 'assets'))
+        for filename in sorted(filenames):
+            if not filename.endswith('.html'):
+                continue
+            path = os.path.join(dirpath, filename)
+            with open(path, 'r', encoding='utf-8') as f:
+                html = f.read()
+
+            # Deshacer el <picture> generado en corridas anteriores
+            plain = PICTURE_RE.sub(lambda m: m.group(1), html)
+
+            found = []
+            def replace(match):
+                new_tag, info = responsive_img(match.group(0), images, is_first=not found)
+                if info:
+                    found.append(info)
+                return new_tag
+
+            rewritten = IMG_RE.sub(replace, plain)
+            if not found:
+                continue
+
+            if rewritten != html:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(rewritten)
+
+            original = sum(entry['bytes'] for entry, _ in found)
+            optimized = sum(mobile_bytes(entry, css_class) for entry, css_class in found)
+            report.append((os.path.relpath(path, SITE_PATH), len(found), original, optimized))
+
+    return report
+
+def main():
+    """Generar variantes y reescribir HTML"""
+
+    print("🖼️  Generando variantes responsive de imágenes...")
+    print("=" * 60)
+
+    if 'avif' not in enabled_formats():
+        print("⚠️  Pillow sin soporte AVIF: solo se generan WebP y JPEG")
+
+    images = build_variants()
+    report = rewrite_html(images)
+
+    print("=" * 60)
+    print(f"📊 Ahorro por página (móvil {REPORT_VIEWPORT}px @{REPORT_DPR}x):")
+    for page, count, original, optimized in report:
+        saved = original - optimized
+        pct = 100 * saved / original if original else 0
+        print(f"   {page}: {count} imágenes, {original // 1024} KB -> {optimized // 1024} KB (-{saved // 1024} KB, -{pct:.0f}%)")
+    print(f"🗂️  Cache: {CACHE_PATH}")
+
+if __name__ == '__main__':
+    main()
@@ -2,253 +2,271 @@
 # -*- coding: utf-8 -*-
 """
 Build Pages - Generador de páginas SEO desde CSV
-Crea /site/<slug>/index.html y /site/sitemap.xml
+Crea /site/<slug>/index.html, /site/sitemap.xml (índice) y
+/site/sitemap-N.xml.gz
+
+Incremental: un manifest con el hash de cada página evita reescribir
+las que no cambiaron (no se tocan mtimes ni se invalida la CDN). Si una
+fila publicada queda inválida se mantiene la última versión buena.
+Streaming: CSV -> validación -> render -> disco/sitemap con memoria
+acotada, para cientos de miles de filas en un contenedor chico.
 """
 
 import os
+import re
 import csv
+import gzip
+import json
+import time
+import filecmp
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from html import escape
+from xml.sax.saxutils import escape as xml_escape
+from urllib.parse import quote, urlencode
 from dotenv import load_dotenv
 
 load_dotenv()
 
 BASE_URL = os.getenv('BASE_URL_PUBLICA', 'https://tusitio.com')
-HOTLINK_BASE = os.getenv('HOTMART_HOTLINK_BASE', 'https://go.hotmart.com/H102540942W')
+# Los CTA pasan por /go/<slug> de app.py, que registra el clic y redirige a Hotmart
+PRODUCT_SLUG = os.getenv('HOTMART_PRODUCT_SLUG', 'enciclopedia-plantas-medicinales')
 CSV_PATH = os.path.join(os.path.dirname(__file__), 'pages.csv')
 SITE_PATH = os.path.join(os.path.dirname(__file__), '..', 'site')
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), '.pages-manifest.db')
+# Manifest JSON de versiones anteriores: se importa una vez y se borra
+LEGACY_MANIFEST_PATH = os.path.join(os.path.dirname(__file__), '.pages-manifest.json')
 
-def create_page_html(row):
-    """
-    Generar HTML de página de producto con JSON-LD
-    
-    IMPORTANTE: Cada página debe aportar VALOR ÚNICO.
-    Evitar "scaled content abuse" (contenido escalado sin valor).
-    Cada página debe resolver una intención de búsqueda específica.
-    """
-    
-    # Extraer precio del benefits o poner genérico
-    precio = "49.00"  # Puedes extraer del CSV si agregas columna "precio"
-    
-    html = f"""<!DOCTYPE html>
+# Procesos para renderizar; con pocas filas no compensa levantar el pool
+BUILD_WORKERS = int(os.getenv('BUILD_WORKERS', os.cpu_count() or 1))
+PARALLEL_MIN_ROWS = 200
+# Filas por tarea del pool y frecuencia del reporte de progreso
+RENDER_BATCH_SIZE = 64
+PROGRESS_EVERY = 10000
+# Límites de salida por consola (el resto se resume)
+MAX_REPORTED_PAGES = 50
+MAX_REPORTED_ERRORS = 20
+
+REQUIRED_COLUMNS = ['slug', 'title', 'h1', 'desc', 'benefits', 'faq_q1', 'faq_a1', 'faq_q2', 'faq_a2']
+SLUG_RE = re.compile(r'^[a-z0-9]+(?:-[a-z0-9]+)*$')
+
+# ============================================
+# HOJA DE ESTILOS COMPARTIDA
+# ============================================
+# Una sola hoja para todas las páginas: se descarga una vez y queda en cache
+PAGE_CSS = """
+* { margin: 0; padding: 0; box-sizing: border-box; }
+body {
+  font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+  line-height: 1.6;
+  color: #333;
+  background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+  min-height: 100vh;
+  padding: 20px;
+}
+.container {
+  max-width: 900px;
+  margin: 0 auto;
+  background: white;
+  border-radius: 16px;
+  box-shadow: 0 20px 60px rgba(0,0,0,0.3);
+  overflow: hidden;
+}
+header {
+  background: linear-gradient(135deg, #4f46e5 0%, #7c3aed 100%);
+  color: white;
+  padding: 50px 40px;
+  text-align: center;
+}
+header h1 {
+  font-size: 2.5em;
+  margin-bottom: 15px;
+  line-height: 1.2;
+}
+header p {
+  font-size: 1.2em;
+  opacity: 0.9;
+}
+section {
+  padding: 50px 40px;
+}
+h2 {
+  color: #4f46e5;
+  margin-bottom: 25px;
+  font-size: 2em;
+}
+.benefits {
+  list-style: none;
+  padding: 0;
+}
+.benefits li {
+  padding: 15px 20px;
+  margin: 10px 0;
+  background: #f0fdf4;
+  border-left: 4px solid #10b981;
+  border-radius: 8px;
+  font-size: 1.1em;
+}
+.benefits li:before {
+  content: "✅ ";
+  margin-right: 10px;
+}
+.cta {
+  text-align: center;
+  padding: 60px 40px;
+  background: linear-gradient(135deg, #fef3c7 0%, #fde68a 100%);
+}
+.cta h2 {
+  color: #92400e;
+  margin-bottom: 20px;
+}
+.cta-note {
+  margin-top: 20px;
+  color: #92400e;
+}
+.btn-comprar {
+  display: inline-block;
+  padding: 20px 50px;
+  background: #10b981;
+  color: white;
+  text-decoration: none;
+  border-radius: 12px;
+  font-size: 1.5em;
+  font-weight: bold;
+  box-shadow: 0 8px 24px rgba(16, 185, 129, 0.4);
+  transition: all 0.3s;
+}
+.btn-comprar:hover {
+  background: #059669;
+  transform: translateY(-3px);
+  box-shadow: 0 12px 32px rgba(16, 185, 129, 0.5);
+}
+.faq {
+  background: #f9fafb;
+  padding: 50px 40px;
+}
+.faq-item {
+  background: white;
+  padding: 25px;
+  margin: 20px 0;
+  border-radius: 8px;
+  box-shadow: 0 2px 8px rgba(0,0,0,0.05);
+}
+.faq-item h3 {
+  color: #4f46e5;
+  margin-bottom: 10px;
+  font-size: 1.3em;
+}
+.faq-item p {
+  color: #555;
+  font-size: 1.05em;
+}
+footer {
+  background: #1f2937;
+  color: white;
+  padding: 30px;
+  text-align: center;
+}
+footer a {
+  color: #60a5fa;
+  text-decoration: none;
+}
+.footer-copy {
+  margin-top: 15px;
+}
+"""
+
+def minify_css(css):
+    """Quitar comentarios y espacios sobrantes"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{}:;,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+def minify_html(html):
+    """Quitar comentarios, indentación y espacios entre etiquetas"""
+    html = re.sub(r'<!--.*?-->', '', html, flags=re.S)
+    html = re.sub(r'\s*\n\s*', ' ', html)
+    html = re.sub(r'>\s+<', '><', html)
+    return html.strip()
+
+STYLESHEET_CSS = minify_css(PAGE_CSS)
+STYLESHEET_NAME = f"pages.{hashlib.sha256(STYLESHEET_CSS.encode('utf-8')).hexdigest()[:10]}.css"
+STYLESHEET_DIR = os.path.join(SITE_PATH, 'css')
+
+def write_stylesheet():
+    """Escribir /site/css/pages.<hash>.css y borrar versiones anteriores"""
+    os.makedirs(STYLESHEET_DIR, exist_ok=True)
+    path = os.path.join(STYLESHEET_DIR, STYLESHEET_NAME)
+    written = write_if_changed(path, STYLESHEET_CSS)
+    for filename in os.listdir(STYLESHEET_DIR):
+        if filename.startswith('pages.') and filename.endswith('.css') and filename != STYLESHEET_NAME:
+            os.remove(os.path.join(STYLESHEET_DIR, filename))
+    return written
+
+# ============================================
+# TEMPLATE PRECOMPILADO
+# ============================================
+# Los {{campo}} se reemplazan por valores ya escapados
+PAGE_TEMPLATE = """<!DOCTYPE html>
 <html lang="es">
 <head>
   <meta charset="UTF-8">
   <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <meta name="description" content="{row['desc']}">
+  <meta name="description" content="{{desc}}">
   <meta name="robots" content="index, follow">
-  <title>{row['title']}</title>
+  <title>{{title}}</title>
   
   <!-- Open Graph -->
-  <meta property="og:title" content="{row['title']}">
-  <meta property="og:description" content="{row['desc']}">
+  <meta property="og:title" content="{{title}}">
+  <meta property="og:description" content="{{desc}}">
   <meta property="og:type" content="product">
-  <meta property="og:url" content="{BASE_URL}/{row['slug']}/">
+  <meta property="og:url" content="{{url}}">
+  
+  <link rel="stylesheet" href="/css/{{stylesheet}}">
   
   <!-- JSON-LD Product Schema -->
-  <script type="application/ld+json">
-  {{
-    "@context": "https://schema.org/",
-    "@type": "Product",
-    "name": "{row['h1']}",
-    "description": "{row['desc']}",
-    "brand": {{
-      "@type": "Brand",
-      "name": "Robot de Ventas"
-    }},
-    "offers": {{
-      "@type": "Offer",
-      "url": "{BASE_URL}/{row['slug']}/",
-      "priceCurrency": "USD",
-      "price": "{precio}",
-      "priceValidUntil": "2026-12-31",
-      "availability": "https://schema.org/InStock"
-    }},
-    "aggregateRating": {{
-      "@type": "AggregateRating",
-      "ratingValue": "4.8",
-      "reviewCount": "127"
-    }}
-  }}
-  </script>
+  <script type="application/ld+json">{{product_jsonld}}</script>
   
   <!-- FAQ Schema -->
-  <script type="application/ld+json">
-  {{
-    "@context": "https://schema.org",
-    "@type": "FAQPage",
-    "mainEntity": [
-      {{
-        "@type": "Question",
-        "name": "{row['faq_q1']}",
-        "acceptedAnswer": {{
-          "@type": "Answer",
-          "text": "{row['faq_a1']}"
-        }}
-      }},
-      {{
-        "@type": "Question",
-        "name": "{row['faq_q2']}",
-        "acceptedAnswer": {{
-          "@type": "Answer",
-          "text": "{row['faq_a2']}"
-        }}
-      }}
-    ]
-  }}
-  </script>
-
-  <style>
-    * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-    body {{
-      font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-      line-height: 1.6;
-      color: #333;
-      background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-      min-height: 100vh;
-      padding: 20px;
-    }}
-    .container {{
-      max-width: 900px;
-      margin: 0 auto;
-      background: white;
-      border-radius: 16px;
-      box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-      overflow: hidden;
-    }}
-    header {{
-      background: linear-gradient(135deg, #4f46e5 0%, #7c3aed 100%);
-      color: white;
-      padding: 50px 40px;
-      text-align: center;
-    }}
-    header h1 {{
-      font-size: 2.5em;
-      margin-bottom: 15px;
-      line-height: 1.2;
-    }}
-    header p {{
-      font-size: 1.2em;
-      opacity: 0.9;
-    }}
-    section {{
-      padding: 50px 40px;
-    }}
-    h2 {{
-      color: #4f46e5;
-      margin-bottom: 25px;
-      font-size: 2em;
-    }}
-    .benefits {{
-      list-style: none;
-      padding: 0;
-    }}
-    .benefits li {{
-      padding: 15px 20px;
-      margin: 10px 0;
-      background: #f0fdf4;
-      border-left: 4px solid #10b981;
-      border-radius: 8px;
-      font-size: 1.1em;
-    }}
-    .benefits li:before {{
-      content: "✅ ";
-      margin-right: 10px;
-    }}
-    .cta {{
-      text-align: center;
-      padding: 60px 40px;
-      background: linear-gradient(135deg, #fef3c7 0%, #fde68a 100%);
-    }}
-    .cta h2 {{
-      color: #92400e;
-      margin-bottom: 20px;
-    }}
-    .btn-comprar {{
-      display: inline-block;
-      padding: 20px 50px;
-      background: #10b981;
-      color: white;
-      text-decoration: none;
-      border-radius: 12px;
-      font-size: 1.5em;
-      font-weight: bold;
-      box-shadow: 0 8px 24px rgba(16, 185, 129, 0.4);
-      transition: all 0.3s;
-    }}
-    .btn-comprar:hover {{
-      background: #059669;
-      transform: translateY(-3px);
-      box-shadow: 0 12px 32px rgba(16, 185, 129, 0.5);
-    }}
-    .faq {{
-      background: #f9fafb;
-      padding: 50px 40px;
-    }}
-    .faq-item {{
-      background: white;
-      padding: 25px;
-      margin: 20px 0;
-      border-radius: 8px;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-    }}
-    .faq-item h3 {{
-      color: #4f46e5;
-      margin-bottom: 10px;
-      font-size: 1.3em;
-    }}
-    .faq-item p {{
-      color: #555;
-      font-size: 1.05em;
-    }}
-    footer {{
-      background: #1f2937;
-      color: white;
-      padding: 30px;
-      text-align: center;
-    }}
-    footer a {{
-      color: #60a5fa;
-      text-decoration: none;
-    }}
-  </style>
+  <script type="application/ld+json">{{faq_jsonld}}</script>
 </head>
 <body>
   <div class="container">
     <header>
-      <h1>{row['h1']}</h1>
-      <p>{row['desc']}</p>
+      <h1>{{h1}}</h1>
+      <p>{{desc}}</p>
     </header>
 
     <section>
       <h2>🎯 Qué vas a lograr</h2>
       <ul class="benefits">
-        {''.join(f'<li>{benefit.strip()}</li>' for benefit in row['benefits'].split('|'))}
+        {{benefits}}
       </ul>
     </section>
 
     <div class="cta">
       <h2>🚀 Comenzá hoy mismo</h2>
-      <a href="{HOTLINK_BASE}?utm_source=seo&utm_medium=organic&utm_campaign=robot&src={row['slug']}" 
-         class="btn-comprar" 
-         target="_blank">
-        💳 Comprar ahora
-      </a>
-      <p style="margin-top: 20px; color: #92400e;">
-        ✅ Garantía de 7 días | 🔒 Pago seguro vía Hotmart
-      </p>
+      <a href="{{hotlink}}" class="btn-comprar" target="_blank">💳 Comprar ahora</a>
+      <p class="cta-note">✅ Garantía de 7 días | 🔒 Pago seguro vía Hotmart</p>
     </div>
 
     <section class="faq">
       <h2>❓ Preguntas Frecuentes</h2>
       
       <div class="faq-item">
-        <h3>{row['faq_q1']}</h3>
-        <p>{row['faq_a1']}</p>
+        <h3>{{faq_q1}}</h3>
+        <p>{{faq_a1}}</p>
       </div>
 
       <div class="faq-item">
-        <h3>{row['faq_q2']}</h3>
-        <p>{row['faq_a2']}</p>
+        <h3>{{faq_q2}}</h3>
+        <p>{{faq_a2}}</p>
       </div>
 
       <div class="faq-item">
@@ -259,85 +277,540 @@ def create_page_html(row):
 
     <footer>
       <p><a href="/">← Volver al inicio</a></p>
-      <p style="margin-top: 15px;">&copy; 2025 Robot de Ventas. Todos los derechos reservados.</p>
+      <p class="footer-copy">&copy; 2025 Robot de Ventas. Todos los derechos reservados.</p>
     </footer>
   </div>
 </body>
 </html>
 """
-    return html
 
-def generate_sitemap(slugs):
-    """Generar sitemap.xml con todas las URLs"""
+def compile_template(template):
+    """
+    Partir el template una sola vez en [literal, campo, literal, campo, ...]
+    (ya minificado), así renderizar es solo un join de strings.
+    """
+    parts = re.split(r'\{\{(\w+)\}\}', minify_html(template))
+    return parts[0::2], parts[1::2]
+
+def render_template(compiled, context):
+    """Renderizar un template compilado con valores ya escapados"""
+    literals, fields = compiled
+    out = [literals[0]]
+    for field, literal in zip(fields, literals[1:]):
+        out.append(context[field])
+        out.append(literal)
+    return ''.join(out)
+
+COMPILED_PAGE_TEMPLATE = compile_template(PAGE_TEMPLATE)
+
+def escape_jsonld(data):
+    """JSON seguro dentro de <script>: sin '</script>' ni '<!--' posibles"""
+    text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return text.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+def create_page_html(row):
+    """
+    Generar HTML de página de producto con JSON-LD
+    
+    IMPORTANTE: Cada página debe aportar VALOR ÚNICO.
+    Evitar "scaled content abuse" (contenido escalado sin valor).
+    Cada página debe resolver una intención de búsqueda específica.
+    """
     
-    now = datetime.now().strftime('%Y-%m-%d')
+    # Extraer precio del benefits o poner genérico
+    precio = "49.00"  # Puedes extraer del CSV si agregas columna "precio"
     
-    urls = [f"""  <url>
-    <loc>{BASE_URL}/</loc>
-    <lastmod>{now}</lastmod>
-    <changefreq>weekly</changefreq>
-    <priority>1.0</priority>
-  </url>"""]
+    page_url = f"{BASE_URL}/{quote(row['slug'])}/"
+    hotlink = f"/go/{PRODUCT_SLUG}?" + urlencode({
+        'utm_source': 'seo',
+        'utm_medium': 'organic',
+        'utm_campaign': 'robot',
+        'src': row['slug'],
+    })
     
-    for slug in slugs:
-        urls.append(f"""  <url>
-    <loc>{BASE_URL}/{slug}/</loc>
-    <lastmod>{now}</lastmod>
-    <changefreq>monthly</changefreq>
-    <priority>0.8</priority>
-  </url>""")
+    product_schema = {
+        "@context": "https://schema.org/",
+        "@type": "Product",
+        "name": row['h1'],
+        "description": row['desc'],
+        "brand": {"@type": "Brand", "name": "Robot de Ventas"},
+        "offers": {
+            "@type": "Offer",
+            "url": page_url,
+            "priceCurrency": "USD",
+            "price": precio,
+            "priceValidUntil": "2026-12-31",
+            "availability": "https://schema.org/InStock"
+        },
+        "aggregateRating": {"@type": "AggregateRating", "ratingValue": "4.8", "reviewCount": "127"}
+    }
     
-    sitemap = f"""<?xml version="1.0" encoding="UTF-8"?>
-<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
-{chr(10).join(urls)}
-</urlset>
-"""
+    faq_schema = {
+        "@context": "https://schema.org",
+        "@type": "FAQPage",
+        "mainEntity": [
+            {"@type": "Question", "name": row[q], "acceptedAnswer": {"@type": "Answer", "text": row[a]}}
+            for q, a in (('faq_q1', 'faq_a1'), ('faq_q2', 'faq_a2'))
+        ]
+    }
+    
+    benefits = ''.join(
+        f'<li>{escape(benefit.strip())}</li>'
+        for benefit in row['benefits'].split('|') if benefit.strip()
+    )
     
-    return sitemap
+    return render_template(COMPILED_PAGE_TEMPLATE, {
+        'title': escape(row['title']),
+        'desc': escape(row['desc']),
+        'h1': escape(row['h1']),
+        'url': escape(page_url),
+        'stylesheet': STYLESHEET_NAME,
+        'product_jsonld': escape_jsonld(product_schema),
+        'faq_jsonld': escape_jsonld(faq_schema),
+        'benefits': benefits,
+        'hotlink': escape(hotlink),
+        'faq_q1': escape(row['faq_q1']),
+        'faq_a1': escape(row['faq_a1']),
+        'faq_q2': escape(row['faq_q2']),
+        'faq_a2': escape(row['faq_a2']),
+    })
+
+# ============================================
+# SITEMAP (índice + shards comprimidos)
+# ============================================
+# Límites del protocolo: 50.000 URLs y 50 MB sin comprimir por archivo
+SITEMAP_MAX_URLS = 50000
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+SITEMAP_SHARD_RE = re.compile(r'^sitemap-(\d+)\.xml\.gz$')
+SITEMAP_URLSET_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+)
+SITEMAP_URLSET_FOOTER = '</urlset>\n'
+
+class SitemapWriter:
+    """
+    Escribe URLs en streaming a /site/sitemap-N.xml.gz (rotando al llegar a
+    los límites) y al cerrar genera el índice /site/sitemap.xml.
+
+    Los shards idénticos a los ya publicados no se reemplazan, así su
+    mtime no cambia.
+    """
+
+    def __init__(self, site_path, base_url, max_urls=SITEMAP_MAX_URLS, max_bytes=SITEMAP_MAX_BYTES):
+        self.site_path = site_path
+        self.base_url = base_url
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self.shards = []  # [(nombre, lastmod más reciente)]
+        self.changed = 0
+        self.total_urls = 0
+        self.raw = None
+        self.gz = None
+
+    def add(self, loc, lastmod, changefreq, priority):
+        """Agregar una URL al shard actual"""
+        entry = (
+            f"  <url>\n"
+            f"    <loc>{xml_escape(loc)}</loc>\n"
+            f"    <lastmod>{lastmod}</lastmod>\n"
+            f"    <changefreq>{changefreq}</changefreq>\n"
+            f"    <priority>{priority}</priority>\n"
+            f"  </url>\n"
+        ).encode('utf-8')
+
+        if self.gz is None or self.count >= self.max_urls or \
+                self.bytes + len(entry) + len(SITEMAP_URLSET_FOOTER) > self.max_bytes:
+            self._close_shard()
+            self._open_shard()
+
+        self.gz.write(entry)
+        self.count += 1
+        self.bytes += len(entry)
+        self.total_urls += 1
+        self.lastmod = max(self.lastmod, lastmod)
+
+    def _open_shard(self):
+        os.makedirs(self.site_path, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=self.site_path, prefix='.tmp-sitemap-')
+        self.raw = os.fdopen(fd, 'wb')
+        # mtime=0 y sin nombre: mismo contenido -> mismos bytes
+        self.gz = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, compresslevel=6, mtime=0)
+        header = SITEMAP_URLSET_HEADER.encode('utf-8')
+        self.gz.write(header)
+        self.count = 0
+        self.bytes = len(header)
+        self.lastmod = ''
+
+    def _close_shard(self):
+        if self.gz is None:
+            return
+        self.gz.write(SITEMAP_URLSET_FOOTER.encode('utf-8'))
+        self.gz.close()
+        self.raw.close()
+        self.gz = self.raw = None
+
+        name = f"sitemap-{len(self.shards) + 1}.xml.gz"
+        path = os.path.join(self.site_path, name)
+        if os.path.exists(path) and filecmp.cmp(self.tmp_path, path, shallow=False):
+            os.remove(self.tmp_path)
+        else:
+            os.chmod(self.tmp_path, 0o644)
+            os.replace(self.tmp_path, path)
+            self.changed += 1
+        self.shards.append((name, self.lastmod))
+
+    def abort(self):
+        """Descartar el shard a medio escribir (si hubo un error)"""
+        if self.gz is None:
+            return
+        self.gz.close()
+        self.raw.close()
+        self.gz = self.raw = None
+        os.remove(self.tmp_path)
+
+    def close(self):
+        """Cerrar el último shard, escribir el índice y borrar shards sobrantes"""
+        self._close_shard()
+
+        entries = ''.join(
+            f"  <sitemap>\n"
+            f"    <loc>{xml_escape(self.base_url)}/{name}</loc>\n"
+            f"    <lastmod>{lastmod}</lastmod>\n"
+            f"  </sitemap>\n"
+            for name, lastmod in self.shards
+        )
+        index = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+            f"{entries}"
+            '</sitemapindex>\n'
+        )
+        if write_if_changed(os.path.join(self.site_path, 'sitemap.xml'), index):
+            self.changed += 1
+
+        for filename in os.listdir(self.site_path):
+            match = SITEMAP_SHARD_RE.match(filename)
+            if match and int(match.group(1)) > len(self.shards):
+                os.remove(os.path.join(self.site_path, filename))
+                self.changed += 1
+
+        return self.changed
+
+def home_lastmod():
+    """lastmod de la home: fecha de modificación de /site/index.html"""
+    home_path = os.path.join(SITE_PATH, 'index.html')
+    if os.path.exists(home_path):
+        return datetime.fromtimestamp(os.path.getmtime(home_path)).strftime('%Y-%m-%d')
+    return datetime.now().strftime('%Y-%m-%d')
+
+def atomic_write(path, content):
+    """Escribir en un temporal del mismo directorio y renombrar (nunca queda a medias)"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def content_hash(content):
+    """Hash SHA-256 del HTML renderizado"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+# ============================================
+# MANIFEST (SQLite: memoria constante con cientos de miles de páginas)
+# ============================================
+
+def open_manifest():
+    """
+    Abrir el manifest de páginas: slug -> hash, lastmod y build en que se vio.
+    Devuelve (conexión, id del build actual).
+    """
+    conn = sqlite3.connect(MANIFEST_PATH)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pages (
+            slug TEXT PRIMARY KEY,
+            hash TEXT,
+            lastmod TEXT,
+            build_id INTEGER
+        )
+    """)
+    # Slugs vistos en este build (detección de duplicados sin un set en memoria)
+    conn.execute('CREATE TEMP TABLE seen (slug TEXT PRIMARY KEY)')
+    import_legacy_manifest(conn)
+    build_id = conn.execute('SELECT COALESCE(MAX(build_id), 0) + 1 FROM pages').fetchone()[0]
+    return conn, build_id
+
+def import_legacy_manifest(conn):
+    """
+    Pasar el manifest JSON ({'pages': {slug: {'hash', 'lastmod'}}}) a SQLite.
+    Sin esto sus páginas quedarían huérfanas: nunca se compararían ni se
+    borrarían al desaparecer del CSV.
+    """
+    if not os.path.exists(LEGACY_MANIFEST_PATH):
+        return 0
+    with open(LEGACY_MANIFEST_PATH, 'r', encoding='utf-8') as f:
+        pages = json.load(f).get('pages', {})
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    conn.executemany(
+        'INSERT OR IGNORE INTO pages (slug, hash, lastmod, build_id) VALUES (?, ?, ?, 0)',
+        [(slug, page.get('hash'), page.get('lastmod') or today) for slug, page in pages.items()]
+    )
+    conn.commit()
+    os.remove(LEGACY_MANIFEST_PATH)
+    print(f"📦 Manifest JSON importado: {len(pages)} páginas")
+    return len(pages)
+
+def keep_previous(conn, slug, build_id):
+    """
+    Mantener publicada la última versión buena de un slug cuya fila quedó
+    inválida. Devuelve su lastmod, o None si no había página que mantener.
+    """
+    if not SLUG_RE.match(slug) or not os.path.exists(os.path.join(SITE_PATH, slug, 'index.html')):
+        return None
+    row = conn.execute('SELECT lastmod FROM pages WHERE slug = ?', (slug,)).fetchone()
+    # Solo la primera aparición del slug (una fila duplicada no mantiene nada)
+    if row is None or conn.execute('INSERT OR IGNORE INTO seen (slug) VALUES (?)', (slug,)).rowcount == 0:
+        return None
+    conn.execute('UPDATE pages SET build_id = ? WHERE slug = ?', (build_id, slug))
+    return row[0]
+
+def lookup_previous(conn, slugs):
+    """Hash y lastmod previos de un lote de slugs"""
+    marks = ', '.join('?' * len(slugs))
+    rows = conn.execute(f'SELECT slug, hash, lastmod FROM pages WHERE slug IN ({marks})', slugs)
+    return {slug: (digest, lastmod) for slug, digest, lastmod in rows}
+
+# ============================================
+# PIPELINE: CSV -> validación -> render -> disco + sitemap
+# ============================================
+
+class RowError(ValueError):
+    """Fila del CSV que no se puede publicar"""
+
+def missing_columns(csv_path):
+    """Columnas requeridas que no están en el encabezado del CSV"""
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        header = next(csv.reader(f), [])
+    return [column for column in REQUIRED_COLUMNS if column not in header]
+
+def iter_rows(csv_path):
+    """Leer el CSV fila por fila (nunca completo en memoria)"""
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+def validate_row(row, conn):
+    """Validar una fila; lanza RowError con el motivo"""
+    slug = (row.get('slug') or '').strip()
+    if not SLUG_RE.match(slug):
+        raise RowError(f"slug inválido: {slug!r}")
+
+    empty = [column for column in REQUIRED_COLUMNS if not (row.get(column) or '').strip()]
+    if empty:
+        raise RowError(f"{slug}: columnas vacías: {', '.join(empty)}")
+
+    if any(not benefit.strip() for benefit in row['benefits'].split('|')):
+        raise RowError(f"{slug}: lista de beneficios mal formada (elemento vacío en {row['benefits']!r})")
+
+    if conn.execute('INSERT OR IGNORE INTO seen (slug) VALUES (?)', (slug,)).rowcount == 0:
+        raise RowError(f"{slug}: slug duplicado")
+
+    row['slug'] = slug
+    return row
+
+def iter_batches(items, size):
+    """Agrupar un iterable en listas de hasta size elementos"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def render_job(job):
+    """
+    Renderizar una fila y escribirla solo si su HTML cambió.
+    Corre dentro del pool de procesos.
+
+    Returns:
+        tuple: (slug, hash, escrita)
+    """
+    row, previous_hash = job
+    slug = row['slug']
+    html = create_page_html(row)
+    digest = content_hash(html)
+    html_path = os.path.join(SITE_PATH, slug, 'index.html')
+
+    if digest == previous_hash and os.path.exists(html_path):
+        return slug, digest, False
+
+    atomic_write(html_path, html)
+    return slug, digest, True
+
+def render_batch(jobs):
+    """Lote de render_job (menos overhead de IPC que una fila por tarea)"""
+    return [render_job(job) for job in jobs]
+
+def bounded_map(pool, fn, batches, window):
+    """
+    Como pool.map pero con a lo sumo `window` lotes en vuelo y sin leer
+    toda la entrada por adelantado: memoria acotada y resultados en orden.
+    Sin pool corre en el proceso actual.
+    """
+    if pool is None:
+        for batch in batches:
+            yield fn(batch)
+        return
+
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.submit(fn, batch))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def remove_page(slug):
+    """Eliminar /site/<slug>/index.html (y el directorio si queda vacío)"""
+    page_dir = os.path.join(SITE_PATH, slug)
+    html_path = os.path.join(page_dir, 'index.html')
+    if os.path.exists(html_path):
+        os.remove(html_path)
+    if os.path.isdir(page_dir) and not os.listdir(page_dir):
+        shutil.rmtree(page_dir)
+
+def write_if_changed(path, content):
+    """Escribir solo si el contenido difiere del que ya está en disco"""
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    atomic_write(path, content)
+    return True
 
 def main():
-    """Generar todas las páginas desde CSV"""
-    
+    """Generar las páginas que cambiaron desde el CSV (streaming, memoria acotada)"""
+
     if not os.path.exists(CSV_PATH):
         print(f"❌ Error: No se encontró {CSV_PATH}")
         return
-    
+
     print("🚀 Generando páginas SEO desde CSV...")
     print("=" * 60)
-    
-    slugs = []
-    
-    with open(CSV_PATH, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        
-        for row in reader:
-            slug = row['slug']
-            slugs.append(slug)
-            
-            # Crear directorio del slug
-            page_dir = os.path.join(SITE_PATH, slug)
-            os.makedirs(page_dir, exist_ok=True)
-            
-            # Generar HTML
-            html = create_page_html(row)
-            
-            # Guardar index.html
-            html_path = os.path.join(page_dir, 'index.html')
-            with open(html_path, 'w', encoding='utf-8') as html_file:
-                html_file.write(html)
-            
-            print(f"✅ Creada: {slug}/index.html")
-    
-    # Generar sitemap.xml
-    sitemap = generate_sitemap(slugs)
-    sitemap_path = os.path.join(SITE_PATH, 'sitemap.xml')
-    
-    with open(sitemap_path, 'w', encoding='utf-8') as sitemap_file:
-        sitemap_file.write(sitemap)
-    
-    print(f"✅ Creado: sitemap.xml")
+
+    missing = missing_columns(CSV_PATH)
+    if missing:
+        print(f"❌ Error: faltan columnas en {os.path.basename(CSV_PATH)}: {', '.join(missing)}")
+        return
+
+    started = time.monotonic()
+    today = datetime.now().strftime('%Y-%m-%d')
+    stats = {'rows': 0, 'written': 0, 'unchanged': 0, 'invalid': 0, 'kept': 0, 'removed': 0}
+    errors = []
+
+    conn, build_id = open_manifest()
+
+    def valid_rows():
+        """Filas válidas; las inválidas se cuentan y se reportan al final"""
+        for line_number, row in iter_rows(CSV_PATH):
+            stats['rows'] += 1
+            try:
+                yield validate_row(row, conn)
+            except RowError as e:
+                stats['invalid'] += 1
+                message = f"línea {line_number}: {e}"
+                slug = (row.get('slug') or '').strip()
+                lastmod = keep_previous(conn, slug, build_id)
+                if lastmod:
+                    stats['kept'] += 1
+                    sitemap.add(f"{BASE_URL}/{quote(slug)}/", lastmod, 'monthly', '0.8')
+                    message += " (se mantiene la versión publicada)"
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(message)
+
+    def jobs():
+        """Lotes de (fila, hash previo) leyendo el estado previo de SQLite"""
+        for batch in iter_batches(valid_rows(), RENDER_BATCH_SIZE):
+            previous = lookup_previous(conn, [row['slug'] for row in batch])
+            yield [(row, previous.get(row['slug'], (None, None))[0]) for row in batch]
+
+    # El pool solo se levanta si el CSV es grande (estimado por tamaño: ~1 KB por fila)
+    workers = BUILD_WORKERS if os.path.getsize(CSV_PATH) >= PARALLEL_MIN_ROWS * 1024 else 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    sitemap = SitemapWriter(SITE_PATH, BASE_URL)
+    sitemap.add(f"{BASE_URL}/", home_lastmod(), 'weekly', '1.0')
+    next_progress = PROGRESS_EVERY
+
+    try:
+        for results in bounded_map(pool, render_batch, jobs(), window=workers * 2):
+            previous = lookup_previous(conn, [slug for slug, _, _ in results])
+            updates = []
+            for slug, digest, changed in results:
+                previous_hash, previous_lastmod = previous.get(slug, (None, None))
+                # Historial de hashes: lastmod solo avanza si el contenido cambió
+                lastmod = previous_lastmod if previous_hash == digest and previous_lastmod else today
+                updates.append((slug, digest, lastmod, build_id))
+                sitemap.add(f"{BASE_URL}/{quote(slug)}/", lastmod, 'monthly', '0.8')
+
+                if changed:
+                    stats['written'] += 1
+                    if stats['written'] <= MAX_REPORTED_PAGES:
+                        print(f"✅ Actualizada: {slug}/index.html")
+                else:
+                    stats['unchanged'] += 1
+
+            conn.executemany('INSERT OR REPLACE INTO pages (slug, hash, lastmod, build_id) VALUES (?, ?, ?, ?)', updates)
+            conn.commit()
+
+            if stats['rows'] >= next_progress:
+                next_progress += PROGRESS_EVERY
+                print(f"⏱️  {stats['rows']} filas ({stats['rows'] / (time.monotonic() - started):.0f} filas/s)")
+
+        # Páginas cuyo slug desapareció del CSV (las de filas inválidas se mantuvieron arriba)
+        for (slug,) in conn.execute('SELECT slug FROM pages WHERE build_id != ?', (build_id,)):
+            remove_page(slug)
+            stats['removed'] += 1
+            if stats['removed'] <= MAX_REPORTED_PAGES:
+                print(f"🗑️  Eliminada: {slug}/index.html")
+        conn.execute('DELETE FROM pages WHERE build_id != ?', (build_id,))
+        conn.commit()
+        sitemap.close()
+    finally:
+        sitemap.abort()
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        conn.close()
+
+    if stats['written'] > MAX_REPORTED_PAGES:
+        print(f"✅ ... y {stats['written'] - MAX_REPORTED_PAGES} páginas más")
+
+    if write_stylesheet():
+        print(f"✅ Actualizada: css/{STYLESHEET_NAME}")
+
+    if sitemap.changed:
+        print(f"✅ Actualizado: sitemap.xml ({len(sitemap.shards)} shards, {sitemap.changed} archivos reescritos)")
+
+    elapsed = time.monotonic() - started
+    pages = stats['written'] + stats['unchanged']
+
     print("=" * 60)
-    print(f"📄 Total páginas generadas: {len(slugs)}")
+    print(f"📄 Total páginas: {pages} | escritas: {stats['written']} | sin cambios: {stats['unchanged']} | eliminadas: {stats['removed']}")
+    print(f"⚙️  Procesos: {workers} | {stats['rows']} filas en {elapsed:.2f}s ({stats['rows'] / elapsed:.0f} filas/s)")
+    if stats['invalid']:
+        print(f"⚠️  Filas inválidas omitidas: {stats['invalid']} (mantenidas con la versión anterior: {stats['kept']})")
+        for error in errors:
+            print(f"   - {error}")
     print(f"🌐 Sitemap: {BASE_URL}/sitemap.xml")
     print()
     print("⚠️  RECORDATORIO:")
@@ -348,4 +821,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
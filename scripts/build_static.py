@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build Static - Pipeline de assets estáticos para /site
+Crea /site/dist/ con archivos con hash de contenido, variantes
+precomprimidas (.gz / .br) y /site/dist/manifest.json
+
+Se puede correr con el servidor andando: el build se arma en un directorio
+aparte (/site/.dist-XXXX) y /site/dist es un symlink que se cambia de golpe
+con os.replace. Los assets con hash de builds anteriores se conservan
+STATIC_KEEP_DAYS días para los navegadores que todavía tienen el HTML viejo.
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+try:
+    import brotli
+except ImportError:  # Brotli es opcional: sin él solo se generan .gz
+    brotli = None
+
+SITE_PATH = os.path.join(os.path.dirname(__file__), '..', 'site')
+DIST_PATH = os.path.join(SITE_PATH, 'dist')
+MANIFEST_NAME = 'manifest.json'
+BUILD_PREFIX = '.dist-'
+# Días que se siguen sirviendo los assets con hash que dejó de usar el build actual
+KEEP_PREVIOUS_SECONDS = float(os.getenv('STATIC_KEEP_DAYS', '7')) * 86400
+
+# Archivos que se renombran con hash (cacheables para siempre)
+HASHED_EXTENSIONS = {'.js', '.css', '.jpg', '.jpeg', '.png', '.webp', '.avif', '.gif', '.svg', '.ico', '.woff', '.woff2'}
+# Archivos que necesitan URL estable aunque sean JS/manifest
+STABLE_NAMES = {'sw.js', 'manifest.webmanifest', 'robots.txt', 'sitemap.xml'}
+# Tipos de texto que vale la pena comprimir (JPEG/PNG ya vienen comprimidos)
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.css', '.svg', '.json', '.webmanifest', '.xml', '.txt'}
+# No comprimir archivos muy chicos: el overhead no compensa
+MIN_COMPRESS_SIZE = 256
+HASH_LENGTH = 10
+
+# Referencias a reescribir en HTML: src="/main.js", href="/assets/1.jpg"
+REFERENCE_RE = re.compile(r'((?:src|href)=["\'])(/?)([^"\'#?:]+)(["\'#?])')
+# Listas de candidatos: srcset="/assets/responsive/1-320w.webp 320w, ..."
+SRCSET_RE = re.compile(r'(srcset=["\'])([^"\']+)(["\'])')
+
+def content_hash(data):
+    """Hash SHA-256 del contenido (hex)"""
+    return hashlib.sha256(data).hexdigest()
+
+def hashed_name(rel_path, digest):
+    """assets/1.jpg -> assets/1.<hash>.jpg"""
+    root, ext = os.path.splitext(rel_path)
+    return f"{root}.{digest[:HASH_LENGTH]}{ext}"
+
+def iter_site_files():
+    """Recorrer /site (sin /site/dist ni builds) devolviendo rutas relativas con '/'"""
+    for dirpath, dirnames, filenames in os.walk(SITE_PATH):
+        if dirpath == SITE_PATH:
+            dirnames[:] = [d for d in dirnames if d != 'dist' and not d.startswith(BUILD_PREFIX)]
+            filenames = [f for f in filenames if f != 'dist']
+        dirnames.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            yield os.path.relpath(full_path, SITE_PATH).replace(os.sep, '/')
+
+def should_hash(rel_path):
+    """Los assets se versionan; HTML, sw.js y manifest mantienen su URL"""
+    ext = os.path.splitext(rel_path)[1].lower()
+    return ext in HASHED_EXTENSIONS and os.path.basename(rel_path) not in STABLE_NAMES
+
+def rewrite_url(url, base_dir, hashed_paths):
+    """Devolver la URL con hash de un asset (o la misma si no está versionado)"""
+    slash = '/' if url.startswith('/') else ''
+    target = url[len(slash):]
+    # Resolver relativo a la raíz del sitio o al directorio del HTML
+    resolved = target if slash else os.path.normpath(os.path.join(base_dir, target)).replace(os.sep, '/')
+    if resolved not in hashed_paths:
+        return url
+    return slash + (hashed_paths[resolved] if slash else os.path.relpath(hashed_paths[resolved], base_dir or '.'))
+
+def rewrite_references(html, rel_path, hashed_paths):
+    """Reemplazar referencias a assets (src, href y srcset) por su nombre con hash"""
+    base_dir = os.path.dirname(rel_path)
+
+    def replace(match):
+        prefix, slash, target, suffix = match.groups()
+        return f"{prefix}{rewrite_url(slash + target, base_dir, hashed_paths)}{suffix}"
+
+    def replace_srcset(match):
+        prefix, candidates, suffix = match.groups()
+        rewritten = []
+        for candidate in candidates.split(','):
+            parts = candidate.strip().split(None, 1)
+            if not parts:
+                continue
+            parts[0] = rewrite_url(parts[0], base_dir, hashed_paths)
+            rewritten.append(' '.join(parts))
+        return f"{prefix}{', '.join(rewritten)}{suffix}"
+
+    return SRCSET_RE.sub(replace_srcset, REFERENCE_RE.sub(replace, html))
+
+def write_file(path, data):
+    """Escribir bytes creando directorios intermedios"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def write_compressed_variants(out_path, data):
+    """Generar .gz y .br si achican el archivo. Devuelve {encoding: bytes}"""
+    variants = {}
+
+    if len(data) < MIN_COMPRESS_SIZE:
+        return variants
+
+    gz_data = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz_data) < len(data):
+        write_file(out_path + '.gz', gz_data)
+        variants['gzip'] = len(gz_data)
+
+    if brotli is not None:
+        br_data = brotli.compress(data, quality=11)
+        if len(br_data) < len(data):
+            write_file(out_path + '.br', br_data)
+            variants['br'] = len(br_data)
+
+    return variants
+
+def load_previous_manifest():
+    """Manifest del build activo (o vacío si nunca se generó)"""
+    try:
+        with open(os.path.join(DIST_PATH, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def keep_previous_assets(previous, manifest, build_path, now):
+    """
+    Copiar al build nuevo los assets con hash del build anterior que ya no se
+    usan, mientras no superen KEEP_PREVIOUS_SECONDS desde que se retiraron.
+    Devuelve {ruta con hash: entry} para la sección 'previous' del manifest.
+    """
+    current_paths = {entry['path'] for entry in manifest.values()}
+    retired = dict(previous.get('previous', {}))
+    for original, entry in previous.get('files', {}).items():
+        if entry.get('immutable'):
+            retired.setdefault(entry['path'], dict(entry, original=original, retired_at=now))
+
+    kept = {}
+    for path, entry in retired.items():
+        if path in current_paths or now - entry.get('retired_at', now) > KEEP_PREVIOUS_SECONDS:
+            continue
+        suffixes = [''] + [{'br': '.br', 'gzip': '.gz'}[encoding] for encoding in entry.get('encodings', {})]
+        try:
+            for suffix in suffixes:
+                out_path = os.path.join(build_path, path + suffix)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                shutil.copy2(os.path.join(DIST_PATH, path + suffix), out_path)
+        except OSError:
+            continue
+        kept[path] = entry
+    return kept
+
+def activate_build(build_path):
+    """Apuntar /site/dist al build nuevo (symlink reemplazado con os.replace)"""
+    previous_target = os.path.realpath(DIST_PATH) if os.path.islink(DIST_PATH) else None
+
+    if os.path.isdir(DIST_PATH) and not os.path.islink(DIST_PATH):
+        # dist de una versión anterior del script (directorio real): se corre a un lado
+        legacy_path = tempfile.mkdtemp(dir=SITE_PATH, prefix=BUILD_PREFIX)
+        os.replace(DIST_PATH, os.path.join(legacy_path, 'dist'))
+        previous_target = legacy_path
+
+    link_path = os.path.join(SITE_PATH, f"{BUILD_PREFIX}link-{os.getpid()}")
+    os.symlink(os.path.basename(build_path), link_path)
+    os.replace(link_path, DIST_PATH)
+
+    # Los requests en curso ya tienen sus archivos abiertos; los nuevos ven el build nuevo
+    if previous_target and previous_target != os.path.realpath(build_path):
+        shutil.rmtree(previous_target, ignore_errors=True)
+
+def main():
+    """Generar /site/dist con assets versionados y precomprimidos"""
+
+    print("🚀 Generando assets estáticos precomprimidos...")
+    print("=" * 60)
+
+    if brotli is None:
+        print("⚠️  Módulo brotli no instalado: solo se generan variantes .gz")
+
+    # Se arma al lado y se activa al final: el build en uso no se toca mientras tanto
+    build_path = tempfile.mkdtemp(dir=SITE_PATH, prefix=BUILD_PREFIX)
+    now = time.time()
+
+    files = list(iter_site_files())
+    manifest = {}
+    hashed_paths = {}
+
+    # 1. Assets versionados (primero, para poder reescribir el HTML)
+    for rel_path in files:
+        if not should_hash(rel_path):
+            continue
+        with open(os.path.join(SITE_PATH, rel_path), 'rb') as f:
+            data = f.read()
+        digest = content_hash(data)
+        hashed_paths[rel_path] = hashed_name(rel_path, digest)
+        manifest[rel_path] = {'path': hashed_paths[rel_path], 'etag': digest[:16], 'data': data}
+
+    # 2. Archivos con URL estable (HTML, sw.js, manifest...)
+    for rel_path in files:
+        if rel_path in manifest:
+            continue
+        with open(os.path.join(SITE_PATH, rel_path), 'rb') as f:
+            data = f.read()
+        if rel_path.endswith('.html'):
+            data = rewrite_references(data.decode('utf-8'), rel_path, hashed_paths).encode('utf-8')
+        manifest[rel_path] = {'path': rel_path, 'etag': content_hash(data)[:16], 'data': data}
+
+    # 3. Escribir archivos y variantes comprimidas
+    original_bytes = 0
+    best_bytes = 0
+    for rel_path, entry in manifest.items():
+        data = entry.pop('data')
+        out_path = os.path.join(build_path, entry['path'])
+        write_file(out_path, data)
+
+        ext = os.path.splitext(rel_path)[1].lower()
+        variants = write_compressed_variants(out_path, data) if ext in COMPRESSIBLE_EXTENSIONS else {}
+
+        entry['size'] = len(data)
+        entry['encodings'] = variants
+        entry['immutable'] = rel_path in hashed_paths
+
+        original_bytes += len(data)
+        best_bytes += min([len(data)] + list(variants.values()))
+
+        encodings = ', '.join(f"{name} {size}B" for name, size in variants.items()) or 'sin comprimir'
+        print(f"✅ {rel_path} -> {entry['path']} ({len(data)}B; {encodings})")
+
+    kept = keep_previous_assets(load_previous_manifest(), manifest, build_path, now)
+
+    with open(os.path.join(build_path, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump({'files': manifest, 'previous': kept}, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    os.chmod(build_path, 0o755)
+    activate_build(build_path)
+
+    saved = original_bytes - best_bytes
+    print("=" * 60)
+    print(f"📄 Total archivos: {len(manifest)} (+{len(kept)} assets de builds anteriores)")
+    print(f"📦 Bytes originales: {original_bytes} | con mejor variante: {best_bytes} (-{saved}B)")
+    print(f"🗂️  Manifest: {os.path.join(DIST_PATH, MANIFEST_NAME)}")
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,39 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Push Test - Enviar notificación Web Push a todas las suscripciones
+Push Test - Enviar notificación Web Push a todas las suscripciones activas
+Usa la base de app.py (DATABASE_URL o robot.db): solo las suscripciones
+vivas (get_active_subscriptions) y el resultado de cada envío queda en el
+historial de entrega (record_push_results) que usa python app.py --prune-subs.
 """
 
 import sys
 import os
 import json
-import sqlite3
 from pywebpush import webpush, WebPushException
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DB_PATH = os.path.join(os.path.dirname(__file__), 'robot.db')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app
+
 VAPID_PRIVATE_KEY = os.getenv('VAPID_PRIVATE_KEY')
 VAPID_PUBLIC_KEY = os.getenv('VAPID_PUBLIC_KEY')
 VAPID_CLAIMS = {"sub": "mailto:admin@tusitio.com"}
 
-def get_all_subscriptions():
-    """Obtener todas las suscripciones activas"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.execute('SELECT * FROM push_subs')
-    subs = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return subs
+def is_permanent_failure(status_code):
+    """Rechazo definitivo del push service (4xx salvo 429); 429 y 5xx son transitorios"""
+    return status_code is not None and 400 <= status_code < 500 and status_code != 429
 
-def delete_subscription(sub_id):
-    """Eliminar suscripción inválida"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute('DELETE FROM push_subs WHERE id = ?', (sub_id,))
-    conn.commit()
-    conn.close()
-    print(f"  🗑️  Suscripción {sub_id} eliminada (inválida)")
+def save_results(delivered_ids, failed_ids):
+    """Guardar el historial de entrega del envío (una transacción)"""
+    conn = app.get_db_connection()
+    try:
+        app.record_push_results(conn.cursor(), delivered_ids, failed_ids)
+        conn.commit()
+    finally:
+        conn.close()
 
 def send_push_notification(title, body):
     """Enviar notificación a todas las suscripciones"""
@@ -43,13 +43,13 @@ def send_push_notification(title, body):
         print("   Generá las claves con: python -m pywebpush generate_vapid_keys")
         sys.exit(1)
     
-    if not os.path.exists(DB_PATH):
-        print(f"❌ Error: Base de datos no existe: {DB_PATH}")
-        print("   Ejecutá primero: python server/app.py --initdb")
+    try:
+        subs = app.get_active_subscriptions()
+    except Exception as e:
+        print(f"❌ Error leyendo suscripciones: {e}")
+        print("   Ejecutá primero: python app.py --initdb")
         sys.exit(1)
     
-    subs = get_all_subscriptions()
-    
     if not subs:
         print("⚠️  No hay suscripciones registradas")
         print("   Suscribite desde el PWA primero (botón 'Recibir cupones')")
@@ -66,18 +66,13 @@ def send_push_notification(title, body):
         'url': '/'
     })
     
-    success_count = 0
+    delivered_ids = []
+    failed_ids = []
     error_count = 0
     
     for sub in subs:
         try:
-            subscription_info = {
-                'endpoint': sub['endpoint'],
-                'keys': {
-                    'p256dh': sub['p256dh'],
-                    'auth': sub['auth']
-                }
-            }
+            subscription_info = {'endpoint': sub['endpoint'], 'keys': sub['keys']}
             
             webpush(
                 subscription_info=subscription_info,
@@ -87,23 +82,26 @@ def send_push_notification(title, body):
             )
             
             print(f"✅ Enviado a suscripción {sub['id']}")
-            success_count += 1
+            delivered_ids.append(sub['id'])
         
         except WebPushException as e:
             error_count += 1
             print(f"❌ Error en suscripción {sub['id']}: {e}")
             
-            # Si es 410 (Gone) o 404 (Not Found), eliminar suscripción
-            if e.response and e.response.status_code in [410, 404]:
-                delete_subscription(sub['id'])
+            # 404/410 y demás rechazos definitivos suman fallos (--prune-subs la elimina al llegar al límite)
+            status_code = e.response.status_code if e.response is not None else None
+            if is_permanent_failure(status_code):
+                failed_ids.append(sub['id'])
         
         except Exception as e:
             error_count += 1
             print(f"❌ Error inesperado en suscripción {sub['id']}: {e}")
     
+    save_results(delivered_ids, failed_ids)
+    
     print("=" * 60)
-    print(f"✅ Exitosas: {success_count}")
-    print(f"❌ Errores: {error_count}")
+    print(f"✅ Exitosas: {len(delivered_ids)}")
+    print(f"❌ Errores: {error_count} (rechazos definitivos: {len(failed_ids)})")
 
 def generate_vapid_keys():
     """Generar claves VAPID (solo para setup inicial)"""
@@ -25,6 +25,9 @@ class Analytics {
         // Trackear clics en elementos importantes
         this.trackClicks();
         
+        // Pasar la sesión a los links de compra (/go/<slug>)
+        this.tagOutboundLinks();
+        
         // Trackear scroll (interés en la página)
         this.trackScroll();
         
@@ -87,6 +90,21 @@ class Analytics {
         console.log('👆 Click trackeado:', data.element_text);
     }
     
+    tagOutboundLinks() {
+        // Los CTA llevan UTM fijos del botón: con la sesión, el servidor atribuye
+        // el clic (y la venta) a los UTM con los que llegó la visita
+        const tag = (e) => {
+            const link = e.target.closest('a[href*="/go/"]');
+            if (!link) return;
+            const url = new URL(link.href, window.location.href);
+            if (url.origin !== window.location.origin || !url.pathname.startsWith('/go/')) return;
+            url.searchParams.set('sid', this.sessionId);
+            link.href = url.toString();
+        };
+        document.addEventListener('click', tag, true);
+        document.addEventListener('auxclick', tag, true);
+    }
+    
     trackScroll() {
         let scrollTimeout;
         let maxScroll = 0;
@@ -45,14 +45,16 @@ async function suscribirPush() {
       applicationServerKey: urlBase64ToUint8Array(CONFIG.VAPID_PUBLIC_KEY)
     });
 
-    // Enviar suscripción al backend
-    const response = await fetch(`${CONFIG.API_BASE}/api/save-sub`, {
+    // Enviar suscripción al backend (app.py: la misma base que usa el envío de campañas)
+    const response = await fetch(`${CONFIG.API_BASE}/api/push/subscribe`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
         endpoint: subscription.endpoint,
-        p256dh: arrayBufferToBase64(subscription.getKey('p256dh')),
-        auth: arrayBufferToBase64(subscription.getKey('auth'))
+        keys: {
+          p256dh: arrayBufferToBase64(subscription.getKey('p256dh')),
+          auth: arrayBufferToBase64(subscription.getKey('auth'))
+        }
       })
     });
 
@@ -63,6 +63,8 @@ self.addEventListener('push', event => {
       notification.title = payload.title || notification.title;
       notification.body = payload.body || notification.body;
       notification.data.url = payload.url || notification.data.url;
+      // ID de la fila en notifications, para medir aperturas y clics
+      notification.data.id = payload.id || payload.notification_id || null;
     } catch (e) {
       console.log('[SW] Push sin JSON, usando defaults');
     }
@@ -76,10 +78,22 @@ self.addEventListener('push', event => {
       tag: notification.tag,
       requireInteraction: notification.requireInteraction,
       data: notification.data
-    })
+    }).then(() => reportNotificationEvent('open', notification.data))
   );
 });
 
+// Reportar apertura/clic al backend (el SW no tiene sendBeacon: fetch keepalive)
+function reportNotificationEvent(eventName, data) {
+  if (!data || !data.id) return Promise.resolve();
+
+  return fetch('/api/push/track', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ notification_id: data.id, event: eventName }),
+    keepalive: true
+  }).catch(err => console.log('[SW] Error reportando notificación:', err));
+}
+
 // Click en notificación: abrir/enfocar app
 self.addEventListener('notificationclick', event => {
   console.log('[SW] Notification click');
@@ -87,21 +101,23 @@ self.addEventListener('notificationclick', event => {
 
   const urlToOpen = event.notification.data?.url || '/';
 
-  event.waitUntil(
-    clients.matchAll({ type: 'window', includeUncontrolled: true })
-      .then(windowClients => {
-        // Si ya hay una ventana abierta, enfocarla
-        for (let i = 0; i < windowClients.length; i++) {
-          const client = windowClients[i];
-          if (client.url === urlToOpen && 'focus' in client) {
-            return client.focus();
-          }
+  const openWindow = clients.matchAll({ type: 'window', includeUncontrolled: true })
+    .then(windowClients => {
+      // Si ya hay una ventana abierta, enfocarla
+      for (let i = 0; i < windowClients.length; i++) {
+        const client = windowClients[i];
+        if (client.url === urlToOpen && 'focus' in client) {
+          return client.focus();
         }
-        // Si no, abrir nueva ventana
-        if (clients.openWindow) {
-          return clients.openWindow(urlToOpen);
-        }
-      })
-  );
-});
+      }
+      // Si no, abrir nueva ventana
+      if (clients.openWindow) {
+        return clients.openWindow(urlToOpen);
+      }
+    });
 
+  event.waitUntil(Promise.all([
+    openWindow,
+    reportNotificationEvent('click', event.notification.data)
+  ]));
+});
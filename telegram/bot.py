@@ -2,19 +2,57 @@
 # -*- coding: utf-8 -*-
 """
 Bot de Telegram - Catálogo de productos Hotmart
+
+Modos:
+  - Webhook (producción): app.py recibe los updates en /telegram/webhook
+    y los procesa con los handlers de este archivo. Registrar la URL con:
+    python telegram/bot.py --set-webhook
+  - Polling (desarrollo local): python telegram/bot.py
+    Usa la base de app.py directamente para guardar los chats de /start
+    y responder FAQs.
 """
 
 import os
+import sys
+import json
+import bisect
+import asyncio
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes
+import threading
+import unicodedata
+from urllib.request import urlopen
+from urllib.parse import urlencode
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.ext import (
+    Application, CommandHandler, CallbackQueryHandler, InlineQueryHandler, MessageHandler, ContextTypes, filters
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Configuración
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# Webhook: URL pública y secreto que Telegram manda en X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', f"{os.getenv('BASE_URL_PUBLICA', 'http://localhost:5000')}/telegram/webhook")
+WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+# URL de la Bot API (se puede apuntar a un servidor local o falso para pruebas)
+API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+# Updates procesados en paralelo
+CONCURRENT_UPDATES = int(os.getenv('TELEGRAM_CONCURRENT_UPDATES', '32'))
+# Usuarios (ids de Telegram) que pueden usar /anunciar, separados por coma
+ADMIN_IDS = {int(i) for i in os.getenv('TELEGRAM_ADMIN_IDS', '').replace(' ', '').split(',') if i}
+# Productos por página del teclado del catálogo
+PRODUCTOS_POR_PAGINA = int(os.getenv('TELEGRAM_PRODUCTOS_POR_PAGINA', '8'))
+# Resultados por respuesta de inline query (máximo de Telegram: 50)
+RESULTADOS_INLINE = 50
 HOTLINK_BASE = os.getenv('HOTMART_HOTLINK_BASE', 'https://go.hotmart.com/H102540942W')
+# Catálogo compartido con la web (tabla products, servido por app.py)
+CATALOG_URL = os.getenv('CATALOG_URL', f"{os.getenv('BASE_URL_PUBLICA', 'http://localhost:5000')}/api/products")
+# Los links de compra pasan por /go/<slug> de la web (registra el clic y redirige)
+LINKS_BASE = os.getenv('BASE_URL_PUBLICA', '')
 
 # Logging
 logging.basicConfig(
@@ -26,26 +64,222 @@ logger = logging.getLogger(__name__)
 # ============================================
 # CATÁLOGO DE PRODUCTOS
 # ============================================
-# Editar aquí para agregar/quitar productos
+# Los productos se cargan de /api/products (tabla products).
+# Esta lista solo se usa si la API no responde.
 PRODUCTOS = [
     {
         'nombre': '🌿 Enciclopedia Plantas Medicinales',
         'slug': 'enciclopedia-plantas-medicinales',
         'precio': 'USD 29',
-        'descripcion': 'Guía completa con 550+ hierbas y usos medicinales'
+        'descripcion': 'Guía completa con 550+ hierbas y usos medicinales',
+        'link': HOTLINK_BASE
     }
 ]
 
+def cargar_productos():
+    """
+    Leer el catálogo desde la API de la web (una vez, al iniciar el bot)
+    """
+    try:
+        with urlopen(CATALOG_URL, timeout=10) as response:
+            data = json.load(response)
+    except Exception as e:
+        logger.warning(f'No se pudo cargar el catálogo desde {CATALOG_URL}: {e}')
+        return PRODUCTOS
+
+    productos = [
+        {
+            'nombre': p['name'],
+            'slug': p['slug'],
+            'precio': f"{p['currency']} {p['price']:g}" if p.get('price') is not None else '',
+            'descripcion': p['description'],
+            'link': f"{LINKS_BASE}/go/{p['slug']}" if LINKS_BASE else (p['hotmart_link'] or HOTLINK_BASE)
+        }
+        for p in data.get('products', [])
+    ]
+    logger.info(f"Catálogo cargado: {len(productos)} productos (versión {data.get('version')})")
+    return productos or PRODUCTOS
+
+async def obtener_productos(context):
+    """
+    Productos vigentes: en modo webhook app.py registra una función que lee
+    el snapshot del catálogo; en polling se usa la lista cargada al iniciar
+    """
+    catalogo = context.bot_data.get('catalogo')
+    if catalogo:
+        try:
+            # Puede releer la base al vencer el snapshot: fuera del event loop
+            return await asyncio.to_thread(catalogo)
+        except Exception as e:
+            logger.warning(f'No se pudo leer el catálogo: {e}')
+            return PRODUCTOS
+    return context.bot_data.get('productos', PRODUCTOS)
+
+# ============================================
+# TECLADOS E ÍNDICE DE BÚSQUEDA (CACHEADOS)
+# ============================================
+
+def normalizar(texto):
+    """'Té de Manzanilla' -> 'te de manzanilla' (sin acentos, minúsculas)"""
+    texto = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode('ascii')
+    return texto.lower()
+
+def palabras(texto):
+    """Palabras normalizadas de un texto"""
+    return [p for p in ''.join(c if c.isalnum() else ' ' for c in normalizar(texto)).split() if p]
+
+def link_producto(producto, medio):
+    """Link de compra con UTM (medio: bot, inline...)"""
+    params = urlencode({
+        'utm_source': 'telegram',
+        'utm_medium': medio,
+        'utm_campaign': 'robot',
+        'src': f"telegram-{producto['slug']}"
+    })
+    separador = '&' if '?' in producto['link'] else '?'
+    return f"{producto['link']}{separador}{params}"
+
+class CatalogoBot:
+    """
+    Teclados del catálogo (uno por página) y resultados de inline query,
+    armados una sola vez por versión de la lista de productos.
+    /start, la paginación y las búsquedas solo leen estructuras ya hechas.
+    """
+
+    def __init__(self, productos):
+        self.productos = productos
+        self.paginas = self._armar_paginas(productos)
+        self.resultados = [self._armar_resultado(p) for p in productos]
+
+        # Índice invertido: palabra -> posiciones de productos que la contienen
+        indice = {}
+        for posicion, producto in enumerate(productos):
+            texto = f"{producto['nombre']} {producto['descripcion']} {producto['slug']}"
+            for palabra in set(palabras(texto)):
+                indice.setdefault(palabra, set()).add(posicion)
+        self.indice = indice
+        # Palabras ordenadas: búsqueda por prefijo con bisect ("manz" -> "manzanilla")
+        self.vocabulario = sorted(indice)
+
+    def _armar_paginas(self, productos):
+        total_paginas = max(1, -(-len(productos) // PRODUCTOS_POR_PAGINA))
+        paginas = []
+
+        for numero in range(total_paginas):
+            inicio = numero * PRODUCTOS_POR_PAGINA
+            keyboard = []
+
+            for producto in productos[inicio:inicio + PRODUCTOS_POR_PAGINA]:
+                # Texto del botón
+                button_text = f"{producto['nombre']} - {producto['precio']}" if producto['precio'] else producto['nombre']
+                keyboard.append([InlineKeyboardButton(button_text, url=link_producto(producto, 'bot'))])
+
+            # Navegación entre páginas (solo si hay más de una)
+            if total_paginas > 1:
+                navegacion = []
+                if numero > 0:
+                    navegacion.append(InlineKeyboardButton("◀️ Anterior", callback_data=f'catalogo:{numero - 1}'))
+                navegacion.append(InlineKeyboardButton(f"{numero + 1}/{total_paginas}", callback_data=f'catalogo:{numero}'))
+                if numero < total_paginas - 1:
+                    navegacion.append(InlineKeyboardButton("Siguiente ▶️", callback_data=f'catalogo:{numero + 1}'))
+                keyboard.append(navegacion)
+
+            keyboard.append([
+                InlineKeyboardButton("🔎 Buscar", switch_inline_query_current_chat=''),
+                InlineKeyboardButton("❓ Ayuda", callback_data='ayuda')
+            ])
+            paginas.append(InlineKeyboardMarkup(keyboard))
+
+        return paginas
+
+    def _armar_resultado(self, producto):
+        link = link_producto(producto, 'inline')
+        precio = f" - {producto['precio']}" if producto['precio'] else ''
+        return InlineQueryResultArticle(
+            id=producto['slug'][:64],
+            title=f"{producto['nombre']}{precio}",
+            description=producto['descripcion'],
+            input_message_content=InputTextMessageContent(f"{producto['nombre']}{precio}\n{producto['descripcion']}\n\n👉 {link}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Ver producto", url=link)]])
+        )
+
+    def pagina(self, numero):
+        """Teclado de una página (acotado al rango válido)"""
+        return self.paginas[min(max(numero, 0), len(self.paginas) - 1)]
+
+    def buscar(self, consulta):
+        """Resultados de inline query: todas las palabras deben matchear (por prefijo)"""
+        terminos = palabras(consulta)
+        if not terminos:
+            return self.resultados
+
+        posiciones = None
+        for termino in terminos:
+            encontradas = set()
+            i = bisect.bisect_left(self.vocabulario, termino)
+            while i < len(self.vocabulario) and self.vocabulario[i].startswith(termino):
+                encontradas |= self.indice[self.vocabulario[i]]
+                i += 1
+            posiciones = encontradas if posiciones is None else posiciones & encontradas
+            if not posiciones:
+                return []
+
+        return [self.resultados[i] for i in sorted(posiciones)]
+
+_catalogo_cache = {'productos': None, 'catalogo': None}
+_catalogo_lock = threading.Lock()
+
+async def obtener_catalogo(context):
+    """Teclados e índice vigentes; se rearman solo si cambió la lista de productos"""
+    productos = await obtener_productos(context)
+    cache = _catalogo_cache
+    if productos is cache['productos']:
+        return cache['catalogo']
+
+    with _catalogo_lock:
+        if productos is not cache['productos']:
+            if cache['catalogo'] is None or productos != cache['productos']:
+                cache['catalogo'] = CatalogoBot(productos)
+                logger.info(f"Teclados del catálogo armados: {len(productos)} productos, {len(cache['catalogo'].paginas)} páginas")
+            cache['productos'] = productos
+    return cache['catalogo']
+
 # ============================================
 # HANDLERS
 # ============================================
 
+MENSAJE_AYUDA = """
+🤖 **Robot de Ventas - Ayuda**
+
+**Comandos disponibles:**
+/start - Ver catálogo de productos
+/ayuda - Ver esta ayuda
+
+**¿Dudas sobre un producto?**
+Hacé click en el producto que te interesa y verás toda la info en la página.
+También podés escribirme tu pregunta (pagos, entrega, garantía...) y te respondo.
+También podés buscar productos desde cualquier chat escribiendo @ y el nombre del bot.
+
+**¿Problemas con tu compra?**
+Escribinos a: soporte@tusitio.com
+
+**Garantía:**
+Todos nuestros productos tienen garantía de 7 días. Si no te gusta, te devolvemos el 100%.
+
+🔒 **Pago seguro:** Procesado por Hotmart (certificado PCI-DSS)
+"""
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Comando /start - Mostrar catálogo con botones inline
     """
     user = update.effective_user
     
+    # Guardar el chat para futuras difusiones
+    registrar_chat = context.bot_data.get('registrar_chat')
+    if registrar_chat:
+        await registrar_chat(update.effective_chat, user)
+    
     mensaje = f"""
 ¡Hola {user.first_name}! 👋
 
@@ -54,22 +288,7 @@ Soy el Robot de Ventas. Te ayudo a elegir el producto digital perfecto para tu n
 🛍️ **Catálogo de Productos:**
 """
     
-    # Crear botones inline para cada producto
-    keyboard = []
-    
-    for producto in PRODUCTOS:
-        # URL con UTM tracking
-        url = f"{HOTLINK_BASE}?utm_source=telegram&utm_medium=bot&utm_campaign=robot&src=telegram-{producto['slug']}"
-        
-        # Texto del botón
-        button_text = f"{producto['nombre']} - {producto['precio']}"
-        
-        keyboard.append([InlineKeyboardButton(button_text, url=url)])
-    
-    # Agregar botón de ayuda
-    keyboard.append([InlineKeyboardButton("❓ Ayuda", callback_data='ayuda')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = (await obtener_catalogo(context)).pagina(0)
     
     await update.message.reply_text(mensaje, reply_markup=reply_markup, parse_mode='Markdown')
 
@@ -77,26 +296,83 @@ async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Comando /ayuda - Información de soporte
     """
-    mensaje = """
-🤖 **Robot de Ventas - Ayuda**
-
-**Comandos disponibles:**
-/start - Ver catálogo de productos
-/ayuda - Ver esta ayuda
+    await update.message.reply_text(MENSAJE_AYUDA, parse_mode='Markdown')
 
-**¿Dudas sobre un producto?**
-Hacé click en el producto que te interesa y verás toda la info en la página.
+MENSAJE_SIN_RESPUESTA = """
+🤔 No encontré una respuesta para eso.
 
-**¿Problemas con tu compra?**
-Escribinos a: soporte@tusitio.com
+Escribinos a soporte@tusitio.com y te respondemos a la brevedad, o usá /start para ver el catálogo.
+"""
 
-**Garantía:**
-Todos nuestros productos tienen garantía de 7 días. Si no te gusta, te devolvemos el 100%.
+async def responder_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Texto libre en chat privado - Responder con la FAQ más parecida
+    (índice en memoria de app.py, sin pasar por /api/faq; también en polling)
+    """
+    buscar_faq = context.bot_data.get('faq')
+    pregunta = update.message.text
+    
+    respuesta = None
+    if buscar_faq:
+        # El índice puede releer la base al vencer: fuera del event loop
+        respuesta = await asyncio.to_thread(buscar_faq, pregunta)
+    
+    if not respuesta:
+        await update.message.reply_text(MENSAJE_SIN_RESPUESTA)
+        return
+    
+    await update.message.reply_text(f"❓ {respuesta['question']}\n\n{respuesta['answer']}")
 
-🔒 **Pago seguro:** Procesado por Hotmart (certificado PCI-DSS)
-"""
+async def anunciar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando /anunciar <texto> - Difundir un mensaje a todos los usuarios (solo admins)
+    """
+    difundir = context.bot_data.get('difundir')
+    if not difundir or update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    texto = update.message.text.partition(' ')[2].strip()
+    if not texto:
+        await update.message.reply_text("Uso: /anunciar <texto del anuncio>")
+        return
     
-    await update.message.reply_text(mensaje, parse_mode='Markdown')
+    broadcast_id = await difundir(texto, update.effective_chat.id)
+    await update.message.reply_text(f"📣 Difusión #{broadcast_id} iniciada. Te aviso cuando termine.")
+
+async def ayuda_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Botón "❓ Ayuda" del catálogo
+    """
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text(MENSAJE_AYUDA, parse_mode='Markdown')
+
+async def catalogo_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Botones de paginación del catálogo (callback_data 'catalogo:<página>')
+    """
+    query = update.callback_query
+    await query.answer()
+    numero = int(query.data.split(':', 1)[1])
+    reply_markup = (await obtener_catalogo(context)).pagina(numero)
+    # Tocar la página actual no cambia nada (Telegram rechaza la edición)
+    if query.message.reply_markup != reply_markup:
+        await query.edit_message_reply_markup(reply_markup=reply_markup)
+
+async def buscar_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Inline query (@bot texto) - Buscar en el catálogo desde cualquier chat
+    """
+    query = update.inline_query
+    resultados = (await obtener_catalogo(context)).buscar(query.query)
+
+    inicio = int(query.offset) if query.offset.isdigit() else 0
+    fin = inicio + RESULTADOS_INLINE
+    await query.answer(
+        resultados[inicio:fin],
+        cache_time=300,
+        next_offset=str(fin) if fin < len(resultados) else ''
+    )
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -104,6 +380,68 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     logger.error(f'Error: {context.error}')
 
+# ============================================
+# APLICACIÓN
+# ============================================
+
+def build_application(token, webhook=False):
+    """
+    Crear la aplicación con updates concurrentes.
+    En modo webhook no hay Updater: los updates llegan por update_queue.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .base_url(API_URL)
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    if webhook:
+        builder = builder.updater(None)
+    return builder.build()
+
+def register_handlers(app):
+    """Registrar handlers (compartido entre polling y webhook)"""
+    app.add_handler(CommandHandler('start', start))
+    app.add_handler(CommandHandler('ayuda', ayuda))
+    app.add_handler(CommandHandler('anunciar', anunciar))
+    app.add_handler(CallbackQueryHandler(ayuda_callback, pattern=r'^ayuda$'))
+    app.add_handler(CallbackQueryHandler(catalogo_pagina, pattern=r'^catalogo:\d+$'))
+    app.add_handler(InlineQueryHandler(buscar_inline))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, responder_faq))
+    
+    # Error handler
+    app.add_error_handler(error_handler)
+
+async def set_webhook():
+    """Registrar en Telegram la URL del webhook (reemplaza al polling)"""
+    app = build_application(TOKEN, webhook=True)
+    async with app:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=CONCURRENT_UPDATES,
+            drop_pending_updates=False
+        )
+        info = await app.bot.get_webhook_info()
+    print(f"✅ Webhook registrado: {info.url}")
+    print(f"   Updates pendientes: {info.pending_update_count}")
+
+def conectar_web(app):
+    """
+    Polling: registrar los hooks de app.py que usan la base (los mismos que
+    en modo webhook), así los chats de /start reciben las difusiones y el
+    texto libre se responde con el índice de FAQs
+    """
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    try:
+        import app as web
+    except Exception as e:
+        logger.warning(f'No se pudo cargar app.py, los chats no se guardan y no hay FAQs: {e}')
+        return
+    app.bot_data['registrar_chat'] = web.register_chat_from_bot
+    app.bot_data['faq'] = web.faq_index.match
+
 # ============================================
 # MAIN
 # ============================================
@@ -117,15 +455,19 @@ def main():
         print("   Obtené tu token desde @BotFather en Telegram")
         return
     
-    # Crear aplicación
-    app = Application.builder().token(TOKEN).build()
-    
-    # Registrar handlers
-    app.add_handler(CommandHandler('start', start))
-    app.add_handler(CommandHandler('ayuda', ayuda))
+    # Modo webhook: solo registrar la URL, los updates los procesa app.py
+    if '--set-webhook' in sys.argv:
+        if not WEBHOOK_SECRET:
+            print("❌ Error: TELEGRAM_WEBHOOK_SECRET no configurado en .env")
+            return
+        asyncio.run(set_webhook())
+        return
     
-    # Error handler
-    app.add_error_handler(error_handler)
+    # Crear aplicación
+    app = build_application(TOKEN)
+    app.bot_data['productos'] = cargar_productos()
+    conectar_web(app)
+    register_handlers(app)
     
     # Iniciar bot
     print("🤖 Robot de Ventas Hotmart - Bot de Telegram")
@@ -135,8 +477,8 @@ def main():
     print("🛑 Presioná Ctrl+C para detener")
     print("=" * 60)
     
+    # run_polling borra el webhook registrado (si lo hay) antes de empezar
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Webhook Test - Probar el bot en modo webhook contra una Bot API falsa
+Levanta un servidor local que imita api.telegram.org, apunta el bot a él
+(TELEGRAM_API_URL) y manda updates a /telegram/webhook de app.py.
+No necesita token real ni conexión a Telegram. Corre contra una base
+SQLite nueva en un directorio temporal (nunca toca el robot.db del repo).
+
+Uso: python telegram/webhook_test.py [cantidad_de_updates]
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBHOOK_SECRET = 'secreto-de-prueba'
+
+# Métodos de la Bot API recibidos: [(método, parámetros)]
+calls = []
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    """Responde ok a todo; getMe y sendMessage con objetos válidos"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        method = self.path.rsplit('/', 1)[-1]
+        calls.append((method, body))
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Robot', 'username': 'robot_test_bot'}
+        elif method == 'sendMessage':
+            result = {'message_id': len(calls), 'date': int(time.time()), 'chat': {'id': 42, 'type': 'private'}, 'text': ''}
+        else:
+            result = True
+
+        data = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_api():
+    """Levantar la Bot API falsa en un puerto libre"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_update(update_id, text='/start'):
+    """Update de un mensaje privado con un comando"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Prueba'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        }
+    }
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    server = start_fake_api()
+    os.environ['TELEGRAM_BOT_TOKEN'] = '123456:TEST'
+    os.environ['TELEGRAM_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{server.server_address[1]}/bot"
+
+    # app.py usa ./robot.db con SQLite: base nueva en un directorio temporal
+    os.environ.pop('DATABASE_URL', None)
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    workdir = tempfile.TemporaryDirectory(prefix='webhook-test-')
+    os.chdir(workdir.name)
+
+    import app
+    app.startup()
+
+    client = app.app.test_client()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+
+    print("🧪 Probando webhook de Telegram contra Bot API falsa...")
+    print("=" * 60)
+
+    response = client.post('/telegram/webhook', json=make_update(1), headers={'X-Telegram-Bot-Api-Secret-Token': 'otro'})
+    print(f"{'✅' if response.status_code == 403 else '❌'} Secreto inválido -> {response.status_code}")
+
+    started = time.monotonic()
+    for update_id in range(2, count + 2):
+        response = client.post('/telegram/webhook', json=make_update(update_id), headers=headers)
+        if response.status_code != 200:
+            print(f"❌ Update {update_id} -> {response.status_code}")
+    enqueued = time.monotonic() - started
+
+    # Esperar las respuestas del bot (procesadas en paralelo)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and sum(1 for method, _ in calls if method == 'sendMessage') < count:
+        time.sleep(0.05)
+    replied = sum(1 for method, _ in calls if method == 'sendMessage')
+    elapsed = time.monotonic() - started
+
+    app.telegram_bot.stop()
+    server.shutdown()
+    workdir.cleanup()
+
+    print(f"{'✅' if replied == count else '❌'} Respuestas enviadas: {replied}/{count}")
+    print(f"⏱️  Encolado: {enqueued * 1000 / count:.1f} ms/update | total: {elapsed:.2f}s")
+    print("=" * 60)
+
+if __name__ == '__main__':
+    main()